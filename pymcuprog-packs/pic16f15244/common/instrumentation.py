@@ -0,0 +1,313 @@
+"""
+Per-layer counters and timers for the debugger stack
+
+Functions are instrumented on the objects of a session by wrapping them, so nothing is spent when instrumentation is
+not asked for.  Each layer counts its calls and their wall time, and picks up how much happened below it during each
+call: USB round trips and polls, ATI fragments, primitive executions and sequences compiled.
+"""
+import time
+import logging
+import inspect
+import functools
+from collections import deque
+
+from pyedbglib.protocols.ati import VENDOR_COMMAND_ATI
+from pyedbglib.protocols.ati import ATI_FRAME_FLAGS
+from pyedbglib.protocols.ati import ATI_CTRL_BIT_READNWRITE
+from pyedbglib.protocols.ati import ATI_OK_FRAME
+
+# Counters kept by the instrumented layers
+USB_ROUND_TRIPS = 'usb_round_trips'
+USB_WRITES = 'usb_writes'
+USB_READS = 'usb_reads'
+USB_POLLS = 'usb_polls'
+USB_BYTES_OUT = 'usb_bytes_out'
+USB_BYTES_IN = 'usb_bytes_in'
+FRAGMENTS_OUT = 'fragments_out'
+FRAGMENTS_IN = 'fragments_in'
+EXECUTIONS = 'executions'
+BLOCKS = 'blocks'
+BLOCK_BYTES = 'block_bytes'
+SEQUENCES = 'sequences'
+SEQUENCES_COMPILED = 'sequences_compiled'
+SEQUENCE_BYTES_UNROLLED = 'sequence_bytes_unrolled'
+SEQUENCE_BYTES_ROLLED = 'sequence_bytes_rolled'
+
+COUNTERS = [USB_ROUND_TRIPS, USB_WRITES, USB_READS, USB_POLLS, USB_BYTES_OUT, USB_BYTES_IN, FRAGMENTS_OUT,
+            FRAGMENTS_IN, EXECUTIONS, BLOCKS, BLOCK_BYTES, SEQUENCES, SEQUENCES_COMPILED, SEQUENCE_BYTES_UNROLLED,
+            SEQUENCE_BYTES_ROLLED]
+
+# Upper bounds of the call latency histogram bins, in seconds (the last bin takes anything slower)
+LATENCY_BINS_S = [1e-5, 1e-4, 1e-3, 1e-2, 1e-1, 1.0]
+
+# Debugger methods which set up and tear down the instrumentation itself
+NOT_INSTRUMENTED = ['setup_session', 'teardown_session', 'load_device_object']
+
+
+def _is_ati_read(packet):
+    """
+    :return: True if the packet is an ATI fragment read
+    """
+    return packet[0] == VENDOR_COMMAND_ATI and packet[ATI_FRAME_FLAGS] & (1 << ATI_CTRL_BIT_READNWRITE)
+
+
+class LayerStatistics(object):
+    """
+    Statistics of one instrumented function: cumulative, and for the last calls
+    """
+
+    def __init__(self, name, history_size=0):
+        """
+        :param name: layer name
+        :param history_size: number of calls to keep the statistics of, besides the last one
+        """
+        self.name = name
+        self.calls = 0
+        self.wall_s = 0.0
+        self.min_s = None
+        self.max_s = 0.0
+        self.histogram = [0] * (len(LATENCY_BINS_S) + 1)
+        self.counters = dict((counter, 0) for counter in COUNTERS)
+        self.last_call = None
+        self.history = deque(maxlen=history_size)
+
+    def record(self, wall_s, deltas):
+        """
+        Adds a call
+        :param wall_s: wall time of the call
+        :param deltas: dictionary of the counters moved during the call, by how much
+        """
+        self.calls += 1
+        self.wall_s += wall_s
+        if self.min_s is None or wall_s < self.min_s:
+            self.min_s = wall_s
+        if wall_s > self.max_s:
+            self.max_s = wall_s
+        index = 0
+        while index < len(LATENCY_BINS_S) and wall_s > LATENCY_BINS_S[index]:
+            index += 1
+        self.histogram[index] += 1
+        for counter, delta in deltas.items():
+            self.counters[counter] += delta
+        self.last_call = dict(deltas, wall_s=wall_s)
+        if self.history.maxlen:
+            self.history.append(self.last_call)
+
+    def get_statistics(self):
+        """
+        :return: dictionary of the statistics of this layer
+        """
+        return {
+            'calls': self.calls,
+            'wall_s': self.wall_s,
+            'mean_s': self.wall_s / self.calls if self.calls else 0.0,
+            'min_s': self.min_s or 0.0,
+            'max_s': self.max_s,
+            'histogram': list(self.histogram),
+            'counters': dict(self.counters),
+            'last_call': self.last_call,
+            'history': list(self.history),
+        }
+
+
+class Instrumentation(object):
+    """
+    Counts and times what the layers of a debugger stack do
+    """
+
+    def __init__(self, history_size=0):
+        """
+        :param history_size: number of calls to keep the statistics of for each layer, besides the last one
+        """
+        self.logger = logging.getLogger(__name__)
+        self.history_size = history_size
+        self.counters = None
+        self.layers = None
+        self._instrumented = []
+        self.reset_statistics()
+
+    def reset_statistics(self):
+        """
+        Clears all statistics
+        """
+        self.counters = dict((counter, 0) for counter in COUNTERS)
+        self.layers = {}
+
+    def get_statistics(self):
+        """
+        Retrieve the statistics
+        :return: dictionary with the totals of each counter, the latency histogram bins and the statistics of each layer
+        """
+        return {
+            'counters': dict(self.counters),
+            'latency_bins_s': list(LATENCY_BINS_S),
+            'layers': dict((name, layer.get_statistics()) for name, layer in self.layers.items()),
+        }
+
+    def count(self, counter, value=1):
+        """
+        Moves a counter
+        :param counter: counter name
+        :param value: how much to add
+        """
+        self.counters[counter] += value
+
+    def wrap(self, function, layer, account=None):
+        """
+        Wraps a function, so that its calls are recorded
+        :param function: function to wrap
+        :param layer: layer name to record the calls under
+        :param account: function taking the arguments and return value of each call, which moves the counters
+        :return: wrapped function
+        """
+        if layer not in self.layers:
+            self.layers[layer] = LayerStatistics(layer, self.history_size)
+
+        @functools.wraps(function)
+        def instrumented(*args, **kwargs):
+            counters = self.counters
+            before = dict(counters)
+            start = time.time()
+            try:
+                result = function(*args, **kwargs)
+                if account is not None:
+                    account(args, kwargs, result)
+                return result
+            finally:
+                wall_s = time.time() - start
+                # The statistics may have been reset by the call, leaving nothing to take the difference from
+                if counters is self.counters:
+                    deltas = dict((counter, counters[counter] - before[counter]) for counter in COUNTERS
+                                  if counters[counter] != before[counter])
+                    self.layers.setdefault(layer, LayerStatistics(layer, self.history_size)).record(wall_s, deltas)
+
+        return instrumented
+
+    def instrument_method(self, obj, name, layer, account=None):
+        """
+        Replaces a method of an object with an instrumented one
+        :param obj: object
+        :param name: method name
+        :param layer: layer name to record the calls under
+        :param account: see wrap
+        """
+        setattr(obj, name, self.wrap(getattr(obj, name), layer, account))
+        self._instrumented.append((obj, name))
+
+    def release(self):
+        """
+        Puts back all methods which were instrumented.  The statistics are kept.
+        """
+        for obj, name in self._instrumented:
+            delattr(obj, name)
+        self._instrumented = []
+
+    def instrument_controller(self, controller):
+        """
+        Instruments the DAP, ATI and execution layers of a controller
+        :param controller: PrimitiveController or Gen4Controller
+        """
+        self.instrument_method(controller, 'dap_command_response', 'dap.command_response', self._account_transfer)
+        # Buffer writes are streamed where the transport allows it
+        if hasattr(controller, 'dap_command_write'):
+            self.instrument_method(controller, 'dap_command_write', 'dap.command_write', self._account_write)
+            self.instrument_method(controller, 'dap_command_read', 'dap.command_read', self._account_read)
+        self.instrument_method(controller, 'send_fragment', 'ati.send_fragment')
+        self.instrument_method(controller, 'receive_fragment', 'ati.receive_fragment')
+        self.instrument_method(controller, 'execute', 'controller.execute', self._account_execution)
+
+    def instrument_accumulator(self, proxy):
+        """
+        Instruments the sequence generation of a PrimitiveFunctionAccumulatorExecuter
+        :param proxy: PrimitiveFunctionAccumulatorExecuter
+        """
+        self.instrument_method(proxy, '_generate_sequence', 'accumulator.generate_sequence', self._account_sequence)
+        self.instrument_method(proxy, '_compile_sequence', 'accumulator.compile_sequence', self._account_compilation)
+        # Size of the accumulated sequence, before it is rolled
+        self.instrument_method(proxy.accumulator, 'get_buffer', 'accumulator.get_buffer', self._account_unrolled)
+
+    def instrument_debugger(self, debugger):
+        """
+        Instruments the public methods of a debugger
+        :param debugger: PythonScriptedPicDebugger (or another CmsisAtiPicDebugger)
+        """
+        for name in dir(type(debugger)):
+            if name.startswith('_') or name in NOT_INSTRUMENTED or name in debugger.__dict__:
+                continue
+            method = getattr(type(debugger), name)
+            # Generators return before doing anything, so there is nothing to time
+            if not callable(method) or inspect.isclass(method) or inspect.isgeneratorfunction(method):
+                continue
+            self.instrument_method(debugger, name, "debugger.{}".format(name))
+
+    # Accounting of what a call did, from its arguments and return value
+
+    def _account_transfer(self, args, kwargs, response):
+        packet = args[0]
+        self.count(USB_ROUND_TRIPS)
+        self._account_write(args, kwargs, None)
+        self.count(USB_READS)
+        self.count(USB_BYTES_IN, len(response))
+        if packet[0] != VENDOR_COMMAND_ATI:
+            return
+        if _is_ati_read(packet):
+            # Data comes back when the tool is ready to give it
+            self.count(FRAGMENTS_IN if response[0] == VENDOR_COMMAND_ATI and response[1] == 0x00 else USB_POLLS)
+        elif response[0] != ATI_OK_FRAME[0] or response[1] != ATI_OK_FRAME[1]:
+            # Fragment not accepted, it is sent again
+            self.count(USB_POLLS)
+
+    def _account_write(self, args, kwargs, result):
+        packet = args[0]
+        self.count(USB_WRITES)
+        self.count(USB_BYTES_OUT, len(packet))
+        if packet[0] == VENDOR_COMMAND_ATI and not _is_ati_read(packet):
+            self.count(FRAGMENTS_OUT)
+
+    def _account_read(self, args, kwargs, response):
+        self.count(USB_READS)
+        self.count(USB_BYTES_IN, len(response))
+
+    def _account_execution(self, args, kwargs, result):
+        blocks = args[0]
+        if not isinstance(blocks, (list, tuple)):
+            # GEN4 script
+            blocks = [blocks]
+        self.count(EXECUTIONS)
+        self.count(BLOCKS, len(blocks))
+        self.count(BLOCK_BYTES, sum(len(block) for block in blocks))
+
+    def _account_sequence(self, args, kwargs, sequence):
+        self.count(SEQUENCES)
+
+    def _account_compilation(self, args, kwargs, compiled):
+        self.count(SEQUENCES_COMPILED)
+        self.count(SEQUENCE_BYTES_ROLLED, len(compiled[0]))
+
+    def _account_unrolled(self, args, kwargs, accumulated):
+        self.count(SEQUENCE_BYTES_UNROLLED, len(accumulated[0]))
+
+    def report(self):
+        """
+        :return: list of lines describing the statistics, slowest layers first
+        """
+        lines = []
+        counters = ", ".join("{0} {1:d}".format(counter, self.counters[counter]) for counter in COUNTERS)
+        lines.append("Totals: {0}".format(counters))
+        for layer in sorted(self.layers.values(), key=lambda layer: -layer.wall_s):
+            if not layer.calls:
+                continue
+            counters = ", ".join("{0} {1:d}".format(counter, layer.counters[counter]) for counter in COUNTERS
+                                 if layer.counters[counter])
+            lines.append("{0}: {1:d} calls, {2:.3f}s (mean {3:.6f}s, max {4:.6f}s), latency bins {5}{6}".format(
+                layer.name, layer.calls, layer.wall_s, layer.wall_s / layer.calls, layer.max_s, layer.histogram,
+                ", " + counters if counters else ""))
+        return lines
+
+    def log_statistics(self):
+        """
+        Logs the statistics
+        """
+        self.logger.info("Instrumentation:")
+        for line in self.report():
+            self.logger.info("> %s", line)
@@ -24,6 +24,9 @@ class DeviceDefinition(PicDevice):
 
     # Flash properties for this device
     FLASH_WRITE_BYTES_PER_PAGE = 64
+    FLASH_SIZE_BYTES = 0x2000
+    # 14-bit words read back with the upper bits clear
+    FLASH_ERASED_WORD = 0x3FFF
 
     # ICSP programming command-set for this device. Commands from programming spec.
     LOAD_PC_COMMAND = 0x80
@@ -37,6 +40,14 @@ class DeviceDefinition(PicDevice):
     INTERNALLY_TIMED_PROG_COMMAND = 0xE0
     INCREMENT_ADDRESS_COMMAND = 0xF8
 
+    # How the commands above move the PC, used by the peephole optimizer to drop redundant LOAD_PC commands within a
+    # sequence.  The optimizer is off unless the session option 'peephole_optimizer' turns it on.
+    PC_INCREMENT_COMMANDS = (READ_DATA_NVM_INC_COMMAND, LOAD_DATA_NVM_INC_COMMAND)
+    PC_STATIC_COMMANDS = (READ_DATA_NVM_COMMAND, LOAD_DATA_NVM_COMMAND)
+    # One address per location, whatever its width
+    PC_WORD_STEP = 1
+    PC_BYTE_STEP = 1
+
     # Extra commands for DE access
     MAE_COMMAND = 0xC4
     MAE_IEDE = 0x006355
@@ -142,6 +153,19 @@ class DeviceDefinition(PicDevice):
         self.enter_tmod()
 
 
+    def erase_row(self, byte_address):
+        """
+        Erases one flash row
+        :param byte_address: start address of the row to erase
+        """
+        # Set the address of the row
+        self.prog.command(self.LOAD_PC_COMMAND)
+        # PIC16 devices uses word addressing
+        self.prog.payload(byte_address // 2)
+        # Internally timed erase command
+        self.prog.command(self.ROW_ERASE_COMMAND)
+        self.board.delay_us(self.ROW_ERASE_DELAY_US)
+
     def write_flash_page(self, byte_address, words):
         """
         Write one flash page to the PIC
@@ -216,6 +240,47 @@ class DeviceDefinition(PicDevice):
         # Identical to write config words
         self.write_config_word(byte_address)
 
+    def read_config_memory(self, byte_address, words):
+        """
+        Reads a block of config words from config space.
+        :param byte_address: address of the first word
+        :param words: number of words to read
+        Data is sent indirectly to the data buffer
+        """
+        self.read_flash(byte_address, words)
+
+    def write_config_memory(self, byte_address, words):
+        """
+        Writes a block of words to the config space
+        :param byte_address: byte address of the first word
+        :param words: number of words to write
+        Data is taken indirectly from the data buffer
+        """
+        # Set the address to write to
+        self.prog.command(self.LOAD_PC_COMMAND)
+        # PIC16 devices uses word addressing
+        self.prog.payload(byte_address // 2)
+        # Loop through range, one internally timed write per word
+        for word in range(words):
+            # Write data into NVM
+            self.prog.command(self.LOAD_DATA_NVM_COMMAND)
+            self.prog.write_data_word()
+            # Internally timed write procedure
+            self.prog.command(self.INTERNALLY_TIMED_PROG_COMMAND)
+            self.board.delay_us(self.WRITE_CONFIG_WORD_DELAY_US)
+            # On to the next word
+            self.prog.command(self.INCREMENT_ADDRESS_COMMAND)
+
+    def write_user_id_memory(self, byte_address, words):
+        """
+        Writes a block of words to the user_id space
+        :param byte_address: byte address of the first word
+        :param words: number of words to write
+        Data is taken indirectly from the data buffer
+        """
+        # Identical to write config memory
+        self.write_config_memory(byte_address, words)
+
     def write_debug_vector(self):
         """
         Writes the debug vector (literal)
@@ -0,0 +1,65 @@
+"""
+    bulkcopy
+    Copies data into the arrays MPLAB X hands over in one go, rather than one element at a time
+"""
+
+try:
+    # Running in MPLAB X (Jython): Java arrays are filled with System.arraycopy
+    # pylint: disable=import-error
+    from java.lang import System
+    from org.python.core.util import StringUtil
+except ImportError:
+    # CPython has no Java arrays to deal with
+    System = None
+    StringUtil = None
+
+
+def _is_java_byte_array(destination):
+    """
+    Checks if the destination is a Java byte[], which is what MPLAB X passes to read functions
+    :param destination: array to check
+    """
+    # Jython shows Java arrays as array.array, with a typecode of 'b' for byte[]
+    return System is not None and getattr(destination, 'typecode', None) == 'b'
+
+
+def _strided(source, count, stride):
+    """
+    Picks the elements of the source which are to be copied into a bytearray or memoryview
+    :param source: data
+    :param count: number of elements to pick
+    :param stride: distance between elements picked
+    :return: sequence of the elements, a view of the source where possible
+    """
+    if stride == 1:
+        try:
+            return memoryview(source)[:count]
+        except TypeError:
+            # Lists of byte values
+            return source[:count]
+    # Extended slicing drops the padding bytes in one pass
+    return source[0:count * stride:stride]
+
+
+def bulk_copy(source, destination, offset=0, stride=1):
+    """
+    Copies data into an array, as much as the array has room for
+    :param source: data (bytearray, bytes, memoryview or list of byte values)
+    :param destination: array to fill: a Java byte[] from MPLAB X, or a bytearray, list or writable memoryview
+    :param offset: index in the destination of the first element copied
+    :param stride: distance between the source elements copied, 2 takes every other byte (for padded EEPROM data)
+    :return: number of elements copied
+    """
+    count = min((len(source) + stride - 1) // stride, len(destination) - offset)
+    if count <= 0:
+        return 0
+    if _is_java_byte_array(destination):
+        # Byte strings convert to byte[] without going element by element through Python
+        data = StringUtil.toBytes(str(bytearray(_strided(source, count, stride))))
+        System.arraycopy(data, 0, destination, offset, count)
+    elif isinstance(destination, (bytearray, memoryview)):
+        destination[offset:offset + count] = _strided(source, count, stride)
+    else:
+        # Python 2 memoryviews hand out characters rather than values, so lists are filled from a slice
+        destination[offset:offset + count] = bytearray(source[0:count * stride:stride])
+    return count
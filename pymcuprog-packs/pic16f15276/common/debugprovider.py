@@ -9,9 +9,14 @@ class ConfigGeneratorTool:
     Tool class for generating XML output from scripts for making drag-and-drop programming support
     Does not use hardware.
     """
-    def __init__(self):
+    def __init__(self, extended_tokens=False):
+        """
+        :param extended_tokens: set to True if the firmware the output is for substitutes count, delay and lambda
+        repeat tokens, and more than one token per script (token system one)
+        """
         # Clean contents
         self.contents = {}
+        self.extended_tokens = extended_tokens
 
     def add_new_entry(self, script_id, xml):
         """
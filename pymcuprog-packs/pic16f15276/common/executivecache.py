@@ -0,0 +1,92 @@
+"""
+Record of executives known to be programmed into devices, kept between sessions
+"""
+import hashlib
+import json
+import logging
+import os
+
+# Where the record is kept unless the session options say otherwise
+DEFAULT_EXECUTIVE_CACHE_FILE = os.path.join(os.path.expanduser("~"), ".pymcuprog-packs", "executives.json")
+
+
+def executive_key(tool_serial, device_id, byte_address, data):
+    """
+    Builds the key of one executive image on one device on one tool
+    :param tool_serial: serial number of the tool, None if it is not known
+    :param device_id: device ID read from the target
+    :param byte_address: address the executive is programmed at
+    :param data: executive image
+    :return: key string
+    """
+    try:
+        image = bytearray(data)
+    except (TypeError, ValueError):
+        image = bytearray(value & 0xFF for value in data)
+    digest = hashlib.md5(bytes(image)).hexdigest()
+    return "{0:s}:{1:04X}:{2:X}:{3:s}".format(str(tool_serial or "local"), device_id & 0xFFFF, byte_address, digest)
+
+
+class ExecutiveCache(object):
+    """
+    Keys of the executives which were verified on a device, by device (tool serial and device ID)
+    """
+
+    def __init__(self, filename=DEFAULT_EXECUTIVE_CACHE_FILE):
+        """
+        :param filename: file the record is persisted in
+        """
+        self.logger = logging.getLogger(__name__)
+        self.filename = filename
+        self.entries = {}
+        self.load()
+
+    @staticmethod
+    def _device(key):
+        # Tool serial and device ID: only one executive image at a time is known per device
+        return ":".join(key.split(":")[:2])
+
+    def __contains__(self, key):
+        return self.entries.get(self._device(key)) == key
+
+    def add(self, key):
+        """
+        Records an executive as verified on its device
+        :param key: key from executive_key()
+        """
+        self.entries[self._device(key)] = key
+        self.save()
+
+    def remove(self, key):
+        """
+        Forgets the executive on a device
+        :param key: key from executive_key(), any executive image of the device will do
+        """
+        if self.entries.pop(self._device(key), None) is not None:
+            self.save()
+
+    def load(self):
+        """
+        Reads the record back from its file
+        """
+        if not os.path.isfile(self.filename):
+            return
+        try:
+            with open(self.filename, "r") as cache_file:
+                self.entries = dict(json.load(cache_file))
+        except (IOError, OSError, ValueError, TypeError) as error:
+            self.logger.warning("Unable to load executive cache %s: %s", self.filename, error)
+            self.entries = {}
+
+    def save(self):
+        """
+        Writes the record to its file
+        """
+        try:
+            directory = os.path.dirname(self.filename)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+            with open(self.filename, "w") as cache_file:
+                json.dump(self.entries, cache_file)
+        except (IOError, OSError) as error:
+            self.logger.warning("Unable to save executive cache %s: %s", self.filename, error)
@@ -0,0 +1,178 @@
+"""
+Record of the flash content of a device, kept between sessions for differential programming
+"""
+import binascii
+import json
+import logging
+import os
+
+# Where shadows are kept unless the session options say otherwise
+DEFAULT_SHADOW_DIRECTORY = os.path.join(os.path.expanduser("~"), ".pymcuprog-packs", "shadow")
+
+SHADOW_FORMAT_VERSION = 1
+
+
+class FlashShadow(object):
+    """
+    Flash rows as last programmed into a device, indexed by row start address.
+
+    A row is either known (its content is stored), known to be erased, or not known at all.  The shadow of a device
+    which has been bulk erased is complete: it knows every row it has no entry for to be erased, and rows which have
+    changed behind its back are entered as not known.
+    """
+
+    # Content of a row known to be erased
+    ERASED = bytearray()
+
+    def __init__(self, row_size, filename=None):
+        """
+        :param row_size: size of a flash row in bytes
+        :param filename: file the shadow is persisted in, None to keep it in memory only
+        """
+        self.logger = logging.getLogger(__name__)
+        self.row_size = row_size
+        self.filename = filename
+        self.rows = {}
+        self.complete = False
+
+    @staticmethod
+    def filename_for(directory, tool_serial, device_id):
+        """
+        Builds the file name of the shadow of one device on one tool
+        :param directory: directory shadows are kept in
+        :param tool_serial: serial number of the tool, None if it is not known
+        :param device_id: device ID read from the target
+        :return: path of the shadow file
+        """
+        serial = "".join(c for c in str(tool_serial or "local") if c.isalnum())
+        return os.path.join(directory, "{0:s}_{1:04X}.json".format(serial, device_id & 0xFFFF))
+
+    def row_address(self, byte_address):
+        """
+        :param byte_address: any address in a row
+        :return: start address of the row
+        """
+        return byte_address - byte_address % self.row_size
+
+    def get_row(self, byte_address):
+        """
+        Looks a row up
+        :param byte_address: row start address
+        :return: row content, ERASED if the row is known to be erased, or None if the row is not known
+        """
+        if byte_address in self.rows:
+            return self.rows[byte_address]
+        if self.complete:
+            return self.ERASED
+        return None
+
+    def set_row(self, byte_address, data):
+        """
+        Records the content of a row
+        :param byte_address: row start address
+        :param data: row content, ERASED for an erased row
+        """
+        self.rows[byte_address] = bytearray(data)
+
+    def erase_row(self, byte_address):
+        """
+        Records that a row has been erased
+        :param byte_address: row start address
+        """
+        self.rows[byte_address] = bytearray(self.ERASED)
+
+    def erase_all(self):
+        """
+        Records a bulk erase of flash
+        """
+        self.rows = {}
+        self.complete = True
+
+    def forget(self, byte_address=None, numbytes=0):
+        """
+        Drops rows from the shadow, for flash which has changed behind its back
+        :param byte_address: start of the changed range, None to forget everything
+        :param numbytes: length of the changed range
+        """
+        if byte_address is None:
+            self.rows = {}
+            self.complete = False
+            return
+        address = self.row_address(byte_address)
+        while address < byte_address + max(numbytes, 1):
+            if self.complete:
+                # Without an entry the row would be taken to be erased
+                self.rows[address] = None
+            else:
+                self.rows.pop(address, None)
+            address += self.row_size
+
+    def programmed_rows(self):
+        """
+        :return: sorted start addresses of the rows which hold content, or might
+        """
+        return sorted(address for address, row in self.rows.items() if row is None or row)
+
+    def known_rows(self):
+        """
+        :return: sorted start addresses of the rows known to hold content
+        """
+        return sorted(address for address, row in self.rows.items() if row)
+
+    def load(self):
+        """
+        Reads the shadow back from its file
+        :return: True if a shadow was loaded
+        """
+        if self.filename is None or not os.path.isfile(self.filename):
+            return False
+        try:
+            with open(self.filename, "r") as shadow_file:
+                content = json.load(shadow_file)
+            if content.get("version") != SHADOW_FORMAT_VERSION or content.get("row_size") != self.row_size:
+                self.logger.info("Ignoring shadow in an old format: %s", self.filename)
+                return False
+            self.complete = bool(content.get("complete", False))
+            self.rows = dict((int(address), None if row is None else bytearray(binascii.unhexlify(row)))
+                             for address, row in content.get("rows", {}).items())
+        except (IOError, OSError, ValueError, TypeError) as error:
+            self.logger.warning("Unable to load flash shadow %s: %s", self.filename, error)
+            self.forget()
+            return False
+        self.logger.info("Loaded flash shadow with %d rows from %s", len(self.rows), self.filename)
+        return True
+
+    def save(self):
+        """
+        Writes the shadow to its file
+        """
+        if self.filename is None:
+            return
+        content = {"version": SHADOW_FORMAT_VERSION,
+                   "row_size": self.row_size,
+                   "complete": self.complete,
+                   "rows": dict((str(address), None if row is None else binascii.hexlify(bytes(row)).decode("ascii"))
+                                for address, row in self.rows.items())}
+        try:
+            directory = os.path.dirname(self.filename)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+            # Write a new file and swap it in, so that an interrupted save does not leave half a shadow behind
+            with open(self.filename + ".tmp", "w") as shadow_file:
+                json.dump(content, shadow_file)
+            if os.path.exists(self.filename):
+                os.remove(self.filename)
+            os.rename(self.filename + ".tmp", self.filename)
+        except (IOError, OSError) as error:
+            self.logger.warning("Unable to save flash shadow %s: %s", self.filename, error)
+
+    def discard(self):
+        """
+        Forgets everything, also on file
+        """
+        self.forget()
+        if self.filename is not None and os.path.exists(self.filename):
+            try:
+                os.remove(self.filename)
+            except (IOError, OSError) as error:
+                self.logger.warning("Unable to remove flash shadow %s: %s", self.filename, error)
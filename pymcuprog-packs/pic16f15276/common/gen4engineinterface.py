@@ -19,18 +19,6 @@ from primitiveaccumulator import PrimitiveFunctionAccumulatorExecuter
 
 from debugprovider import PrinterTool
 
-def is_blank(data):
-    """
-    Checks if a block of flash memory in an array is 'blank'
-    """
-    for d in range(0, len(data), 1):
-        if not data[d] == 0xFF:
-            return False
-            # TODO: flash width should depend on the target
-
-    return True
-
-
 class Gen4WrapperDebugger(CmsisAtiPicDebugger):
     """
     Wrapper for a python-based debugger
@@ -87,10 +75,12 @@ class Gen4WrapperDebugger(CmsisAtiPicDebugger):
                 # Controller object for interfacing with the debugger tool in programming mode
                 self.logger.debug("Creating programming primitive controller")
                 self.prog_controller = Gen4Controller(self.transport)
+                self.prog_controller.data_buffer_size = self.options['ati_data_buffer_size']
 
                 # Controller object for interfacing with the debugger tool in debug mode
                 self.logger.debug("Creating debug primitive controller")
                 self.debug_controller = PrimitiveController(self.transport)
+                self.debug_controller.data_buffer_size = self.options['ati_data_buffer_size']
 
                 self.logger.debug("Creating GEN4 wrapper")
                 self.device_proxy = Gen4ScriptWrapper(self.device_object, self.prog_controller)
@@ -109,6 +99,8 @@ class Gen4WrapperDebugger(CmsisAtiPicDebugger):
                 # For the programming executive we use primitives like for the debug executive so we can just reuse the debug_controller
                 self.prog_executive_proxy = PrimitiveFunctionAccumulatorExecuter(self.prog_executive_object, self.debug_controller)
 
+        self._instrument_session()
+
     def set_program_exec(self, address, data, pe_version=None):
         """
         Store the programming exec for later use
@@ -156,6 +148,7 @@ class Gen4WrapperDebugger(CmsisAtiPicDebugger):
         if device_id & 0xFFFF == 0x0000 or device_id & 0xFFFF == 0x3FFF:
             raise Exception("Unable to read ID")
 
+        self.device_id = device_id & 0xFFFF
         self._in_tmod = True
 
     def enter_tmod_pe(self):
@@ -233,14 +226,26 @@ class Gen4WrapperDebugger(CmsisAtiPicDebugger):
         # Gather chunks
         result = bytearray()
 
-        # ATI chunk is 512
-        # TODO: read out from ATI
-        chunk_size_bytes = 512
+        # ATI buffer size picked for the tool when the session was set up
+        chunk_size_bytes = self.options['ati_data_buffer_size']
 
         if self.use_pe:
             # Enable eICSP (PE mode) only when we need it
             self.enter_tmod_pe()
 
+        if self.options.get('overlapped_reads', False) and self.transport and numbytes > chunk_size_bytes:
+            # Each chunk is fetched while the next one is read from the device
+            ranges = self.read_ranges(byte_address, numbytes, chunk_size_bytes)
+            if self.use_pe:
+                pe = self.prog_executive_object
+                chunks = [(pe.read_flash_response_size(size), {'byte_address': int(address), 'numbytes': size})
+                          for address, size in ranges]
+                return self._read_overlapped(self.prog_executive_proxy, self.prog_executive_model._read_flash_proxy_command,
+                                             chunks, unpack=lambda data, kwargs: pe.check_read_flash_response(
+                                                 data, kwargs['numbytes']))
+            chunks = [(size, {'byte_address': int(address), 'numbytes': size}) for address, size in ranges]
+            return self._read_overlapped(self.device_proxy, self.device_model.read_flash, chunks)
+
         # Loop until done
         while numbytes > 0:
             # Handle leftovers
@@ -329,16 +334,15 @@ class Gen4WrapperDebugger(CmsisAtiPicDebugger):
         """
         self.logger.debug("Flash block write")
 
-        # ATI chunking
-        # TODO: read out from ATI
-        chunksize = 512
+        # ATI buffer size picked for the tool when the session was set up
+        chunksize = self.options['ati_data_buffer_size']
 
         # Make sure the chunk size is a multiple of the page size as we can only write full pages
         pagesize = self.device_object.get_flash_write_row_size_bytes()
         chunksize -= chunksize % pagesize
 
         for chunk in self.chunks(data, chunksize):
-            if not is_blank(chunk):
+            if not self.blank_detector.is_blank(chunk):
                 self.logger.info("Writing %d bytes to byte address 0x%04X", len(chunk), byte_address)
 
                 # MPLAB is supposed to always write complete pages but in the past it has in some situations not done so (MPLABX-4885)
@@ -426,6 +430,8 @@ class Gen4WrapperDebugger(CmsisAtiPicDebugger):
         """
         Erase the device
         """
+        # Program memory is erased whatever the address, the DE included
+        self._forget_debug_exec()
         # Use address if provided
         self.device_proxy.invoke(self.device_model.bulk_erase, byte_address=byte_address)
 
@@ -436,6 +442,7 @@ class Gen4WrapperDebugger(CmsisAtiPicDebugger):
         :param numbytes: number of bytes
         """
         self.logger.info("Erase DE mem %d bytes at byte address 0x%08X", numbytes, byte_address)
+        self._forget_debug_exec()
         data = self.device_proxy.invoke(method=self.device_model.erase_testmem_range, byte_address=int(byte_address),
                                         numbytes=numbytes)
         self.logger.info("Done")
@@ -551,6 +558,7 @@ class Gen4WrapperDebugger(CmsisAtiPicDebugger):
         Start a debug session
         """
         self.logger.info("Entering debug mode")
+        de_cached = False
 
         # Program the DE
         if program_de:
@@ -567,8 +575,12 @@ class Gen4WrapperDebugger(CmsisAtiPicDebugger):
                 self.enter_tmod()
                 self.logger.info("Checking DE")
                 status = True
-                if self._verify_flash_block(self.debug_exec_address, self.debug_exec_data, silent_early_exit=True):
+                de_cached = self._debug_exec_cached()
+                if de_cached:
+                    self.logger.info("DE OK (verified in an earlier session)")
+                elif self._verify_flash_block(self.debug_exec_address, self.debug_exec_data, silent_early_exit=True):
                     self.logger.info("DE OK")
+                    self._remember_debug_exec()
                 else:
                     self.logger.info("Erasing DE")
                     self.erase_de_memory(self.debug_exec_address, len(self.debug_exec_data))
@@ -576,6 +588,8 @@ class Gen4WrapperDebugger(CmsisAtiPicDebugger):
                     self.write_de_memory(self.debug_exec_address, self.debug_exec_data)
                     self.logger.info("Verifying DE")
                     status = self._verify_flash_block(self.debug_exec_address, self.debug_exec_data)
+                    if status:
+                        self._remember_debug_exec()
                 self.exit_tmod()
 
                 # Revert the PE flag since we are done with DE programming
@@ -589,7 +603,15 @@ class Gen4WrapperDebugger(CmsisAtiPicDebugger):
 
         # Try to read the DE version to check that things are ok
         # If unable to communicate with the DE an exception will be raised and will have to be handled further up the stack.
-        de_version = self.debug_read_de_version()
+        try:
+            de_version = self.debug_read_de_version()
+        except Exception:
+            if not de_cached:
+                raise
+            # Only a few rows of the DE were checked, so check all of it before giving up
+            self.logger.warning("DE not responding, verifying all of it")
+            self._forget_debug_exec()
+            return self.init_debug_session(program_de)
 
         # Reset state
         self._is_running = False
@@ -853,8 +875,8 @@ class Gen4WrapperDebugger(CmsisAtiPicDebugger):
         # Gather chunks
         result = bytearray()
 
-        # TODO: read out from ATI
-        chunk_size_bytes = 512
+        # ATI buffer size picked for the tool when the session was set up
+        chunk_size_bytes = self.options['ati_data_buffer_size']
 
         # The chunk size must be possible to split into an integer number of n byte "packs"
         chunk_size_bytes -= chunk_size_bytes % self.debug_executive_object.de_read_flash_pack_size()
@@ -84,6 +84,9 @@ def _IOWR(io_type, nr, size):
 
 IOCTL_ICSP_CMD = _IOWR(ord('i'), 0, "=s64s")
 
+# Most bytes of primitives the driver takes in one IOCTL_ICSP_CMD
+ICSP_COMMAND_SIZE = 64
+
 
 class IcspIo():
     """
@@ -93,12 +96,16 @@ class IcspIo():
         self.logger = logging.getLogger(__name__)
         icsp_driver_file = "/dev/icsp"
         self.logger.debug("Opening file '%s' for data transfer to ICSP driver", icsp_driver_file)
-        self.icsp_dev = open(icsp_driver_file, "r+b")
+        # Unbuffered, so that each transfer is one system call and data is with the driver as soon as it is written
+        self.icsp_dev = open(icsp_driver_file, "r+b", 0)
 
     def execute(self, buffer):
         """
         Executes a sequence of primitives
+        :param buffer: primitives, at most ICSP_COMMAND_SIZE bytes
         """
+        if len(buffer) > ICSP_COMMAND_SIZE:
+            raise Exception("{0:d} bytes of primitives do not fit in an ICSP command".format(len(buffer)))
         self.logger.debug("Sending primitive array to ICSP driver")
         fcntl.ioctl(self.icsp_dev, IOCTL_ICSP_CMD, bytearray(buffer))
 
@@ -108,10 +115,15 @@ class IcspIo():
         """
         # pylint: disable=unused-argument
         self.logger.debug("Sending %d data bytes to ICSP driver", len(values))
-        self.icsp_dev.write(values)
-        # Flush after write to be sure that values are available without closing the file
-        # TODO: evaluate whether its better to disable file bufferring at the open() call instead of flushing here
-        self.icsp_dev.flush()
+        data = bytearray(values)
+        written = 0
+        while written < len(data):
+            # Unbuffered writes may take only part of the data
+            count = self.icsp_dev.write(data[written:])
+            if count is None:
+                # Python 2 files write it all
+                break
+            written += count
 
     def get_data_buffer(self, buffer_id, numbytes):
         """
@@ -119,8 +131,14 @@ class IcspIo():
         """
         # pylint: disable=unused-argument
         self.logger.debug("Receiving %d data bytes from ICSP driver", numbytes)
-        result = self.icsp_dev.read(numbytes)
-        return bytearray(result)
+        result = bytearray()
+        while len(result) < numbytes:
+            # Unbuffered reads may return only part of the data
+            data = self.icsp_dev.read(numbytes - len(result))
+            if not data:
+                break
+            result.extend(data)
+        return result
 
     def __del__(self):
         if not self.icsp_dev is None:
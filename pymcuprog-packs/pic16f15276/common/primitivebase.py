@@ -8,6 +8,90 @@ class PrimitiveFunction(object):
         # Store the model object for later 'execution' of functions
         self.model_object = model_object
 
+    def transaction(self):
+        """
+        Starts a transaction: a list of calls to be invoked together
+        """
+        return PrimitiveTransaction(self)
+
+    def invoke_many(self, calls):
+        """
+        Invokes a list of calls, one by one.  Functions which can execute several calls at once override this.
+        :param calls: list of PrimitiveCall
+        :return: list of results, one per call
+        """
+        results = []
+        for call in calls:
+            results.append(call.run(self))
+        return results
+
+
+class PrimitiveCall(object):
+    """
+    A method invocation queued in a transaction
+    """
+    # pylint: disable=too-few-public-methods
+    def __init__(self, method, kwargs, data_to_write=None, bytes_to_read=0):
+        self.method = method
+        self.kwargs = kwargs
+        self.data_to_write = data_to_write
+        self.bytes_to_read = bytes_to_read
+
+    def run(self, function):
+        """
+        Invokes this call on its own
+        """
+        if self.data_to_write is not None and self.bytes_to_read:
+            return function.invoke_write_read(self.data_to_write, self.bytes_to_read, self.method, **self.kwargs)
+        if self.data_to_write is not None:
+            return function.invoke_write(self.data_to_write, self.method, **self.kwargs)
+        if self.bytes_to_read:
+            return function.invoke_read(self.bytes_to_read, self.method, **self.kwargs)
+        return function.invoke(self.method, **self.kwargs)
+
+
+class PrimitiveTransaction(object):
+    """
+    Queues method invocations, which are then executed in one go by the function they were queued on
+    """
+
+    def __init__(self, function):
+        self.function = function
+        self.calls = []
+
+    def invoke(self, method, **kwargs):
+        """
+        Queues an invocation - no data
+        :return: index of the result of this call
+        """
+        self.calls.append(PrimitiveCall(method, kwargs))
+        return len(self.calls) - 1
+
+    def invoke_read(self, bytes_to_read, method, **kwargs):
+        """
+        Queues an invocation - data is read back
+        :return: index of the result of this call
+        """
+        self.calls.append(PrimitiveCall(method, kwargs, bytes_to_read=bytes_to_read))
+        return len(self.calls) - 1
+
+    def invoke_write(self, data_to_write, method, **kwargs):
+        """
+        Queues an invocation - data is written
+        :return: index of the result of this call
+        """
+        self.calls.append(PrimitiveCall(method, kwargs, data_to_write=data_to_write))
+        return len(self.calls) - 1
+
+    def execute(self):
+        """
+        Executes all queued calls, and empties the queue
+        :return: list of results, one per call: data read, or execution status
+        """
+        calls = self.calls
+        self.calls = []
+        return self.function.invoke_many(calls)
+
 
 class PrimitiveResourceProvider(object):
     def programming_interface(self, variant):
@@ -0,0 +1,535 @@
+"""
+PrimitiveOptimizer
+Peephole optimisation of primitive sequences, applied before loop rolling
+
+Rules:
+- merge_delays: consecutive DELAY_US (or DELAY_MS) primitives become one
+- drop_repeated_pins: SET_ICSP_PINS to the value the pins already have is dropped
+- drop_redundant_load_pc: LOAD_PC to the address the PC is already at is dropped (only for devices which describe
+  how their ICSP commands move the PC, see address_counter_model)
+
+The PC is only tracked within one sequence, and is taken to be unknown where each sequence starts.  Sequences are
+compiled and cached on their own, and run in executions of their own with sequences of other models (like the debug
+executive) possibly in between, so nothing is known of the PC they leave.  Reading memory in chunks therefore still
+loads the PC once per chunk: only sequences of methods which access the same locations more than once gain.
+
+The optimizer is off unless the session option 'peephole_optimizer' turns it on.
+"""
+import logging
+
+from pyedbglib.primitive import primitives
+
+from primitiveutils import ParametricToken
+from primitiveutils import PrimitiveException
+
+# Number of bytes following the ID of each primitive
+PRIMITIVE_PAYLOAD_LENGTHS = {
+    primitives.DELAY_MS: 2,
+    primitives.DELAY_US: 2,
+    primitives.DE_COMMAND: 5,
+    primitives.GET_ICSP_PINS: 0,
+    primitives.SET_ICSP_PINS: 1,
+    primitives.SET_CLK_HI: 0,
+    primitives.SET_CLK_LO: 0,
+    primitives.SET_VPP_ON: 0,
+    primitives.SET_VPP_OFF: 0,
+    primitives.SET_SPEED: 4,
+    primitives.WRITE_BITS_LITERAL: 5,
+    primitives.WRITE_BITS_LITERAL_MSB: 5,
+    primitives.WRITE_LITERAL_32_LSB: 4,
+    primitives.P16ENV3_WRITE_PAYLOAD_LITERAL: 5,
+    primitives.P16ENV3_WRITE_BUFFER: 0,
+    primitives.P16ENV3_WRITE_BUFFER_DFM: 0,
+    primitives.P16ENV3_READ_PAYLOAD_PFM: 0,
+    primitives.P16ENV3_READ_PAYLOAD_DFM: 0,
+    primitives.P16F_WRITE_LOC_BUFFER: 0,
+    primitives.P16F_READ_LOC_BUFFER: 0,
+    primitives.P24_SEND_PE_WORD: 2,
+    primitives.P24_SEND_PE_WORD_BUF: 0,
+    primitives.P24_RECEIVE_PE_WORD: 0,
+    primitives.P24_PE_HANDSHAKE: 0,
+}
+
+# Primitives which do nothing but wait
+DELAY_PRIMITIVES = (primitives.DELAY_US, primitives.DELAY_MS)
+
+# Data cycles following an ICSP command, by width of the location accessed
+WORD_DATA_PRIMITIVES = (primitives.P16ENV3_WRITE_BUFFER, primitives.P16ENV3_READ_PAYLOAD_PFM,
+                        primitives.P16ENV3_WRITE_PAYLOAD_LITERAL)
+BYTE_DATA_PRIMITIVES = (primitives.P16ENV3_WRITE_BUFFER_DFM, primitives.P16ENV3_READ_PAYLOAD_DFM)
+
+# Width in bits of an 8-bit ICSP command cycle
+COMMAND_BITS = 8
+
+
+class AddressCounterModel(object):
+    """
+    Describes how the ICSP commands of a device (8-bit command, 24-bit data) move its program counter (PC)
+    """
+    # pylint: disable=too-few-public-methods
+    def __init__(self, load_pc_command, increment_commands, static_commands, word_step, byte_step):
+        """
+        :param load_pc_command: command which loads the PC from its payload
+        :param increment_commands: commands which access the location at the PC, then step it on
+        :param static_commands: commands which access the location at the PC and leave the PC where it is
+        :param word_step: PC step after a word access
+        :param byte_step: PC step after a byte access
+        """
+        self.load_pc_command = load_pc_command
+        self.increment_commands = increment_commands
+        self.static_commands = static_commands
+        self.word_step = word_step
+        self.byte_step = byte_step
+
+
+def address_counter_model(model_object):
+    """
+    Builds the address counter model declared by a DeviceDefinition, if any
+    :param model_object: device model instance
+    :return: AddressCounterModel, or None if the device does not describe its PC behaviour
+    """
+    try:
+        return AddressCounterModel(model_object.LOAD_PC_COMMAND, model_object.PC_INCREMENT_COMMANDS,
+                                   model_object.PC_STATIC_COMMANDS, model_object.PC_WORD_STEP,
+                                   model_object.PC_BYTE_STEP)
+    except AttributeError:
+        return None
+
+
+class _ListElements(object):
+    """
+    Element access to a primitive sequence as a list of lists (see PrimitiveAccumulatorProxy)
+    """
+
+    def __init__(self, content):
+        self.content = content
+
+    def __len__(self):
+        return len(self.content)
+
+    def ident(self, index):
+        """
+        Primitive ID of an element
+        """
+        return self.content[index][0]
+
+    def payload(self, index):
+        """
+        Payload of an element, or None if it holds tokens
+        """
+        element = self.content[index]
+        for item in element:
+            if isinstance(item, ParametricToken):
+                return None
+        return element[1:]
+
+
+class _BufferElements(object):
+    """
+    Element access to a primitive sequence in a flat buffer (see PrimitiveBufferAccumulatorProxy)
+    """
+
+    def __init__(self, buffer, offsets, tokens):
+        self.buffer = buffer
+        self.offsets = offsets
+        self.ends = offsets[1:] + [len(buffer)]
+        self.tokenised = set([index for index, _, _ in tokens])
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def ident(self, index):
+        """
+        Primitive ID of an element
+        """
+        return self.buffer[self.offsets[index]]
+
+    def payload(self, index):
+        """
+        Payload of an element, or None if it holds tokens
+        """
+        if index in self.tokenised:
+            return None
+        return self.buffer[self.offsets[index] + 1:self.ends[index]]
+
+
+def _le_value(payload, start, numbytes):
+    """
+    Little endian value from a payload
+    """
+    value = 0
+    for index in range(numbytes):
+        value |= payload[start + index] << (8 * index)
+    return value
+
+
+class PrimitivePeepholeOptimizer(object):
+    """
+    Removes redundant primitives from a sequence, keeping rule statistics
+    """
+
+    RULES = ('merge_delays', 'drop_repeated_pins', 'drop_redundant_load_pc')
+
+    # Largest delay a single delay primitive can hold (16-bit)
+    MAX_DELAY = 0xFFFF
+
+    def __init__(self, address_model=None, rules=None, verify=False):
+        """
+        :param address_model: AddressCounterModel of the device, required by drop_redundant_load_pc
+        :param rules: names of the rules to apply, all by default
+        :param verify: set to True to check every optimised sequence against the original one on a simulated target
+        """
+        self.logger = logging.getLogger(__name__)
+        self.address_model = address_model
+        if rules is None:
+            rules = self.RULES
+        self.rules = rules
+        self.verify = verify
+        self.statistics = None
+        self.reset_statistics()
+
+    def reset_statistics(self):
+        """
+        Clears the rule statistics
+        """
+        self.statistics = {
+            'sequences': 0,
+            'elements_removed': 0,
+            'bytes_removed': 0,
+            'verified': 0,
+        }
+        for rule in self.RULES:
+            self.statistics[rule] = 0
+
+    def get_statistics(self):
+        """
+        Retrieve the rule statistics
+        :return: dictionary of counters: number of times each rule was applied, and totals
+        """
+        return dict(self.statistics)
+
+    def log_statistics(self):
+        """
+        Logs the rule statistics
+        """
+        self.logger.info("Peephole optimizer: %d elements (%d bytes) removed from %d sequences",
+                         self.statistics['elements_removed'], self.statistics['bytes_removed'],
+                         self.statistics['sequences'])
+        for rule in self.RULES:
+            self.logger.info("> %s: %d", rule, self.statistics[rule])
+
+    def _plan(self, elements):
+        """
+        Finds the edits to make to a sequence
+        :param elements: element access object
+        :return: dictionary of element index to None (drop) or replacement element (bytearray)
+        """
+        edits = {}
+        model = self.address_model
+        if 'drop_redundant_load_pc' not in self.rules:
+            model = None
+        # Last kept delay element (index, ID, accumulated value)
+        delay = None
+        # Pin value last set, if nothing has changed the pins since
+        pins = None
+        # PC value, if known
+        program_counter = None
+
+        index = 0
+        count = len(elements)
+        while index < count:
+            ident = elements.ident(index)
+            payload = elements.payload(index)
+
+            if ident in DELAY_PRIMITIVES:
+                if payload is not None and 'merge_delays' in self.rules:
+                    value = _le_value(payload, 0, 2)
+                    if delay is not None and delay[1] == ident and delay[2] + value <= self.MAX_DELAY:
+                        total = delay[2] + value
+                        edits[delay[0]] = bytearray([ident, total & 0xFF, (total >> 8) & 0xFF])
+                        edits[index] = None
+                        delay = (delay[0], ident, total)
+                        self.statistics['merge_delays'] += 1
+                    else:
+                        delay = (index, ident, value)
+                else:
+                    delay = None
+                # Waiting changes neither pins nor PC
+                index += 1
+                continue
+            delay = None
+
+            if ident == primitives.SET_ICSP_PINS:
+                value = None
+                if payload is not None:
+                    value = payload[0]
+                if value is not None and value == pins and 'drop_repeated_pins' in self.rules:
+                    edits[index] = None
+                    self.statistics['drop_repeated_pins'] += 1
+                pins = value
+                # Moving pins may clock the target, so the PC is no longer known
+                program_counter = None
+                index += 1
+                continue
+            pins = None
+
+            if model is not None and ident == primitives.WRITE_BITS_LITERAL_MSB and payload is not None \
+                    and payload[0] == COMMAND_BITS and index + 1 < count:
+                command = _le_value(payload, 1, 4)
+                data_ident = elements.ident(index + 1)
+                data = elements.payload(index + 1)
+                if command == model.load_pc_command and data_ident == primitives.P16ENV3_WRITE_PAYLOAD_LITERAL:
+                    address = None
+                    if data is not None:
+                        address = _le_value(data, 1, 4)
+                    if address is not None and address == program_counter:
+                        edits[index] = None
+                        edits[index + 1] = None
+                        self.statistics['drop_redundant_load_pc'] += 1
+                    program_counter = address
+                    index += 2
+                    continue
+                if command in model.static_commands and \
+                        (data_ident in WORD_DATA_PRIMITIVES or data_ident in BYTE_DATA_PRIMITIVES):
+                    index += 2
+                    continue
+                if command in model.increment_commands and program_counter is not None:
+                    if data_ident in WORD_DATA_PRIMITIVES:
+                        program_counter += model.word_step
+                        index += 2
+                        continue
+                    if data_ident in BYTE_DATA_PRIMITIVES:
+                        program_counter += model.byte_step
+                        index += 2
+                        continue
+            # Anything else may move the PC
+            program_counter = None
+            index += 1
+        return edits
+
+    def _count(self, elements, edits):
+        """
+        Updates statistics for a set of edits
+        """
+        self.statistics['sequences'] += 1
+        for index, replacement in edits.items():
+            if replacement is None:
+                self.statistics['elements_removed'] += 1
+                self.statistics['bytes_removed'] += 1 + PRIMITIVE_PAYLOAD_LENGTHS.get(elements.ident(index), 0)
+
+    def optimize(self, content):
+        """
+        Optimises a primitive sequence in list of lists form
+        :param content: list of elements
+        :return: optimised list of elements
+        """
+        elements = _ListElements(content)
+        edits = self._plan(elements)
+        self._count(elements, edits)
+        if not edits:
+            return content
+        result = []
+        for index, element in enumerate(content):
+            if index in edits:
+                replacement = edits[index]
+                if replacement is not None:
+                    result.append(list(replacement))
+            else:
+                result.append(element)
+        return result
+
+    def optimize_buffer(self, buffer, offsets, tokens):
+        """
+        Optimises a primitive sequence in flat buffer form
+        :param buffer: accumulated primitives (bytearray)
+        :param offsets: offset of each element in the buffer
+        :param tokens: (element index, buffer offset, token) for each token
+        :return: optimised buffer, offsets and tokens
+        """
+        elements = _BufferElements(buffer, offsets, tokens)
+        edits = self._plan(elements)
+        self._count(elements, edits)
+        if not edits:
+            return buffer, offsets, tokens
+        new_buffer = bytearray()
+        new_offsets = []
+        # Tokenised elements are never edited, so their tokens only move
+        moves = {}
+        for index, (start, end) in enumerate(zip(offsets, elements.ends)):
+            if index in edits:
+                replacement = edits[index]
+                if replacement is not None:
+                    new_offsets.append(len(new_buffer))
+                    new_buffer.extend(replacement)
+                continue
+            moves[index] = (len(new_offsets), len(new_buffer) - start)
+            new_offsets.append(len(new_buffer))
+            new_buffer.extend(buffer[start:end])
+        new_tokens = []
+        for index, offset, token in tokens:
+            new_index, shift = moves[index]
+            new_tokens.append((new_index, offset + shift, token))
+        return new_buffer, new_offsets, new_tokens
+
+    def check(self, reference, optimised):
+        """
+        Checks that an optimised sequence does the same as the original on a simulated target
+        :param reference: flattened sequence compiled without optimisation
+        :param optimised: flattened sequence compiled with optimisation
+        """
+        expected = PrimitiveTraceSimulator(self.address_model).run(reference)
+        actual = PrimitiveTraceSimulator(self.address_model).run(optimised)
+        if expected != actual:
+            for position, (wanted, found) in enumerate(zip(expected, actual)):
+                if wanted != found:
+                    self.logger.error("Optimised sequence differs at event %d: %s instead of %s", position, found,
+                                      wanted)
+                    break
+            raise PrimitiveException("Peephole optimizer verification failed")
+        self.statistics['verified'] += 1
+
+
+class PrimitiveTraceSimulator(object):
+    """
+    Runs a flattened primitive sequence on a simulated target, recording what the target would see:
+    pin changes, VPP changes, total waiting time between other primitives, and ICSP commands with the PC they act on
+    """
+
+    def __init__(self, address_model=None):
+        self.address_model = address_model
+        self.trace = None
+        self.pins = None
+        self.delay_us = 0
+        self.program_counter = None
+        self.pending_command = None
+
+    def run(self, sequence):
+        """
+        Runs a sequence
+        :param sequence: flattened sequence (outer lambda included)
+        :return: list of events
+        """
+        self.trace = []
+        self.pins = None
+        self.delay_us = 0
+        self.program_counter = None
+        self.pending_command = None
+        end = self._run_block(sequence, 0, len(sequence))
+        if end != len(sequence):
+            raise PrimitiveException("Trailing bytes in sequence")
+        if self.pending_command is not None:
+            self._event(('command', self.pending_command, self.program_counter))
+        self._flush_delay()
+        return self.trace
+
+    def _run_block(self, sequence, position, end):
+        """
+        Runs primitives from position up to end
+        :return: position after the last primitive run
+        """
+        while position < end:
+            position = self._run_primitive(sequence, position)
+        return position
+
+    def _skip(self, sequence, position, count):
+        """
+        Finds the position after count primitives, without running them
+        """
+        for _ in range(count):
+            ident = sequence[position]
+            if ident == primitives.LAMBDA:
+                position = self._skip(sequence, position + 3, sequence[position + 2])
+            else:
+                position += 1 + self._payload_length(ident)
+        return position
+
+    @staticmethod
+    def _payload_length(ident):
+        try:
+            return PRIMITIVE_PAYLOAD_LENGTHS[ident]
+        except KeyError:
+            raise PrimitiveException("Unknown primitive 0x{0:02X}".format(ident))
+
+    def _flush_delay(self):
+        if self.delay_us:
+            self.trace.append(('delay_us', self.delay_us))
+            self.delay_us = 0
+
+    def _event(self, event):
+        self._flush_delay()
+        self.trace.append(event)
+
+    def _run_primitive(self, sequence, position):
+        """
+        Runs one primitive (or loop)
+        :return: position of the next primitive
+        """
+        ident = sequence[position]
+        if ident == primitives.LAMBDA:
+            repeats = sequence[position + 1]
+            length = sequence[position + 2]
+            start = position + 3
+            end = self._skip(sequence, start, length)
+            # Repeat count is off by one: the body runs repeats + 1 times
+            for _ in range(repeats + 1):
+                self._run_block(sequence, start, end)
+            return end
+
+        length = self._payload_length(ident)
+        payload = sequence[position + 1:position + 1 + length]
+        if ident == primitives.DELAY_US:
+            self.delay_us += _le_value(payload, 0, 2)
+        elif ident == primitives.DELAY_MS:
+            self.delay_us += 1000 * _le_value(payload, 0, 2)
+        elif ident == primitives.SET_ICSP_PINS:
+            if payload[0] != self.pins:
+                self.pins = payload[0]
+                self._event(('pins', self.pins))
+            self.program_counter = None
+        elif self.address_model is not None and ident == primitives.WRITE_BITS_LITERAL_MSB \
+                and payload[0] == COMMAND_BITS:
+            if self.pending_command is not None:
+                # Command without data cycle
+                self._event(('command', self.pending_command, self.program_counter))
+                self.program_counter = None
+            self.pending_command = _le_value(payload, 1, 4)
+        elif self.pending_command is not None:
+            self._data_cycle(ident, payload)
+        else:
+            self._other(ident, payload)
+        return position + 1 + length
+
+    def _data_cycle(self, ident, payload):
+        """
+        A data cycle following an ICSP command
+        """
+        model = self.address_model
+        command = self.pending_command
+        self.pending_command = None
+        if command == model.load_pc_command and ident == primitives.P16ENV3_WRITE_PAYLOAD_LITERAL:
+            self.program_counter = _le_value(payload, 1, 4)
+            return
+        if ident in WORD_DATA_PRIMITIVES:
+            step = model.word_step
+        elif ident in BYTE_DATA_PRIMITIVES:
+            step = model.byte_step
+        else:
+            self._event(('command', command, self.program_counter))
+            self._other(ident, payload)
+            return
+        self._event(('command', command, self.program_counter, ident, tuple(payload)))
+        if command in model.increment_commands:
+            if self.program_counter is not None:
+                self.program_counter += step
+        elif command not in model.static_commands:
+            self.program_counter = None
+
+    def _other(self, ident, payload):
+        """
+        Any other primitive
+        """
+        if self.pending_command is not None:
+            self._event(('command', self.pending_command, self.program_counter))
+            self.pending_command = None
+        self._event((ident, tuple(payload)))
+        self.program_counter = None
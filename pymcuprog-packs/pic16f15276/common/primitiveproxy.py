@@ -6,7 +6,9 @@ import logging
 
 from primitiveutils import enclose_as_lambda
 from primitiveutils import flatten_tree
+from primitiveutils import ParametricToken
 from pyedbglib.primitive.primitivecontroller import PrimitiveControllerCommand
+from pyedbglib.protocols.ati import ATI_RESPONSE_BUFFER_SIZE
 
 
 class PrimitiveProxy(object):
@@ -28,7 +30,10 @@ class PrimitiveEmbeddedProxy(PrimitiveProxy):
         self.logger = logging.getLogger(__name__)
         self.logger.info("Creating ICSP IO driver connection")
         from icspio import IcspIo
+        from icspio import ICSP_COMMAND_SIZE
         self.icsp = IcspIo()
+        # Most bytes of primitives executed in one go
+        self.command_size = ICSP_COMMAND_SIZE
 
     def execute(self, primitives):
         """
@@ -116,16 +121,29 @@ class PrimitiveAccumulatorProxy(PrimitiveProxy):
         """
         self._content.append([element])
 
+    def _append_token(self, token, bytecount):
+        """
+        Append a token in place of a value of the given size
+        """
+        token.bytecount = bytecount
+        self.add_token(token)
+
     def append_byte(self, value):
         """
         Append a byte to a primitive construct
         """
+        if isinstance(value, ParametricToken):
+            self._append_token(value, 1)
+            return
         self._content[-1].extend([value & 0xFF])
 
     def append_le16(self, value):
         """
         Append a 16-bit little endian value to a primitive construct
         """
+        if isinstance(value, ParametricToken):
+            self._append_token(value, 2)
+            return
         self._content[-1].extend([value & 0xFF])
         self._content[-1].extend([(value >> 8) & 0xFF])
 
@@ -133,6 +151,9 @@ class PrimitiveAccumulatorProxy(PrimitiveProxy):
         """
         Append a 32-bit little endian value to a primitive construct
         """
+        if isinstance(value, ParametricToken):
+            self._append_token(value, 4)
+            return
         self._content[-1].extend([value & 0xFF])
         self._content[-1].extend([(value >> 8) & 0xFF])
         self._content[-1].extend([(value >> 16) & 0xFF])
@@ -168,6 +189,112 @@ class PrimitiveAccumulatorProxy(PrimitiveProxy):
         return self._content
 
 
+class PrimitiveBufferAccumulatorProxy(PrimitiveAccumulatorProxy):
+    """
+    Proxy object for accumulating primitive sequences into a single flat buffer
+    Elements are located by an index of their offsets instead of being kept as a list each
+    """
+
+    def __init__(self):
+        self._buffer = None
+        self._offsets = None
+        self._value_tokens = None
+        PrimitiveAccumulatorProxy.__init__(self)
+
+    def reset(self):
+        """
+        Resets buffer, element offsets and tokens
+        """
+        self._buffer = bytearray()
+        self._offsets = []
+        # Parametric tokens as (element index, buffer offset, token).  No space is reserved for them in the buffer.
+        self._value_tokens = []
+        self._tokens = []
+
+    def new_element(self, element):
+        """
+        Add a new element (ie: primitive construct)
+        :param element: ID (first byte) of primitive
+        """
+        self._offsets.append(len(self._buffer))
+        self._buffer.append(element)
+
+    def append_byte(self, value):
+        """
+        Append a byte to a primitive construct
+        """
+        if isinstance(value, ParametricToken):
+            self._append_token(value, 1)
+            return
+        self._buffer.append(value & 0xFF)
+
+    def append_le16(self, value):
+        """
+        Append a 16-bit little endian value to a primitive construct
+        """
+        if isinstance(value, ParametricToken):
+            self._append_token(value, 2)
+            return
+        self._buffer.append(value & 0xFF)
+        self._buffer.append((value >> 8) & 0xFF)
+
+    def append_le32(self, value):
+        """
+        Append a 32-bit little endian value to a primitive construct
+        """
+        if isinstance(value, ParametricToken):
+            self._append_token(value, 4)
+            return
+        self._buffer.append(value & 0xFF)
+        self._buffer.append((value >> 8) & 0xFF)
+        self._buffer.append((value >> 16) & 0xFF)
+        self._buffer.append((value >> 24) & 0xFF)
+
+    def add_token(self, token):
+        """
+        Insert a token in a primitive construct
+        """
+        self.logger.debug("Adding token")
+        self._value_tokens.append((len(self._offsets) - 1, len(self._buffer), token))
+
+    def mark(self, data):
+        """
+        Mark a location and add a token
+        """
+        token = {
+            'offset': len(self._offsets),
+            'bytes': data
+        }
+        self._tokens.append(token)
+
+    def get_buffer(self):
+        """
+        Retrieve the accumulated primitives in flat form
+        :return: buffer (bytearray), element offsets and (element index, buffer offset, token) for each token
+        """
+        return self._buffer, self._offsets, self._value_tokens
+
+    def get_content(self):
+        """
+        Retrieve all primitive constructs, as a list of lists like PrimitiveAccumulatorProxy does
+        """
+        content = []
+        ends = self._offsets[1:] + [len(self._buffer)]
+        token_index = 0
+        for index, (start, end) in enumerate(zip(self._offsets, ends)):
+            element = []
+            position = start
+            while token_index < len(self._value_tokens) and self._value_tokens[token_index][0] == index:
+                _, offset, token = self._value_tokens[token_index]
+                element.extend(self._buffer[position:offset])
+                element.append(token)
+                position = offset
+                token_index += 1
+            element.extend(self._buffer[position:end])
+            content.append(element)
+        return content
+
+
 class PrimitiveExecuterProxy(PrimitiveAccumulatorProxy):
     """
     Proxy object for executing primitive sequences
@@ -175,7 +302,7 @@ class PrimitiveExecuterProxy(PrimitiveAccumulatorProxy):
 
     def __init__(self, controller):
         PrimitiveAccumulatorProxy.__init__(self)
-        self.transportproxy = TransportProxy(controller, 64)  # todo - correct size
+        self.transportproxy = TransportProxy(controller)
         self._result_accumulator = None
         self.clear_accumulated_results()
 
@@ -231,10 +358,24 @@ class TransportProxy(object):
     Sync points also force execution, for example when a result is required before execution can continue
     """
 
-    def __init__(self, transport, blocksize):
+    # ATI header, envelope version and block count
+    EXECUTE_COMMAND_OVERHEAD = 4 + 2 + 1
+    # Each block of an execution is prefixed by an 8-bit length
+    BLOCK_LENGTH_SIZE = 1
+
+    def __init__(self, transport, blocksize=None):
+        """
+        :param transport: controller to execute on
+        :param blocksize: maximum size of one execution, defaults to the command buffer size of the controller
+        """
         self.logger = logging.getLogger(__name__)
         self.transport = transport
+        if blocksize is None:
+            # The command buffer is taken to be as large as a data buffer
+            blocksize = transport.data_buffer_size
         self.blocksize = blocksize
+        # Each block returns a 32-bit status
+        self.max_blocks = (ATI_RESPONSE_BUFFER_SIZE - 1) // 4
         self.content = None
         self.length = None
         self.reset()
@@ -244,7 +385,7 @@ class TransportProxy(object):
         Reset and clear content
         """
         self.content = []
-        self.length = 0
+        self.length = self.EXECUTE_COMMAND_OVERHEAD
 
     def send_block(self, content):
         """
@@ -254,13 +395,17 @@ class TransportProxy(object):
         """
         self.logger.debug("Sending block:")
         self.logger.debug(content)
-        if self.length + len(content) > self.blocksize:
+        lamb = enclose_as_lambda([content])
+        section = flatten_tree(lamb)[0]
+        block = PrimitiveControllerCommand(section).generate_bytestream()
+        if self.content and (self.length + self.BLOCK_LENGTH_SIZE + len(block) > self.blocksize or
+                             len(self.content) == self.max_blocks):
             # No space, flush to hardware first
             self.logger.debug("Full flush!")
             self._flush()
 
-        self.content.append(content)
-        self.length += len(content)
+        self.content.append(block)
+        self.length += self.BLOCK_LENGTH_SIZE + len(block)
 
     def sync(self):
         """
@@ -274,16 +419,8 @@ class TransportProxy(object):
         """
         Executes the primitive sequence remotely
         """
-        commands = []
-        for i in range(len(self.content)):
-
-            lamb = enclose_as_lambda([self.content[i]])
-            section = flatten_tree(lamb)[0]
-            ati_command = PrimitiveControllerCommand(section)
-            commands.append(ati_command.generate_bytestream())
-
         self.logger.debug("Execute")
-        results = self.transport.execute(commands)
+        results = self.transport.execute(self.content)
         self.reset()
         # Ditch all but the last result.  Sync points are used for retrieving useful results
         result = results[-1]
@@ -38,12 +38,28 @@ class ParametricToken(object):
 
     # Token types
     TOKEN_ADDRESS_LE32 = 1
+    TOKEN_COUNT_LE16 = 2
+    TOKEN_DELAY_LE16 = 3
+    TOKEN_LAMBDA_REPEAT = 4
 
     # pylint: disable=too-few-public-methods
     def __init__(self):
         self.logger = logging.getLogger(__name__)
         self.logger.debug("Creating token")
         self.offset = None
+        # Name of the argument this token stands for, if any
+        self.parameter = None
+
+    def substitute(self, value):
+        """
+        Converts an argument value to the value to put in place of the token
+        """
+        raise NotImplementedError("Token can not be substituted")
+
+
+# Token types which can be encoded
+TOKEN_TYPES = (ParametricToken.TOKEN_ADDRESS_LE32, ParametricToken.TOKEN_COUNT_LE16, ParametricToken.TOKEN_DELAY_LE16,
+               ParametricToken.TOKEN_LAMBDA_REPEAT)
 
 
 class ParametricValueToken(ParametricToken):
@@ -62,6 +78,14 @@ class ParametricValueToken(ParametricToken):
         # Transform is [determined on use]
         self.transform = 0
 
+    def substitute(self, value):
+        """
+        Converts an argument value to the value to put in place of the token
+        :param value: argument value
+        :return: value shifted right by the transform
+        """
+        return value >> self.transform
+
     def __floordiv__(self, other):
         """
         Divide this parameter by two on the way in
@@ -91,23 +115,75 @@ class ParametricValueToken(ParametricToken):
         """
         return 0
 
+    def __eq__(self, other):
+        """
+        Tokens are only equal to themselves.
+        Comparing a token to a value means that the sequence depends on the value of the parameter, so it can not be
+        parameterised.
+        """
+        if isinstance(other, ParametricToken):
+            return self is other
+        raise PrimitiveException("Parametric token compared to a value")
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        return id(self)
 
-# We choose (for now) to NOT parameterise lambdas until we really need to
-# class ParametricScalarToken (ParametricToken):
-#     """
-#     This token represents a SCALAR parameter (loop/lambda)
-#     """
-#     def __init__ (self, repeatcount, sequencelength):
-#         ParametricToken.__init__(self)
-#         self.logger = logging.getLogger(__name__)
-#         self.logger.debug("Creating lambda token")
-#         self.repeatcount = repeatcount
-#         self.sequencelength = sequencelength
+    def __lt__(self, other):
+        raise PrimitiveException("Parametric token compared to a value")
 
+    __le__ = __lt__
+    __gt__ = __lt__
+    __ge__ = __lt__
 
-def process_primitive_sequence(cmd):
+
+class ParametricScalarToken(ParametricToken):
+    """
+    This token represents a SCALAR parameter (loop/lambda)
+    It replaces the header of a rolled loop, so that the repeat count can be bound to a count argument later.
+    """
+    # pylint: disable=too-few-public-methods
+    def __init__(self, repeatcount, sequencelength):
+        ParametricToken.__init__(self)
+        self.logger = logging.getLogger(__name__)
+        self.logger.debug("Creating lambda token")
+        self.type = ParametricToken.TOKEN_LAMBDA_REPEAT
+        self.repeatcount = repeatcount
+        self.sequencelength = sequencelength
+        # Only the repeat count is substituted
+        self.bytecount = 1
+        # Difference between the count argument and the (off-by-one) repeat count, determined when bound
+        self.transform = 0
+
+    def substitute(self, value):
+        """
+        Converts a count argument to a repeat count
+        :param value: argument value
+        :return: value less the transform
+        """
+        return value - self.transform
+
+    def __eq__(self, other):
+        """
+        Lambda tokens compare by value, so that rolled loops compare equal whether or not they are tokenised
+        """
+        if not isinstance(other, ParametricScalarToken):
+            return False
+        return self.repeatcount == other.repeatcount and self.sequencelength == other.sequencelength
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        return hash((self.repeatcount, self.sequencelength))
+
+
+def process_primitive_sequence(cmd, roller=None, lambda_tokens=False, optimizer=None):
     """
     Processes a primitive sequence before sending for remote execution
+    - Removes redundant primitives (optional)
     - Rolls loops
         - to save space on the transport
         - to execute faster on remote hardware
@@ -115,19 +191,117 @@ def process_primitive_sequence(cmd):
     - Flatten and extract tokens (for parameterising)
 
     :param cmd: sequence to process
+    :param roller: loop roller to use, roll_tandem_repeats by default.
+        roll_loops_reference can be used for the original (slow) search.
+    :param lambda_tokens: set to True to put a ParametricScalarToken on every rolled loop
+    :param optimizer: PrimitivePeepholeOptimizer to apply before rolling loops, if any
     :return: command array and token array
     """
-    success = True
-    lambda_tokens = None
+    if roller is None:
+        roller = roll_tandem_repeats
+    reference = None
+    if optimizer is not None:
+        if optimizer.verify:
+            reference, _ = process_primitive_sequence(cmd, roller, lambda_tokens)
+        cmd = optimizer.optimize(cmd)
     # Roll loops recursively for maximum compression
-    while success:
-        success, cmd, lambda_tokens = roll_loops(cmd)
+    cmd, _ = roller(cmd, lambda_tokens=lambda_tokens)
 
     cmd = enclose_as_lambda(cmd)
+    # Tokens are collected in order of appearance, including lambda tokens
     cmd, tokens = flatten_tree(cmd)
-    tokens = tokens + lambda_tokens
+    if reference is not None:
+        optimizer.check(reference, cmd)
     return cmd, tokens
 
+
+def process_primitive_buffer(buffer, offsets, tokens, roller=None, lambda_tokens=False, optimizer=None):
+    """
+    Processes a primitive sequence accumulated in a flat buffer, as process_primitive_sequence does for nested lists
+    Each element is replaced by a symbol for loop rolling, so the primitives themselves are only copied once: from the
+    accumulated buffer into the output.
+
+    :param buffer: accumulated primitives (bytearray)
+    :param offsets: offset of each element in the buffer
+    :param tokens: (element index, buffer offset, token) for each token, in order of appearance
+    :param roller: loop roller to use, roll_tandem_repeats by default
+    :param lambda_tokens: set to True to put a ParametricScalarToken on every rolled loop
+    :param optimizer: PrimitivePeepholeOptimizer to apply before rolling loops, if any
+    :return: command bytearray and token array
+    """
+    if roller is None:
+        roller = roll_tandem_repeats
+    reference = None
+    if optimizer is not None:
+        if optimizer.verify:
+            reference, _ = process_primitive_buffer(buffer, offsets, tokens, roller, lambda_tokens)
+        buffer, offsets, tokens = optimizer.optimize_buffer(buffer, offsets, tokens)
+    symbols, elements = _intern_buffer_elements(buffer, offsets, tokens)
+    # Roll loops on the symbols, which compare as the elements they stand for
+    tree, _ = roller(symbols, lambda_tokens=lambda_tokens)
+
+    # Wrap as a lambda function and flatten
+    result = bytearray([primitives.LAMBDA, 0, len(tree)])
+    found = []
+    _flatten_buffer_tree(tree, buffer, elements, result, found)
+    if reference is not None:
+        optimizer.check(reference, result)
+    return result, found
+
+
+def frame_primitive_buffer(buffer, offsets, tokens, frame_size, roller=None, optimizer=None):
+    """
+    Processes a primitive sequence accumulated in a flat buffer, as process_primitive_buffer does, for hosts which
+    only take a limited number of bytes per execution.
+    The rolled sequence is cut into frames of whole top-level items, each frame a lambda of its own.  A loop too large
+    for a frame is unrolled by one level.
+
+    :param buffer: accumulated primitives (bytearray)
+    :param offsets: offset of each element in the buffer
+    :param tokens: (element index, buffer offset, token) for each token.  Frames are executed as they are, so there
+        must not be any.
+    :param frame_size: largest frame, in bytes
+    :param roller: loop roller to use, roll_tandem_repeats by default
+    :param optimizer: PrimitivePeepholeOptimizer to apply before rolling loops, if any
+    :return: list of frames (bytearray), to be executed in order
+    """
+    if tokens:
+        raise PrimitiveException("Parametric primitive sequences can not be split into frames")
+    if roller is None:
+        roller = roll_tandem_repeats
+    if optimizer is not None:
+        buffer, offsets, tokens = optimizer.optimize_buffer(buffer, offsets, tokens)
+    symbols, elements = _intern_buffer_elements(buffer, offsets, tokens)
+    tree, _ = roller(symbols)
+
+    # Each frame is enclosed in a lambda, which counts its items in one byte
+    header_size = 3
+    frames = []
+    body = bytearray()
+    items = 0
+    # Items still to place, last one first
+    pending = tree[::-1]
+    while pending:
+        item = pending.pop()
+        data = bytearray()
+        _flatten_buffer_tree([item], buffer, elements, data, [])
+        if header_size + len(data) > frame_size:
+            if not isinstance(item, list):
+                raise PrimitiveException("Primitive of {0:d} bytes does not fit in a frame".format(len(data)))
+            # Loop header is (LAMBDA, repeats, length): the body runs once more than it repeats
+            pending.extend((item[3:] * (item[1] + 1))[::-1])
+            continue
+        if items == 0xFF or header_size + len(body) + len(data) > frame_size:
+            frames.append(bytearray([primitives.LAMBDA, 0, items]) + body)
+            body = bytearray()
+            items = 0
+        body.extend(data)
+        items += 1
+    if items:
+        frames.append(bytearray([primitives.LAMBDA, 0, items]) + body)
+    return frames
+
+
 def list_compare(a_list, b_list):
     """
     Verifies that the input "lists" are of the same type and of the same length
@@ -147,13 +321,14 @@ def list_compare(a_list, b_list):
     return True
 
 
-def roll_loops(content, minimum_sequence_length=1, maximum_sequence_length=None, threshold=4):
+def roll_loops(content, minimum_sequence_length=1, maximum_sequence_length=None, threshold=4, lambda_tokens=False):
     """
     Compacts a primitive sequence by looking for repeated sections and turning them into loops
     :param content: primitive sequence to squash
     :param minimum_sequence_length: minimum length to process
     :param maximum_sequence_length: maximum length to process
     :param threshold: minumum length of a contraction worth doing. Avoids micro-optimising the wrong things
+    :param lambda_tokens: set to True to use a ParametricScalarToken as loop header
     """
     tokens = []
     # Calculate bounds
@@ -187,14 +362,14 @@ def roll_loops(content, minimum_sequence_length=1, maximum_sequence_length=None,
                     prefix = content[:start]
                     suffix = content[start + seqlen * (repeats + 1):]
 
-                    # Add token
-                    # We choose (for now) to NOT parameterise lambdas until we really need to
-                    # token = ParametricScalarToken(repeats, seqlen)
-                    # tokens.append(token)
-                    # contraction = [token]
-
-                    # Trust blindly
-                    contraction = [primitives.LAMBDA, repeats, seqlen]
+                    if lambda_tokens:
+                        # Add token
+                        token = ParametricScalarToken(repeats, seqlen)
+                        tokens.append(token)
+                        contraction = [token]
+                    else:
+                        # Trust blindly
+                        contraction = [primitives.LAMBDA, repeats, seqlen]
                     contraction += content[start:start + seqlen]
                     content = prefix + [contraction] + suffix
 
@@ -202,6 +377,375 @@ def roll_loops(content, minimum_sequence_length=1, maximum_sequence_length=None,
     return False, content, tokens
 
 
+def roll_loops_reference(content, minimum_sequence_length=1, maximum_sequence_length=None, threshold=4,
+                         lambda_tokens=False):
+    """
+    Rolls all loops in a primitive sequence by calling roll_loops until no more contractions are found.
+    This is the original loop rolling search, kept as a reference for roll_tandem_repeats.
+    :param content: primitive sequence to squash
+    :param minimum_sequence_length: minimum length to process
+    :param maximum_sequence_length: maximum length to process
+    :param threshold: minumum length of a contraction worth doing
+    :param lambda_tokens: set to True to use a ParametricScalarToken as loop header
+    :return: rolled sequence and token array
+    """
+    success = True
+    tokens = []
+    while success:
+        success, content, new_tokens = roll_loops(content, minimum_sequence_length, maximum_sequence_length,
+                                                  threshold, lambda_tokens)
+        tokens += new_tokens
+    return content, tokens
+
+
+# Modulus and base of the polynomial hash used for finding tandem repeats
+HASH_MODULUS = (1 << 61) - 1
+HASH_BASE = 1000003
+
+
+class _RollingSymbols(object):
+    """
+    Symbols (and elements) of a sequence being rolled, with prefix hashes for comparing any two sections in constant
+    time.
+    The sequence is kept as a head, which contractions change, followed by what is left of the tail, the sequence as it
+    was when rebased.  A contraction only rehashes the head from where it starts, so contractions made from left to
+    right cost no more than the elements they take in.
+    """
+
+    def __init__(self, content, symbols):
+        self.powers = [1]
+        self.head_content = []
+        self.head_symbols = []
+        self.head_hashes = [0]
+        self.tail_content = content
+        self.tail_symbols = symbols
+        self.tail_hashes = [0]
+        self.tail_start = 0
+        self._hash_tail()
+
+    def _hash_tail(self):
+        hashes = self.tail_hashes
+        for symbol in self.tail_symbols[len(hashes) - 1:]:
+            hashes.append((hashes[-1] * HASH_BASE + symbol + 1) % HASH_MODULUS)
+        while len(self.powers) < len(hashes):
+            self.powers.append((self.powers[-1] * HASH_BASE) % HASH_MODULUS)
+
+    def rebase(self):
+        """
+        Makes the whole sequence the tail again, so that the next contractions start from an empty head
+        """
+        if not self.head_symbols:
+            return
+        self.tail_content = self.head_content + self.tail_content[self.tail_start:]
+        self.tail_symbols = self.head_symbols + self.tail_symbols[self.tail_start:]
+        self.tail_hashes = self.head_hashes
+        self.tail_start = 0
+        self.head_content = []
+        self.head_symbols = []
+        self.head_hashes = [0]
+        self._hash_tail()
+
+    def content(self):
+        """
+        :return: the elements of the sequence, as a list
+        """
+        return self.head_content + self.tail_content[self.tail_start:]
+
+    def __len__(self):
+        return len(self.head_symbols) + len(self.tail_symbols) - self.tail_start
+
+    def symbol(self, position):
+        head = len(self.head_symbols)
+        if position < head:
+            return self.head_symbols[position]
+        return self.tail_symbols[self.tail_start + position - head]
+
+    def element(self, position):
+        head = len(self.head_symbols)
+        if position < head:
+            return self.head_content[position]
+        return self.tail_content[self.tail_start + position - head]
+
+    def _hash(self, hashes, start, end):
+        return (hashes[end] - hashes[start] * self.powers[end - start]) % HASH_MODULUS
+
+    def section(self, start, length):
+        """
+        Hash of a section of the sequence
+        """
+        head = len(self.head_symbols)
+        end = start + length
+        if end <= head:
+            return self._hash(self.head_hashes, start, end)
+        tail_end = self.tail_start + end - head
+        if start >= head:
+            return self._hash(self.tail_hashes, self.tail_start + start - head, tail_end)
+        return (self._hash(self.head_hashes, start, head) * self.powers[end - head] +
+                self._hash(self.tail_hashes, self.tail_start, tail_end)) % HASH_MODULUS
+
+    def _append(self, element, symbol):
+        self.head_content.append(element)
+        self.head_symbols.append(symbol)
+        self.head_hashes.append((self.head_hashes[-1] * HASH_BASE + symbol + 1) % HASH_MODULUS)
+
+    def contract(self, start, end, element, symbol):
+        """
+        Replaces a section of the sequence by one element
+        """
+        head = len(self.head_symbols)
+        kept = []
+        if end <= head:
+            # Elements of the head after the section go back in after it
+            kept = list(zip(self.head_content[end:], self.head_symbols[end:]))
+        else:
+            # Bring the tail up to the start of the section into the head, and skip the rest of the section
+            for index in range(self.tail_start, self.tail_start + start - head):
+                self._append(self.tail_content[index], self.tail_symbols[index])
+            self.tail_start += end - head
+        del self.head_content[start:]
+        del self.head_symbols[start:]
+        del self.head_hashes[start + 1:]
+        self._append(element, symbol)
+        for kept_element, kept_symbol in kept:
+            self._append(kept_element, kept_symbol)
+
+    def _extend(self, first, second, limit, direction):
+        """
+        Number of equal symbols going from two positions in the given direction (1 or -1).
+        The match length is bracketed by doubling steps and then narrowed down by bisection.
+        """
+        if limit == 0 or self.symbol(first) != self.symbol(second):
+            return 0
+        low = 1
+        step = 2
+        while True:
+            high = min(step, limit)
+            if direction > 0:
+                equal = self.section(first, high) == self.section(second, high)
+            else:
+                equal = self.section(first - high + 1, high) == self.section(second - high + 1, high)
+            if not equal:
+                high -= 1
+                break
+            low = high
+            if high == limit:
+                return limit
+            step *= 2
+        while low < high:
+            middle = (low + high + 1) // 2
+            if direction > 0:
+                equal = self.section(first, middle) == self.section(second, middle)
+            else:
+                equal = self.section(first - middle + 1, middle) == self.section(second - middle + 1, middle)
+            if equal:
+                low = middle
+            else:
+                high = middle - 1
+        return low
+
+    def common_prefix(self, first, second, limit):
+        """
+        Number of equal symbols going forwards from two positions
+        """
+        return self._extend(first, second, limit, 1)
+
+    def common_suffix(self, first, second, limit):
+        """
+        Number of equal symbols going backwards from (and including) two positions
+        """
+        return self._extend(first, second, limit, -1)
+
+
+def _intern_element(element, symbol_table):
+    """
+    Maps a sequence element to a symbol, so that elements which list_compare as equal get the same symbol
+    :param element: primitive, token or nested sequence
+    :param symbol_table: dictionary of keys to symbols, shared by all elements to compare
+    :return: symbol (integer)
+    """
+    if isinstance(element, list):
+        key = (list, tuple([_intern_element(item, symbol_table) for item in element]))
+    else:
+        key = (type(element), element)
+    symbol = symbol_table.get(key)
+    if symbol is None:
+        symbol = len(symbol_table)
+        symbol_table[key] = symbol
+    return symbol
+
+
+def _tandem_run(sequence, seqlen, probe):
+    """
+    Finds the run of back-to-back copies of a section which the section at the probe position is part of
+    :return: (start, number of positions from start which equal the position seqlen on) or None
+    """
+    forward = sequence.common_prefix(probe, probe + seqlen, len(sequence) - probe - seqlen)
+    if forward == 0:
+        return None
+    backward = 0
+    if probe > 0:
+        backward = sequence.common_suffix(probe - 1, probe + seqlen - 1, probe)
+    return probe - backward, backward + forward
+
+
+def _worthy_repeats(seqlen, run, threshold):
+    """
+    :return: number of repeats roll_loops would roll for a run, or 0 if it would not roll it
+    """
+    # Repeat-count is an 8-bit off-by-one field.
+    repeats = min(run // seqlen, 255)
+    # Is this contraction worth doing?
+    if seqlen * repeats > threshold:
+        return repeats
+    return 0
+
+
+def _find_tandem_repeat(sequence, seqlen, probe, threshold):
+    """
+    Finds the first run roll_loops would roll for one section length, from a position on.
+    Only every seqlen'th position is probed.  Any section repeated back-to-back covers one of these positions, and
+    extending the match forwards and backwards from there gives the full repeated run.
+    :return: (sequence length, start, repeats) or None
+    """
+    length = len(sequence)
+    while probe + seqlen < length:
+        found = _tandem_run(sequence, seqlen, probe)
+        if found is None:
+            probe += seqlen
+            continue
+        start, run = found
+        repeats = _worthy_repeats(seqlen, run, threshold)
+        if repeats:
+            return seqlen, start, repeats
+        # Skip past this run
+        probe = start + run + seqlen - (run % seqlen or seqlen)
+    return None
+
+
+def _find_tandem_repeat_around(sequence, position, minimum_sequence_length, maximum_sequence_length, threshold):
+    """
+    Finds the shortest, and then first, run roll_loops would roll which takes in a position or one next to it.
+    A run of back-to-back copies holds matching positions (equal to the position seqlen on) for at least seqlen
+    positions, so any run taking in a position has a matching position there or seqlen before it.
+    :return: (sequence length, start, repeats) or None
+    """
+    length = len(sequence)
+    for seqlen in range(minimum_sequence_length, maximum_sequence_length):
+        best = None
+        for probe in (position - 1 - seqlen, position - seqlen, position + 1 - seqlen, position - 1, position,
+                      position + 1):
+            if probe < 0 or probe + seqlen >= length:
+                continue
+            found = _tandem_run(sequence, seqlen, probe)
+            if found is None:
+                continue
+            start, run = found
+            repeats = _worthy_repeats(seqlen, run, threshold)
+            if repeats and (best is None or start < best[1]):
+                best = seqlen, start, repeats
+        if best is not None:
+            return best
+    return None
+
+
+def roll_tandem_repeats(content, minimum_sequence_length=1, maximum_sequence_length=None, threshold=4,
+                        lambda_tokens=False):
+    """
+    Rolls all loops in a primitive sequence.
+    Makes exactly the same contractions as roll_loops_reference, but sections are compared by hash instead of
+    element by element, and each section length is searched once, from left to right.
+    A contraction can only make a run worth rolling where it takes in the new loop or what is left of a run it cut
+    into, both of which are next to the new loop.  So after each contraction only the positions next to the loops made
+    so far are searched again, for all lengths up to the one being searched, until nothing is found next to them.
+    :param content: primitive sequence to squash
+    :param minimum_sequence_length: minimum length to process
+    :param maximum_sequence_length: maximum length to process
+    :param threshold: minumum length of a contraction worth doing. Avoids micro-optimising the wrong things
+    :param lambda_tokens: set to True to use a ParametricScalarToken as loop header
+    :return: rolled sequence and token array
+    """
+    tokens = []
+    symbol_table = {}
+    sequence = _RollingSymbols(content, [_intern_element(element, symbol_table) for element in content])
+    # Section length being searched, and where its search is up to
+    seqlen = minimum_sequence_length
+    probe = 0
+    # Next run found by the search, if it is still good
+    found = None
+    # Positions of the loops made while searching this length
+    loops = []
+    while True:
+        # Calculate bounds
+        max_sequence_length = len(sequence) // 2
+        if maximum_sequence_length is not None and maximum_sequence_length < max_sequence_length:
+            max_sequence_length = maximum_sequence_length
+
+        best = None
+        for position in list(loops):
+            around = _find_tandem_repeat_around(sequence, position, minimum_sequence_length,
+                                                min(seqlen + 1, max_sequence_length), threshold)
+            if around is None:
+                # Nothing to roll here, unless a later contraction comes close
+                loops.remove(position)
+            elif best is None or around[:2] < best[:2]:
+                best = around
+        if seqlen < max_sequence_length and (best is None or best[0] == seqlen):
+            if found is None:
+                found = _find_tandem_repeat(sequence, seqlen, probe, threshold)
+            if found is not None and (best is None or found[1] < best[1]):
+                best = found
+        if best is None:
+            # Nothing left to roll for this length, on to the next one
+            seqlen += 1
+            if seqlen >= max_sequence_length:
+                return sequence.content(), tokens
+            probe = 0
+            loops = []
+            sequence.rebase()
+            continue
+
+        length, start, repeats = best
+        end = start + length * (repeats + 1)
+        # A hash collision would give a false match, so check before contracting
+        for position in range(start + length, end):
+            if sequence.symbol(position) != sequence.symbol(position - length):
+                LOGGER.warning("Hash collision rolling loops, using reference roller")
+                content, new_tokens = roll_loops_reference(sequence.content(), minimum_sequence_length,
+                                                           maximum_sequence_length, threshold, lambda_tokens)
+                return content, tokens + new_tokens
+
+        if lambda_tokens:
+            token = ParametricScalarToken(repeats, length)
+            tokens.append(token)
+            contraction = [token]
+        else:
+            contraction = [primitives.LAMBDA, repeats, length]
+        contraction += [sequence.element(position) for position in range(start, start + length)]
+        sequence.contract(start, end, contraction, _intern_element(contraction, symbol_table))
+
+        # Move what is known to where it is after the contraction
+        removed = end - start - 1
+        if best is found:
+            found = None
+            probe = start + 1
+        else:
+            if found is not None and end < found[1]:
+                found = (found[0], found[1] - removed, found[2])
+            else:
+                found = None
+            if probe >= end:
+                probe -= removed
+            elif probe > start:
+                probe = start + 1
+        moved = [start]
+        for position in loops:
+            if position < start:
+                moved.append(position)
+            elif position >= end:
+                moved.append(position - removed)
+        loops = sorted(set(moved))
+
+
 def enclose_as_lambda(content):
     """
     Wraps an entire, complete primitive stream into an outer lambda function
@@ -239,26 +783,95 @@ def do_flatten_tree(source, result, tokens):
     # Hope its a number at this point
     if isinstance(source, ParametricValueToken):
         source.offset = len(result)
-        LOGGER.info("%d byte Value Token called %s at %d (transform %d)", source.bytecount, source.type, source.offset, source.transform)
+        LOGGER.debug("%d byte Value Token called %s at %d (transform %d)", source.bytecount, source.type, source.offset, source.transform)
         if source.bytecount == 0:
-            raise Exception("Zero-lenght token found!")
+            raise Exception("Zero-length token found!")
         tokens.append(source)
         # Substitute zeros
         for _ in range(source.bytecount):
             result.append(0)
-    # We choose (for now) to NOT parameterise lambdas until we really need to
-    # elif isinstance(source, ParametricScalarToken):
-    #     logger.info("Lambda Token!")
-    #     result.append(primitives.LAMBDA)
-    #     source.offset = len(result)
-    #     result.append(source.repeatcount)
-    #     result.append(source.sequencelength)
+    elif isinstance(source, ParametricScalarToken):
+        LOGGER.debug("Lambda Token repeating %d elements %d times at %d", source.sequencelength,
+                     source.repeatcount, len(result) + 1)
+        tokens.append(source)
+        result.append(primitives.LAMBDA)
+        source.offset = len(result)
+        result.append(source.repeatcount)
+        result.append(source.sequencelength)
     else:
         result.append(source)
 
 
 
 
+def _intern_buffer_elements(buffer, offsets, tokens):
+    """
+    Maps the elements of a flat primitive buffer to symbols, so that identical elements get the same symbol
+    :param buffer: accumulated primitives (bytearray)
+    :param offsets: offset of each element in the buffer
+    :param tokens: (element index, buffer offset, token) for each token, in order of appearance
+    :return: list of symbols, and for each symbol the (start, end, tokens) of the first element found with it
+    """
+    symbol_table = {}
+    elements = []
+    symbols = []
+    ends = offsets[1:] + [len(buffer)]
+    token_index = 0
+    for index, (start, end) in enumerate(zip(offsets, ends)):
+        element_tokens = []
+        while token_index < len(tokens) and tokens[token_index][0] == index:
+            _, offset, token = tokens[token_index]
+            element_tokens.append((offset, token))
+            token_index += 1
+        # Value tokens compare by identity, so elements only match if they hold the same token objects
+        key = (bytes(buffer[start:end]), tuple([(offset - start, token) for offset, token in element_tokens]))
+        symbol = symbol_table.get(key)
+        if symbol is None:
+            symbol = len(elements)
+            symbol_table[key] = symbol
+            elements.append((start, end, element_tokens))
+        symbols.append(symbol)
+    return symbols, elements
+
+
+def _flatten_buffer_tree(source, buffer, elements, result, tokens):
+    """
+    Flattens a rolled sequence of symbols into a bytearray, copying each element from the buffer.
+    Tokens are substituted with zeros while keeping track of their absolute positions, as do_flatten_tree does.
+    """
+    for item in source:
+        if isinstance(item, list):
+            # Rolled loop: header then body
+            header = item[0]
+            if isinstance(header, ParametricScalarToken):
+                LOGGER.debug("Lambda Token repeating %d elements %d times at %d", header.sequencelength,
+                             header.repeatcount, len(result) + 1)
+                tokens.append(header)
+                result.append(primitives.LAMBDA)
+                header.offset = len(result)
+                result.append(header.repeatcount)
+                result.append(header.sequencelength)
+                body = item[1:]
+            else:
+                result.extend(item[:3])
+                body = item[3:]
+            _flatten_buffer_tree(body, buffer, elements, result, tokens)
+            continue
+        start, end, element_tokens = elements[item]
+        position = start
+        for offset, token in element_tokens:
+            result.extend(buffer[position:offset])
+            token.offset = len(result)
+            LOGGER.debug("%d byte Value Token called %s at %d (transform %d)", token.bytecount, token.type, token.offset,
+                         token.transform)
+            if token.bytecount == 0:
+                raise Exception("Zero-length token found!")
+            tokens.append(token)
+            result.extend(bytearray(token.bytecount))
+            position = offset
+        result.extend(buffer[position:end])
+
+
 def array_to_hexstring(values):
     """
     Converts an array to a string of ascii hex values
@@ -271,35 +884,46 @@ def array_to_hexstring(values):
     return hexstring
 
 
-def tokens_to_array(tokens):
+def tokens_to_array(tokens, extended_tokens=False):
     """
     Adds offsets and byte-counts into token list
+    Each token is encoded as type, byte-count, transform and 16-bit offset.
+    Token system zero has one address token at most.  Token system one (extended_tokens) has any number of address,
+    count, delay and lambda repeat tokens, and is only for consumers which substitute them all.
+    For value tokens the transform is a right-shift of the argument, for lambda repeat tokens it is subtracted from the
+    count argument.
+    :param tokens: tokens to encode
+    :param extended_tokens: set to True to encode in token system one
     """
-    LOGGER.info("%d token(s) for encoding", len(tokens))
+    LOGGER.debug("%d token(s) for encoding", len(tokens))
 
-    # T is for token, Token system zero
-    token_prefix = [ord('T'), 0]
+    # T is for token, then the token system
+    token_prefix = [ord('T'), 1 if extended_tokens else 0]
     # How many
     token_count = len(tokens)
-    if token_count > 1:
+    if not extended_tokens and token_count > 1:
         raise Exception("No multi-token support.")
+    if token_count > 0xFF:
+        raise Exception("Too many tokens.")
     token_prefix.append(token_count)
-    if token_count > 0:
-        for token in tokens:
-            if isinstance(token, ParametricValueToken):
-                LOGGER.info("Substitute token type '%d' of size '%d' bytes at offset '%d' (transform '%d')",
-                        token.type,
-                        token.bytecount, token.offset, token.transform)
-
-                if token.type == ParametricValueToken.TOKEN_ADDRESS_LE32:
-                    token_prefix.append(ParametricValueToken.TOKEN_ADDRESS_LE32)
-                    token_prefix.append(token.bytecount)
-                    token_prefix.append(token.transform)
-                    token_prefix.append(token.offset & 0xFF)
-                    token_prefix.append((token.offset >> 8) & 0xFF)
-                else:
-                    raise Exception("Unsupported token type!")
-            else:
-                raise Exception("Unsupported token!")
+    for token in tokens:
+        if isinstance(token, (ParametricValueToken, ParametricScalarToken)):
+            LOGGER.debug("Substitute token type '%d' of size '%d' bytes at offset '%d' (transform '%d')",
+                         token.type,
+                         token.bytecount, token.offset, token.transform)
+
+            if token.type not in TOKEN_TYPES:
+                raise Exception("Unsupported token type!")
+            if not extended_tokens and token.type != ParametricToken.TOKEN_ADDRESS_LE32:
+                raise Exception("Unsupported token type!")
+            if not 0 <= token.transform <= 0xFF:
+                raise Exception("Unsupported token transform!")
+            token_prefix.append(token.type)
+            token_prefix.append(token.bytecount)
+            token_prefix.append(token.transform)
+            token_prefix.append(token.offset & 0xFF)
+            token_prefix.append((token.offset >> 8) & 0xFF)
+        else:
+            raise Exception("Unsupported token!")
 
     return token_prefix
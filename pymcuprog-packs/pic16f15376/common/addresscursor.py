@@ -0,0 +1,137 @@
+"""
+Address pointer tracking for devices which can not load their NVM address directly
+"""
+from primitivebase import PrimitiveTransaction
+
+
+class AddressRegion(object):
+    """
+    A range of NVM which the address pointer can be reset to the start of, and then walk through
+    """
+    # pylint: disable=too-few-public-methods
+    def __init__(self, start_b, end_b, reset, reset_cost):
+        """
+        :param start_b: byte address the pointer is reset to
+        :param end_b: byte address just past the region
+        :param reset: function generating the commands which reset the pointer to start_b
+        :param reset_cost: cost of a reset, counted in increments
+        """
+        self.start_b = start_b
+        self.end_b = end_b
+        self.reset = reset
+        self.reset_cost = reset_cost
+
+    def __contains__(self, byte_address):
+        return self.start_b <= byte_address < self.end_b
+
+
+class AddressCursor(object):
+    """
+    Where the address pointer of the device is, as far as the model knows.
+
+    Devices like the ones with the 6-bit command/16-bit data ICSP interface only move their pointer by resetting it to
+    the start of a region (flash or configuration space) and incrementing it one word at a time.  The cursor remembers
+    where the previous command left the pointer, for as long as the device stays in TMOD, so that each seek is the
+    shortest walk: on from the current position, or from the start of the region.
+    """
+
+    def __init__(self, increment, word_bytes=2):
+        """
+        :param increment: function generating the command which moves the pointer on by one word
+        :param word_bytes: bytes per increment
+        """
+        self.increment = increment
+        self.word_bytes = word_bytes
+        self.regions = []
+        # Byte address the pointer is at, None when it is not known
+        self.position = None
+
+    def add_region(self, start_b, end_b, reset, reset_cost=1):
+        """
+        Adds a region the pointer can be reset into
+        :param start_b: byte address the pointer is reset to
+        :param end_b: byte address just past the region
+        :param reset: function generating the commands which reset the pointer to start_b
+        :param reset_cost: cost of a reset, counted in increments
+        """
+        self.regions.append(AddressRegion(start_b, end_b, reset, reset_cost))
+
+    def region_of(self, byte_address):
+        """
+        :param byte_address: address in NVM
+        :return: region holding the address
+        """
+        for region in self.regions:
+            if byte_address in region:
+                return region
+        raise Exception("Address 0x{0:X} can not be reached by the address pointer".format(byte_address))
+
+    def invalidate(self):
+        """
+        Forgets the position, for when the device may have moved the pointer on its own
+        """
+        self.position = None
+
+    def set(self, byte_address):
+        """
+        Records the position after a command which puts the pointer at a known address
+        :param byte_address: address the pointer is at
+        """
+        self.position = byte_address
+
+    def advance(self, words):
+        """
+        Records increments done by the caller
+        :param words: number of increments
+        """
+        if self.position is not None:
+            self.position += words * self.word_bytes
+
+    def walk_from_position(self, byte_address):
+        """
+        :param byte_address: address to move to
+        :return: increments needed to get there from the current position, None if it can not be done
+        """
+        if self.position is None or self.position > byte_address:
+            return None
+        # Walks do not run from one region into the next
+        if self.position not in self.region_of(byte_address):
+            return None
+        return (byte_address - self.position) // self.word_bytes
+
+    def seek(self, byte_address):
+        """
+        Generates the commands which move the pointer to an address, taking the shortest walk
+        :param byte_address: address to move to
+        """
+        region = self.region_of(byte_address)
+        walk = self.walk_from_position(byte_address)
+        from_start = (byte_address - region.start_b) // self.word_bytes
+        if walk is None or region.reset_cost + from_start < walk:
+            region.reset()
+            walk = from_start
+        for _ in range(walk):
+            self.increment()
+        self.position = byte_address
+
+
+class AddressOrderedTransaction(PrimitiveTransaction):
+    """
+    Transaction which executes its calls by ascending address, so that a device tracked by an AddressCursor only ever
+    walks forward from one call to the next.  Results are returned in the order the calls were queued.
+    Only calls which do not depend on each other's order may be queued together.
+    """
+
+    def execute(self):
+        """
+        Executes all queued calls, and empties the queue
+        :return: list of results, one per call, in the order the calls were queued
+        """
+        calls = self.calls
+        self.calls = []
+        order = sorted(range(len(calls)), key=lambda index: calls[index].kwargs.get('byte_address', 0))
+        ordered_results = self.function.invoke_many([calls[index] for index in order])
+        results = [None] * len(calls)
+        for index, result in zip(order, ordered_results):
+            results[index] = result
+        return results
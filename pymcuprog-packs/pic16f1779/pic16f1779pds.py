@@ -24,6 +24,9 @@ class DeviceDefinition(PicDevice):
 
     # Flash properties for this device
     FLASH_WRITE_BYTES_PER_PAGE = 64
+    FLASH_SIZE_BYTES = 0x8000
+    # 14-bit words read back with the upper bits clear
+    FLASH_ERASED_WORD = 0x3FFF
 
     # ICSP programming command-set for this device. Commands from programming spec.
     LOAD_CONFIGURATION = 0x00
@@ -73,8 +76,31 @@ class DeviceDefinition(PicDevice):
     def __init__(self):
         PicDevice.__init__(self)
         # This PIC has no set_address() function available, but relies on pure increments with reset back to start
-        # The last_address_b value is thus cached so that the Python model can keep track of the address in the device
-        self.last_address_b = -1
+        # The cursor keeps track of the address in the device, so that each access walks on from the previous one
+        self.cursor = AddressCursor(self._increment_address)
+        self.cursor.add_region(self.USER_MEMORY_ADDRESS_B, self.CONFIG_MEMORY_ADDRESS_B, self._reset_address)
+        # Loading the configuration address takes a command and a payload
+        self.cursor.add_region(self.CONFIG_MEMORY_ADDRESS_B, self.CONFIG_MEMORY_ADDRESS_B * 2, self._load_configuration,
+                               reset_cost=2)
+
+    def _increment_address(self):
+        """
+        Moves the address pointer on by one word
+        """
+        self.prog.command(self.INCREMENT_ADDRESS)
+
+    def _reset_address(self):
+        """
+        Moves the address pointer to the start of flash
+        """
+        self.prog.command(self.RESET_ADDRESS)
+
+    def _load_configuration(self):
+        """
+        Moves the address pointer to the start of configuration space
+        """
+        self.prog.command(self.LOAD_CONFIGURATION)
+        self.prog.payload(self.DUMMY_ADDRESS)
 
     def enter_tmod(self):
         """
@@ -100,6 +126,9 @@ class DeviceDefinition(PicDevice):
         self.hw.set_clk()
         self.hw.clr_clk()
 
+        # The address pointer starts at the beginning of flash
+        self.cursor.set(self.USER_MEMORY_ADDRESS_B)
+
     def exit_tmod(self):
         """
         Exit TMOD
@@ -109,33 +138,33 @@ class DeviceDefinition(PicDevice):
         # And wait
         self.board.delay_ms(100)
 
+        # Invalidate address pointer
+        self.cursor.invalidate()
+
     def hold_in_reset(self):
         # Tristate
         self.hw.set_clk_in_data_in()
         # MCLR low
         self.hw.set_mclr_low()
 
+        # Invalidate address pointer
+        self.cursor.invalidate()
+
     def release_from_reset(self):
         # Tristate
         self.hw.set_clk_in_data_in()
         # MCLR high
         self.hw.set_mclr_high()
 
+        # Invalidate address pointer
+        self.cursor.invalidate()
+
     def read_id(self):
         """
         Read the device ID from the PIC
         """
-        # Set address to configuration space
-        self.prog.command(self.LOAD_CONFIGURATION)
-        self.prog.payload(self.DUMMY_ADDRESS)
-
         # Step to device ID address
-        # PIC16 devices uses word adressing so only one increment per word please
-        for _ in range((self.DEVICE_ID_ADDRESS_B - self.CONFIG_MEMORY_ADDRESS_B) // 2):
-            self.prog.command(self.INCREMENT_ADDRESS)
-
-        # Update address pointer
-        self.last_address_b = self.DEVICE_ID_ADDRESS_B
+        self.cursor.seek(self.DEVICE_ID_ADDRESS_B)
 
         # Read data word
         self.prog.command(self.READ_DATA_FROM_PROGRAM_MEMORY)
@@ -158,7 +187,19 @@ class DeviceDefinition(PicDevice):
         self.board.delay_us(self.BULK_ERASE_DELAY_US)
 
         # Invalidate address pointer
-        self.last_address_b = -1
+        self.cursor.invalidate()
+
+    def erase_row(self, byte_address):
+        """
+        Erases one flash row
+        :param byte_address: start address of the row to erase
+        """
+        # Move to the row we want to erase
+        self.cursor.seek(byte_address)
+
+        # Internally timed erase command
+        self.prog.command(self.ROW_ERASE_PROGRAM_MEMORY)
+        self.board.delay_us(self.ROW_ERASE_DELAY_US)
 
     def write_flash_page(self, byte_address, words):
         """
@@ -167,20 +208,8 @@ class DeviceDefinition(PicDevice):
         :param words: number of words to write
         Data is taken indirectly from the data buffer
         """
-        # Check if the address pointer needs to move
-        if self.last_address_b != byte_address or self.last_address_b > byte_address:
-            # Reset to flash start
-            self.prog.command(self.RESET_ADDRESS)
-            # PIC16 devices takes word address
-            self.last_address_b = self.USER_MEMORY_ADDRESS_B // 2
-
-        # If needed: increment address until we get to the word we want to write
-        if byte_address != self.last_address_b:
-            # PIC16 devices are using word addressing so only one increment per word please
-            for _ in range(byte_address // 2):
-                self.prog.command(self.INCREMENT_ADDRESS)
-                # Increment by 2 since the PIC16 devices uses word addressing while we use byte addressing
-                self.last_address_b += 2
+        # Move to the word we want to write
+        self.cursor.seek(byte_address)
 
         # Loop through all but the last word
         for _ in range(words-1):
@@ -200,7 +229,7 @@ class DeviceDefinition(PicDevice):
         self.prog.command(self.INCREMENT_ADDRESS)
 
         # Update address pointer
-        self.last_address_b += words * 2
+        self.cursor.advance(words)
 
     def read_flash(self, byte_address, words):
         """
@@ -209,26 +238,8 @@ class DeviceDefinition(PicDevice):
         :param words: number of words to read
         Data is sent indirectly to the data buffer
         """
-        # Check if the address pointer needs to move
-        if self.last_address_b != byte_address or self.last_address_b > byte_address:
-            # Which range to read: user or config?
-            if byte_address >= self.CONFIG_MEMORY_ADDRESS_B:
-                # Reset to config
-                self.prog.command(self.LOAD_CONFIGURATION)
-                self.prog.payload(self.DUMMY_ADDRESS)
-                self.last_address_b = self.CONFIG_MEMORY_ADDRESS_B
-            else:
-                # Reset to flash start
-                self.prog.command(self.RESET_ADDRESS)
-                self.last_address_b = self.USER_MEMORY_ADDRESS_B
-
-        # If needed: increment address until we get to the word we want to read
-        if byte_address != self.last_address_b:
-            # PIC16 is word addressed so only one increment per word please
-            for _ in range((byte_address - self.last_address_b) // 2):
-                self.prog.command(self.INCREMENT_ADDRESS)
-                # PIC16 devices uses word addressing so only one increment per word please
-                self.last_address_b += 2
+        # Move to the word we want to read, in user or config space
+        self.cursor.seek(byte_address)
 
         # Loop through range, reading words
         for _ in range(words):
@@ -237,7 +248,7 @@ class DeviceDefinition(PicDevice):
             self.prog.command(self.INCREMENT_ADDRESS)
 
         # Update address pointer
-        self.last_address_b += words * 2
+        self.cursor.advance(words)
 
     def read_config_word(self, byte_address):
         """
@@ -253,26 +264,17 @@ class DeviceDefinition(PicDevice):
         :param byte_address: byte address to write
         :return:
         """
-        # Set the address to configuration memory
-        self.prog.command(self.LOAD_CONFIGURATION)
-        self.prog.payload(self.DUMMY_ADDRESS)
-
-        # Increment address until we get to the word we want to write
-        # PIC16 devices uses word addressing mode so only one increment per word please
-        for _ in range((byte_address - self.CONFIG_MEMORY_ADDRESS_B) // 2):
-            self.prog.command(self.INCREMENT_ADDRESS)
+        # Move to the word we want to write
+        self.cursor.seek(byte_address)
 
         # Write data into NVM
         self.prog.command(self.LOAD_DATA_FOR_PROGRAM_MEMORY)
         self.prog.write_data_word()
 
-        # Internally timed write procedure
+        # Internally timed write procedure, the address pointer stays on the word
         self.prog.command(self.BEGIN_INTERNALLY_TIMED_PROGRAMMING)
         self.board.delay_us(self.PROGRAM_CONFIG_WORDS_DELAY_US)
 
-        # Invalidate address pointer
-        self.last_address_b = -1
-
     def write_user_id_word(self, byte_address):
         """
         Writes one word to the user_id space
@@ -282,6 +284,49 @@ class DeviceDefinition(PicDevice):
         # Identical to write config words
         self.write_config_word(byte_address)
 
+    def read_config_memory(self, byte_address, words):
+        """
+        Reads a block of config words from config space.
+        :param byte_address: address of the first word
+        :param words: number of words to read
+        Data is sent indirectly to the data buffer
+        """
+        self.read_flash(byte_address, words)
+
+    def write_config_memory(self, byte_address, words):
+        """
+        Writes a block of words to the config space
+        :param byte_address: byte address of the first word
+        :param words: number of words to write
+        Data is taken indirectly from the data buffer
+        """
+        # Move to the first word we want to write
+        self.cursor.seek(byte_address)
+
+        # Loop through range, one internally timed write per word
+        for _ in range(words):
+            # Write data into NVM
+            self.prog.command(self.LOAD_DATA_FOR_PROGRAM_MEMORY)
+            self.prog.write_data_word()
+            # Internally timed write procedure
+            self.prog.command(self.BEGIN_INTERNALLY_TIMED_PROGRAMMING)
+            self.board.delay_us(self.PROGRAM_CONFIG_WORDS_DELAY_US)
+            # On to the next word
+            self.prog.command(self.INCREMENT_ADDRESS)
+
+        # Update address pointer
+        self.cursor.advance(words)
+
+    def write_user_id_memory(self, byte_address, words):
+        """
+        Writes a block of words to the user ID space
+        :param byte_address: byte address of the first word
+        :param words: number of words to write
+        Data is taken indirectly from the data buffer
+        """
+        # Identical to write config memory
+        self.write_config_memory(byte_address, words)
+
 
     def write_debug_vector(self):
         """
@@ -291,14 +336,8 @@ class DeviceDefinition(PicDevice):
         # Enter programming mode
         self.enter_tmod()
 
-        # Set address to configuration space
-        self.prog.command(self.LOAD_CONFIGURATION)
-        self.prog.payload(self.DUMMY_ADDRESS)
-
-        # Increment address until we get to the word we want to write
-        # PIC16 devices uses word addressing mode so only one increment per word please
-        for _ in range((self.ICD_INSTRUCTION_ADDRESS_B - self.CONFIG_MEMORY_ADDRESS_B) // 2):
-            self.prog.command(self.INCREMENT_ADDRESS)
+        # Move to the word we want to write
+        self.cursor.seek(self.ICD_INSTRUCTION_ADDRESS_B)
 
         # Write literal
         self.prog.command(self.LOAD_DATA_FOR_PROGRAM_MEMORY)
@@ -308,9 +347,6 @@ class DeviceDefinition(PicDevice):
         self.prog.command(self.BEGIN_INTERNALLY_TIMED_PROGRAMMING)
         self.board.delay_us(self.PROGRAM_CONFIG_WORDS_DELAY_US)
 
-        # Invalidate address pointer
-        self.last_address_b = -1
-
         # Leave programming mode
         self.exit_tmod()
 
@@ -348,15 +384,8 @@ class DeviceDefinition(PicDevice):
         """
         Erase the Debug Executive
         """
-        # Reset to config
-        self.prog.command(self.LOAD_CONFIGURATION)
-        self.prog.payload(self.DUMMY_ADDRESS)
-
-        # If needed: increment address until we get to the word we want to erase
-        if byte_address != self.CONFIG_MEMORY_ADDRESS_B:
-            # PIC16 devices uses word addressing mode so only one increment per word please
-            for _ in range((byte_address - self.CONFIG_MEMORY_ADDRESS_B) // 2):
-                self.prog.command(self.INCREMENT_ADDRESS)
+        # Move to the word we want to erase
+        self.cursor.seek(byte_address)
 
         # Erase
         self.prog.command(self.BULK_ERASE_PROGRAM_MEMORY)
@@ -364,14 +393,9 @@ class DeviceDefinition(PicDevice):
 
         # Erase the next section?
         if byte_address + words*2 >= self.DE_MEM2_B:
-            # Reset back to config
-            self.prog.command(self.LOAD_CONFIGURATION)
-            self.prog.payload(self.DUMMY_ADDRESS)
-
-            # Move PC
-            # PIC16 devices uses word addressing mode so only one increment per word please
-            for _ in range((self.DE_MEM2_B - self.CONFIG_MEMORY_ADDRESS_B) // 2):
-                self.prog.command(self.INCREMENT_ADDRESS)
+            # Move PC, back from config start after the erase
+            self.cursor.invalidate()
+            self.cursor.seek(self.DE_MEM2_B)
 
             # Enable region
             self.prog.command(self.MAE_COMMAND)
@@ -382,21 +406,14 @@ class DeviceDefinition(PicDevice):
             self.board.delay_us(self.BULK_ERASE_DELAY_US)
 
         # Invalidate address pointer
-        self.last_address_b = -1
+        self.cursor.invalidate()
 
     def write_de_page(self, byte_address, words):
         """
         Write a page of the Debug Executive
         """
-        # Reset to config
-        self.prog.command(self.LOAD_CONFIGURATION)
-        self.prog.payload(self.DUMMY_ADDRESS)
-
-        # If needed: increment address until we get to the word we want to write
-        if byte_address != self.CONFIG_MEMORY_ADDRESS_B:
-            # PIC16 devices uses word addressing mode so only one increment per word please
-            for _ in range((byte_address - self.CONFIG_MEMORY_ADDRESS_B) // 2):
-                self.prog.command(self.INCREMENT_ADDRESS)
+        # Move to the word we want to write
+        self.cursor.seek(byte_address)
 
         if byte_address >= self.DE_MEM2_B:
             # Enable region
@@ -419,5 +436,5 @@ class DeviceDefinition(PicDevice):
         # Increment address for next row
         self.prog.command(self.INCREMENT_ADDRESS)
 
-        # Invalidate address pointer
-        self.last_address_b = -1
+        # Update address pointer
+        self.cursor.advance(words)
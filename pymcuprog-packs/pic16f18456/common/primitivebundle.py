@@ -0,0 +1,444 @@
+"""
+PrimitiveBundle
+
+Ahead-of-time compiled primitive sequences.
+A bundle holds the parametric sequences of every method of a device model (and its debug executive model), as
+compiled by PrimitiveSequenceCache.  It is built offline and stored next to the device model, so that a session can
+load it instead of tracing the Python model at run time.
+
+The bundle records a fingerprint of the device model and of the sources which generate sequences.  Line endings and
+trailing whitespace are left out of the fingerprint, so that a checkout which converts them still uses the bundle.  A
+bundle which does not match the sources it is loaded with is ignored (with a warning), and sequences are then compiled
+at run time as usual.
+
+Models which keep track of device state, like the address cursor of devices without a load PC command (PIC16F1768
+and PIC16F1779), generate different sequences for the same arguments.  Their sequences are not cached, so their packs
+have no bundle.
+
+To (re)build the bundle of a device pack, run:
+    python <pack>/common/primitivebundle.py
+"""
+import hashlib
+import inspect
+import logging
+import os
+import sys
+
+# pyedbglib dependencies
+from pyedbglib.util import binary
+
+from primitiveutils import ParametricValueToken
+from primitiveutils import ParametricScalarToken
+from primitivecache import CompiledSequence
+from primitivecache import PrimitiveSequenceCache
+from primitiveoptimizer import PrimitivePeepholeOptimizer
+from primitiveoptimizer import address_counter_model
+
+BUNDLE_MAGIC = bytearray([ord(char) for char in 'PSQB'])
+BUNDLE_VERSION = 1
+BUNDLE_EXTENSION = '.bundle'
+
+# Sources (in common) which affect the sequences generated by a device model
+FINGERPRINT_SOURCES = ['picdevice.py', 'proginterfaceprovider.py', 'debuginterfaceprovider.py',
+                       'programexecinterfaceprovider.py', 'primitivebase.py', 'primitivegenerator.py',
+                       'primitiveproxy.py', 'primitiveaccumulator.py', 'primitiveutils.py', 'primitivecache.py',
+                       'primitiveoptimizer.py', 'primitivebundle.py']
+
+# Argument values used when compiling.  Addresses, counts and delays are parametric, so these only need to be typical.
+REPRESENTATIVE_ARGUMENTS = {
+    'byte_address': 0x1000,
+    'words': 128,
+    'numbytes': 128,
+    'delay': 2500,
+}
+
+# Argument kinds in a bundle key
+ARGUMENT_PARAMETRIC = 0
+ARGUMENT_NONE = 1
+
+# Token kinds in a bundle
+TOKEN_VALUE = 1
+TOKEN_SCALAR = 2
+
+
+def _module_of(device_model):
+    return sys.modules[device_model.__module__]
+
+
+def bundle_filename(device_model):
+    """
+    Location of the bundle of a device model, next to the device model module
+    :param device_model: DeviceDefinition class
+    :return: path
+    """
+    module = _module_of(device_model)
+    return os.path.join(os.path.dirname(os.path.abspath(module.__file__)),
+                        module.__name__.split('.')[-1] + BUNDLE_EXTENSION)
+
+
+def _normalise_source(data):
+    """
+    Drops line endings and trailing whitespace from a source, which checkouts and editors change without changing the
+    code
+    """
+    lines = data.replace(b'\r\n', b'\n').replace(b'\r', b'\n').split(b'\n')
+    return b'\n'.join([line.rstrip() for line in lines]).rstrip(b'\n')
+
+
+def fingerprint_sources(filenames, optimized=False):
+    """
+    Hashes sources, ignoring line endings and trailing whitespace
+    :param filenames: sources to hash, in order
+    :param optimized: True if sequences are compiled with the peephole optimizer
+    :return: digest (bytearray)
+    """
+    digest = hashlib.md5()
+    for filename in filenames:
+        with open(filename, 'rb') as source_file:
+            digest.update(_normalise_source(source_file.read()))
+        # Keep the sources apart, so that moving code between them changes the digest
+        digest.update(b'\0')
+    if optimized:
+        digest.update(bytearray([ord(char) for char in 'peephole']))
+    return bytearray(digest.digest())
+
+
+def fingerprint(device_model, optimized=False):
+    """
+    Hashes the device model source and the common sources generating sequences
+    :param device_model: DeviceDefinition class
+    :param optimized: True if sequences are compiled with the peephole optimizer
+    :return: digest (bytearray)
+    """
+    module = _module_of(device_model)
+    model_source = os.path.join(os.path.dirname(os.path.abspath(module.__file__)),
+                                module.__name__.split('.')[-1] + '.py')
+    common_dir = os.path.dirname(os.path.abspath(__file__))
+    return fingerprint_sources([model_source] + [os.path.join(common_dir, source) for source in FINGERPRINT_SOURCES],
+                               optimized)
+
+
+def _encode_string(text):
+    if len(text) > 0xFF:
+        raise Exception("String too long for bundle: '{}'".format(text))
+    return bytearray([len(text)]) + bytearray([ord(char) for char in text])
+
+
+def _encode_key(key):
+    model_name, method_name, shape = key
+    data = _encode_string(model_name) + _encode_string(method_name)
+    data.append(len(shape))
+    for name, value in shape:
+        data += _encode_string(name)
+        if value == PrimitiveSequenceCache.PARAMETER_MARKER:
+            data.append(ARGUMENT_PARAMETRIC)
+        elif value is None:
+            data.append(ARGUMENT_NONE)
+        else:
+            raise Exception("Argument '{}' can not be stored in a bundle".format(name))
+    return data
+
+
+def _encode_sequence(compiled):
+    data = binary.pack_le16(len(compiled.sequence)) + compiled.sequence
+    data.append(len(compiled.tokens))
+    for token in compiled.tokens:
+        if isinstance(token, ParametricScalarToken):
+            data.append(TOKEN_SCALAR)
+        else:
+            data.append(TOKEN_VALUE)
+        data += _encode_string(token.parameter)
+        data += bytearray([token.type, token.bytecount, token.transform])
+        data += binary.pack_le16(token.offset)
+        if isinstance(token, ParametricScalarToken):
+            data += bytearray([token.repeatcount, token.sequencelength])
+    data.append(len(compiled.ranges))
+    for name in sorted(compiled.ranges):
+        low, high = compiled.ranges[name]
+        data += _encode_string(name) + binary.pack_le32(low) + binary.pack_le32(high)
+    return data
+
+
+def encode_bundle(entries, digest):
+    """
+    Encodes compiled sequences as a bundle
+    :param entries: list of (cache key, list of CompiledSequence)
+    :param digest: fingerprint of the sources
+    :return: bundle (bytearray)
+    """
+    data = bytearray(BUNDLE_MAGIC)
+    data.append(BUNDLE_VERSION)
+    data += digest
+    data += binary.pack_le16(len(entries))
+    for key, variants in entries:
+        data += _encode_key(key)
+        data.append(len(variants))
+        for compiled in variants:
+            data += _encode_sequence(compiled)
+    return data
+
+
+class _BundleReader(object):
+    """
+    Reads fields from a bundle
+    """
+
+    def __init__(self, data):
+        self.data = data
+        self.position = 0
+
+    def read(self, numbytes):
+        if self.position + numbytes > len(self.data):
+            raise Exception("Truncated bundle")
+        value = self.data[self.position:self.position + numbytes]
+        self.position += numbytes
+        return value
+
+    def byte(self):
+        return self.read(1)[0]
+
+    def le16(self):
+        return binary.unpack_le16(self.read(2))
+
+    def le32(self):
+        return binary.unpack_le32(self.read(4))
+
+    def string(self):
+        return ''.join([chr(char) for char in self.read(self.byte())])
+
+
+def _decode_key(reader):
+    model_name = reader.string()
+    method_name = reader.string()
+    shape = []
+    for _ in range(reader.byte()):
+        name = reader.string()
+        kind = reader.byte()
+        if kind == ARGUMENT_PARAMETRIC:
+            shape.append((name, PrimitiveSequenceCache.PARAMETER_MARKER))
+        elif kind == ARGUMENT_NONE:
+            shape.append((name, None))
+        else:
+            raise Exception("Unknown argument kind in bundle")
+    return model_name, method_name, tuple(shape)
+
+
+def _decode_sequence(reader):
+    sequence = reader.read(reader.le16())
+    tokens = []
+    for _ in range(reader.byte()):
+        kind = reader.byte()
+        parameter = reader.string()
+        tokentype = reader.byte()
+        bytecount = reader.byte()
+        transform = reader.byte()
+        offset = reader.le16()
+        if kind == TOKEN_SCALAR:
+            token = ParametricScalarToken(reader.byte(), reader.byte())
+        elif kind == TOKEN_VALUE:
+            token = ParametricValueToken(tokentype)
+        else:
+            raise Exception("Unknown token kind in bundle")
+        token.parameter = parameter
+        token.bytecount = bytecount
+        token.transform = transform
+        token.offset = offset
+        tokens.append(token)
+    ranges = {}
+    for _ in range(reader.byte()):
+        name = reader.string()
+        ranges[name] = (reader.le32(), reader.le32())
+    return CompiledSequence(sequence, tokens, ranges)
+
+
+def decode_bundle(data, digest):
+    """
+    Decodes a bundle
+    :param data: bundle content
+    :param digest: fingerprint of the sources, or None to skip the check
+    :return: list of (cache key, list of CompiledSequence), or None if the bundle does not match the sources
+    """
+    reader = _BundleReader(bytearray(data))
+    if reader.read(len(BUNDLE_MAGIC)) != BUNDLE_MAGIC or reader.byte() != BUNDLE_VERSION:
+        raise Exception("Not a sequence bundle")
+    bundle_digest = reader.read(16)
+    if digest is not None and bundle_digest != digest:
+        return None
+    entries = []
+    for _ in range(reader.le16()):
+        key = _decode_key(reader)
+        variants = [_decode_sequence(reader) for _ in range(reader.byte())]
+        entries.append((key, variants))
+    return entries
+
+
+def load_bundle(sequence_cache, device_model, filename=None, optimized=False):
+    """
+    Loads the bundle of a device model into a sequence cache
+    :param sequence_cache: PrimitiveSequenceCache to fill
+    :param device_model: DeviceDefinition class
+    :param filename: bundle to load, defaults to the one next to the device model
+    :param optimized: True if the session compiles sequences with the peephole optimizer
+    :return: number of sequences loaded
+    """
+    logger = logging.getLogger(__name__)
+    if filename is None:
+        filename = bundle_filename(device_model)
+    if not os.path.isfile(filename):
+        logger.debug("No sequence bundle found at %s", filename)
+        return 0
+    with open(filename, 'rb') as bundle_file:
+        data = bundle_file.read()
+    try:
+        entries = decode_bundle(data, fingerprint(device_model, optimized))
+    except Exception as error:
+        logger.warning("Sequence bundle %s is not valid (%s), sequences will be compiled at run time", filename, error)
+        return 0
+    if entries is None:
+        logger.warning("Sequence bundle %s was built from other sources than this session's, sequences will be "
+                       "compiled at run time (rebuild it with primitivebundle.py)", filename)
+        return 0
+    loaded = 0
+    for key, variants in entries:
+        sequence_cache.add_sequences(key, variants)
+        loaded += len(variants)
+    logger.info("Loaded %d compiled sequences from %s", loaded, filename)
+    return loaded
+
+
+def _argument_names(method):
+    """
+    Lists the arguments of a model method (excluding self), and which of them are optional
+    """
+    try:
+        spec = inspect.getfullargspec(method)
+    except AttributeError:
+        # Python 2
+        spec = inspect.getargspec(method)
+    names = spec.args[1:]
+    defaults = spec.defaults or ()
+    return names, names[len(names) - len(defaults):]
+
+
+def _model_methods(model):
+    """
+    Lists the methods of a model which could generate primitives
+    """
+    for name in sorted(dir(model)):
+        if name.startswith('_') or name == 'initialise':
+            continue
+        method = getattr(model, name)
+        if inspect.isfunction(method) or inspect.ismethod(method):
+            yield method
+
+
+def _argument_sets(method):
+    """
+    Lists the argument sets to compile a method with, using representative values
+    """
+    names, optional = _argument_names(method)
+    for name in names:
+        if name not in REPRESENTATIVE_ARGUMENTS:
+            return []
+    kwargs = dict((name, REPRESENTATIVE_ARGUMENTS[name]) for name in names)
+    argument_sets = [kwargs]
+    for name in optional:
+        # Optional arguments are passed as None by the scripting interface
+        without = dict(kwargs)
+        without[name] = None
+        argument_sets.append(without)
+    return argument_sets
+
+
+def compile_model(sequence_cache, model, optimizer=None):
+    """
+    Compiles the sequences of all methods of a model
+    :param sequence_cache: PrimitiveSequenceCache to compile into
+    :param model: model class
+    :param optimizer: PrimitivePeepholeOptimizer to compile with, if any
+    """
+    # Imported here to avoid a circular import
+    from primitiveaccumulator import PrimitiveFunctionAccumulator
+
+    logger = logging.getLogger(__name__)
+    model_object = model()
+    if not sequence_cache.is_cacheable(model_object):
+        logger.info("%s keeps device state, its sequences can not be compiled ahead of time", model.__name__)
+        return
+    accumulator = PrimitiveFunctionAccumulator(model_object)
+    accumulator.optimizer = optimizer
+    # pylint: disable=protected-access
+    compiler = accumulator._compile_sequence
+    for method in _model_methods(model):
+        for kwargs in _argument_sets(method):
+            try:
+                content = PrimitiveFunctionAccumulator.invoke(accumulator, method, **kwargs)
+            except Exception as error:
+                logger.debug("Skipping %s%s (%s)", method.__name__, kwargs, error)
+                continue
+            if not content:
+                # Not a primitive generating method
+                continue
+            sequence_cache.get_sequence(compiler, model_object, method, kwargs)
+            # Also compile counts outside of the range of the representative one
+            counts = [name for name in kwargs if name in sequence_cache.COUNT_ARGUMENTS]
+            if len(counts) != 1 or not sequence_cache.is_count_parametric(model_object, method, kwargs):
+                continue
+            for count in range(1, sequence_cache.MAX_REPEAT + 2):
+                count_kwargs = dict(kwargs)
+                count_kwargs[counts[0]] = count
+                sequence_cache.get_sequence(compiler, model_object, method, count_kwargs)
+
+
+def build_bundle(device_model, filename=None, optimized=False):
+    """
+    Compiles a device model and its debug executive model, and writes the bundle
+    :param device_model: DeviceDefinition class
+    :param filename: bundle to write, defaults to the one next to the device model
+    :param optimized: True to compile sequences with the peephole optimizer, as sessions asking for it do
+    :return: number of sequences in the bundle
+    """
+    logger = logging.getLogger(__name__)
+    sequence_cache = PrimitiveSequenceCache()
+    optimizer = None
+    if optimized:
+        # Sessions optimize with the address counter model of the device for both models, see
+        # PythonScriptedPicDebugger
+        optimizer = PrimitivePeepholeOptimizer(address_counter_model(device_model()))
+    compile_model(sequence_cache, device_model, optimizer)
+    if getattr(device_model, 'DEBUGGING_INTERFACE', None) is not None:
+        compile_model(sequence_cache, device_model.DEBUGGING_INTERFACE, optimizer)
+
+    # Only parametric sequences are of use to other sessions
+    entries = []
+    for key, variants in sequence_cache.get_sequences():
+        try:
+            _encode_key(key)
+        except Exception:
+            continue
+        entries.append((key, variants))
+    if filename is None:
+        filename = bundle_filename(device_model)
+    if not entries:
+        logger.info("No sequences to bundle for %s", device_model.__module__)
+        if os.path.isfile(filename):
+            os.remove(filename)
+        return 0
+
+    with open(filename, 'wb') as bundle_file:
+        bundle_file.write(encode_bundle(entries, fingerprint(device_model, optimized)))
+    count = sum([len(variants) for _, variants in entries])
+    logger.info("Wrote %d compiled sequences to %s", count, filename)
+    return count
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    COMMON_DIR = os.path.dirname(os.path.abspath(__file__))
+    PACK_DIR = os.path.dirname(COMMON_DIR)
+    sys.path.insert(0, PACK_DIR)
+    from debugprovider import provide_debugger_model
+    for MODEL_SOURCE in sorted(os.listdir(PACK_DIR)):
+        if MODEL_SOURCE.endswith('pds.py'):
+            DEBUGGER = provide_debugger_model(MODEL_SOURCE[:-len('pds.py')])
+            build_bundle(DEBUGGER.device_model)
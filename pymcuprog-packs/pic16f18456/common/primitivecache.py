@@ -0,0 +1,389 @@
+"""
+PrimitiveCache
+
+Caches compiled (rolled and flattened) primitive sequences.
+Generating a sequence means tracing a device model method, accumulating its primitives, rolling loops and flattening
+the result.  For most methods the only things that change from call to call are the address and the number of
+words, so the sequence is compiled once with the address replaced by a parametric token and the loop over the words
+replaced by a lambda token, and each call only patches the token fields.
+"""
+import logging
+import numbers
+
+from addresscursor import AddressCursor
+from primitiveutils import ParametricToken
+from primitiveutils import ParametricValueToken
+from primitiveutils import ParametricScalarToken
+
+
+class CompiledSequence(object):
+    """
+    A flattened primitive sequence with a list of tokens to substitute before execution
+    """
+
+    def __init__(self, sequence, tokens=None, ranges=None):
+        """
+        :param sequence: flattened primitive sequence
+        :param tokens: list of tokens bound to arguments (token.parameter)
+        :param ranges: dictionary of count argument names to the (inclusive) range of values the sequence is valid for
+        """
+        self.sequence = bytearray(sequence)
+        if tokens is None:
+            tokens = []
+        self.tokens = tokens
+        if ranges is None:
+            ranges = {}
+        self.ranges = ranges
+
+    def accepts(self, kwargs):
+        """
+        Checks if the sequence can be rendered for the given arguments
+        :param kwargs: arguments as passed to the model method
+        :return: True if all count arguments are in range
+        """
+        for name, (low, high) in self.ranges.items():
+            if not low <= kwargs[name] <= high:
+                return False
+        return True
+
+    def render(self, kwargs):
+        """
+        Generates the sequence for the given arguments
+        :param kwargs: arguments as passed to the model method
+        :return: primitive sequence (bytearray)
+        """
+        if not self.tokens:
+            return self.sequence
+        sequence = bytearray(self.sequence)
+        for token in self.tokens:
+            value = token.substitute(kwargs[token.parameter])
+            for index in range(token.bytecount):
+                sequence[token.offset + index] = (value >> (8 * index)) & 0xFF
+        return sequence
+
+
+class PrimitiveSequenceCache(object):
+    """
+    Cache of compiled primitive sequences, keyed by (device model, method, shape of arguments)
+    """
+
+    # Arguments which are replaced by tokens when compiling, and the token type used for each of them
+    PARAMETRIC_ARGUMENTS = {
+        'byte_address': ParametricToken.TOKEN_ADDRESS_LE32,
+        'delay': ParametricToken.TOKEN_DELAY_LE16,
+    }
+
+    # Arguments which set the number of iterations of a loop, and are bound to lambda repeat tokens
+    COUNT_ARGUMENTS = ('words', 'numbytes')
+
+    # Token type used for count arguments which are used as values rather than looped over
+    COUNT_TOKEN_TYPE = ParametricToken.TOKEN_COUNT_LE16
+
+    # Shortest loop worth rolling, as used by process_primitive_sequence
+    ROLL_THRESHOLD = 4
+
+    # Maximum value of a lambda repeat count
+    MAX_REPEAT = 255
+
+    # Marker used in place of the value of a parametric argument in a cache key
+    PARAMETER_MARKER = '<param>'
+
+    def __init__(self):
+        self.logger = logging.getLogger(__name__)
+        self._sequences = {}
+        # Arguments of each method which can not be parameterised, these are cached by their concrete values
+        self._fixed_arguments = {}
+        self.hits = 0
+        self.misses = 0
+
+    def clear(self):
+        """
+        Drops all compiled sequences
+        """
+        self._sequences = {}
+        self._fixed_arguments = {}
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def is_cacheable(model_object):
+        """
+        Checks if sequences generated by a model object can be cached.
+        Models which keep track of device state in plain attributes or in an address cursor (like the address pointer
+        of devices without a load PC command) generate different sequences for the same arguments, and can not be
+        cached.
+        :param model_object: device or debug executive model instance
+        :return: True if sequences can be cached
+        """
+        for value in vars(model_object).values():
+            if isinstance(value, (numbers.Number, str, AddressCursor)):
+                return False
+        return True
+
+    @staticmethod
+    def _is_integer(value):
+        return isinstance(value, numbers.Integral) and not isinstance(value, bool)
+
+    def _parametric_names(self, method_id, kwargs):
+        """
+        Lists the arguments of an invocation which are replaced by value tokens and which are bound to lambda tokens
+        """
+        fixed = self._fixed_arguments.get(method_id, ())
+        values = []
+        counts = []
+        for name, value in kwargs.items():
+            if name in fixed or not self._is_integer(value):
+                continue
+            if name in self.PARAMETRIC_ARGUMENTS:
+                values.append(name)
+            elif name in self.COUNT_ARGUMENTS:
+                counts.append(name)
+        return values, counts
+
+    def _fix_argument(self, method_id, name):
+        self.logger.debug("%s can not be parameterised by %s", method_id[1], name)
+        self._fixed_arguments.setdefault(method_id, set()).add(name)
+
+    def _fix_arguments(self, method_id, values, counts):
+        """
+        Gives up on parameterising an invocation, one kind of argument at a time: values first, then counts
+        """
+        for name in values or counts:
+            self._fix_argument(method_id, name)
+
+    def _make_key(self, model_object, method, kwargs):
+        """
+        Builds a cache key for a method invocation
+        """
+        method_id = (type(model_object).__name__, method.__name__)
+        values, counts = self._parametric_names(method_id, kwargs)
+        shape = []
+        for name in sorted(kwargs):
+            value = kwargs[name]
+            if name in values or name in counts:
+                value = self.PARAMETER_MARKER
+            shape.append((name, value))
+        return method_id + (tuple(shape),)
+
+    def get_sequence(self, compiler, model_object, method, kwargs):
+        """
+        Provides the primitive sequence for a method invocation, compiling it if needed
+        :param compiler: function taking (method, kwargs, lambda_tokens) returning a processed sequence and its tokens
+        :param model_object: model object the method is invoked on
+        :param method: model method
+        :param kwargs: method arguments
+        :return: primitive sequence
+        """
+        key = self._make_key(model_object, method, kwargs)
+        try:
+            variants = self._sequences.get(key, [])
+        except TypeError:
+            # Unhashable arguments, do not cache
+            sequence, _ = compiler(method, kwargs)
+            return sequence
+
+        for compiled in variants:
+            if compiled.accepts(kwargs):
+                self.hits += 1
+                return compiled.render(kwargs)
+
+        self.misses += 1
+        compiled = self.compile(compiler, model_object, method, kwargs)
+        # Arguments might just have been found to be fixed, so re-key before storing
+        self._sequences.setdefault(self._make_key(model_object, method, kwargs), []).append(compiled)
+        return compiled.render(kwargs)
+
+    def get_sequences(self):
+        """
+        Lists all compiled sequences
+        :return: list of (key, list of CompiledSequence)
+        """
+        return sorted(self._sequences.items(), key=lambda item: repr(item[0]))
+
+    def add_sequences(self, key, variants):
+        """
+        Adds compiled sequences, as provided by get_sequences (of another cache)
+        :param key: cache key
+        :param variants: list of CompiledSequence
+        """
+        self._sequences.setdefault(key, []).extend(variants)
+
+    def is_count_parametric(self, model_object, method, kwargs):
+        """
+        Checks if the sequence compiled for an invocation serves more than one count
+        """
+        for compiled in self._sequences.get(self._make_key(model_object, method, kwargs), []):
+            if compiled.accepts(kwargs):
+                for low, high in compiled.ranges.values():
+                    if high > low:
+                        return True
+        return False
+
+    def compile(self, compiler, model_object, method, kwargs):
+        """
+        Compiles a sequence using tokens for parametric arguments.
+        Value arguments (addresses) are passed to the method as tokens.  Count arguments are passed as tokens too if
+        the method only uses them as values.  If the method loops over a count the sequence is compiled for a second
+        count instead, and lambdas whose repeat count follows the count are bound to it.
+        The result is checked against sequences compiled with actual arguments.  If it does not render correctly the
+        value arguments are marked as fixed and the sequence is compiled again.  A count which can not be bound only
+        limits the sequence to that count.
+        A bound count is checked at both ends of its range and in the middle.  The ends catch loops rolled differently
+        (too short to roll, or past the repeat field), the middle catches a method which branches on the count, like
+        one splitting long accesses.  A method which only changes for a few counts in between is not caught.
+        :param compiler: function taking (method, kwargs, lambda_tokens) returning a processed sequence and its tokens
+        :param model_object: model object the method is invoked on
+        :param method: model method
+        :param kwargs: method arguments
+        :return: CompiledSequence
+        """
+        self.logger.debug("Compiling %s", method.__name__)
+        method_id = (type(model_object).__name__, method.__name__)
+        # Reference sequence using actual values
+        sequence, _ = compiler(method, kwargs)
+        reference = CompiledSequence(sequence)
+
+        values, counts = self._parametric_names(method_id, kwargs)
+        if not values and not counts:
+            return reference
+
+        if counts:
+            compiled = self._compile_count_values(compiler, method, kwargs, values, counts, reference)
+            if compiled is not None:
+                return compiled
+
+        try:
+            template, tokens = compiler(method, self._tokenise(kwargs, values), bool(counts))
+        except Exception as error:
+            self.logger.debug("%s can not be parameterised (%s)", method.__name__, error)
+            self._fix_arguments(method_id, values, counts)
+            return self.compile(compiler, model_object, method, kwargs)
+
+        bound = [token for token in tokens if token.parameter is not None]
+        if CompiledSequence(template, bound).render(kwargs) != reference.sequence:
+            self.logger.debug("%s does not render correctly with tokens", method.__name__)
+            self._fix_arguments(method_id, values, counts)
+            return self.compile(compiler, model_object, method, kwargs)
+
+        ranges = {}
+        for name in counts:
+            count = kwargs[name]
+            # By default the sequence only serves this count
+            ranges[name] = (count, count)
+            count_tokens = self._bind_count(compiler, method, kwargs, values, name, template, tokens)
+            if not count_tokens:
+                continue
+            # Check the sequence renders correctly at both ends of the range and in the middle
+            count_range = self._count_range(count_tokens)
+            compiled = CompiledSequence(template, bound + count_tokens)
+            low, high = count_range
+            for value in sorted(set((low, (low + high) // 2, high))):
+                check = dict(kwargs)
+                check[name] = value
+                expected, _ = compiler(method, check)
+                if compiled.render(check) != bytearray(expected):
+                    self.logger.debug("%s does not render correctly for %s=%d", method.__name__, name, value)
+                    break
+            else:
+                bound += count_tokens
+                ranges[name] = count_range
+
+        return CompiledSequence(template, bound, ranges)
+
+    def _compile_count_values(self, compiler, method, kwargs, values, counts, reference):
+        """
+        Compiles a sequence with count arguments passed as value tokens
+        :return: CompiledSequence, or None if the method loops over a count
+        """
+        try:
+            template, tokens = compiler(method, self._tokenise(kwargs, values + counts))
+        except Exception:
+            return None
+        compiled = CompiledSequence(template, [token for token in tokens if token.parameter is not None])
+        if compiled.render(kwargs) != reference.sequence:
+            return None
+        # Counts must fit the field they are put in
+        for token in compiled.tokens:
+            if token.parameter in counts:
+                compiled.ranges[token.parameter] = (0, ((1 << (8 * token.bytecount)) - 1) << token.transform)
+        return compiled
+
+    def _tokenise(self, kwargs, names):
+        """
+        Replaces arguments by value tokens
+        """
+        token_kwargs = dict(kwargs)
+        for name in names:
+            token = ParametricValueToken(self.PARAMETRIC_ARGUMENTS.get(name, self.COUNT_TOKEN_TYPE))
+            token.parameter = name
+            token_kwargs[name] = token
+        return token_kwargs
+
+    def _bind_count(self, compiler, method, kwargs, values, name, template, tokens):
+        """
+        Finds the lambda tokens which repeat once per unit of a count argument.
+        The sequence is compiled with a count one off, and should only differ in the repeat count of those lambdas.
+        :return: list of bound lambda tokens, empty if the count can not be parameterised
+        """
+        count = kwargs[name]
+        other = count - 1 if count > 1 else count + 1
+        other_kwargs = self._tokenise(kwargs, values)
+        other_kwargs[name] = other
+        try:
+            other_template, other_tokens = compiler(method, other_kwargs, True)
+        except Exception:
+            return []
+        if len(other_template) != len(template) or len(other_tokens) != len(tokens):
+            return []
+
+        bound = []
+        for token, other_token in zip(tokens, other_tokens):
+            if type(token) != type(other_token) or token.offset != other_token.offset:
+                return []
+            if not isinstance(token, ParametricScalarToken):
+                continue
+            if token.sequencelength != other_token.sequencelength:
+                return []
+            difference = other_token.repeatcount - token.repeatcount
+            if difference == 0:
+                continue
+            if difference != other - count:
+                return []
+            token.parameter = name
+            token.transform = count - token.repeatcount
+            bound.append(token)
+
+        # Nothing else may differ
+        skip = set(token.offset for token in bound)
+        for offset, (value, other_value) in enumerate(zip(template, other_template)):
+            if value != other_value and offset not in skip:
+                return []
+        return bound
+
+    def _count_range(self, tokens):
+        """
+        Range of count values for which all bound loops are rolled the same way
+        """
+        low = 0
+        high = None
+        for token in tokens:
+            # A loop is only rolled if it repeats at least once and the contraction is above the threshold
+            minimum_repeat = max(1, self.ROLL_THRESHOLD // token.sequencelength + 1)
+            low = max(low, token.transform + minimum_repeat)
+            if high is None:
+                high = token.transform + self.MAX_REPEAT
+            else:
+                high = min(high, token.transform + self.MAX_REPEAT)
+        return low, high
+
+
+class AddressSequenceCache(PrimitiveSequenceCache):
+    """
+    Sequence cache which only replaces addresses by tokens, for consumers of token system zero
+    """
+
+    PARAMETRIC_ARGUMENTS = {
+        'byte_address': ParametricToken.TOKEN_ADDRESS_LE32,
+    }
+
+    COUNT_ARGUMENTS = ()
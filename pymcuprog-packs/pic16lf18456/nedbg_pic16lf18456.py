@@ -10,6 +10,7 @@ from common.mplablog import setup_logger
 # Import driver model provider for debugger variants
 from common.debugprovider import provide_debugger_model
 from common.primitiveutils import PrimitiveException
+from common.bulkcopy import bulk_copy
 
 from common.terminaloutput import TerminalOutput
 terminal = TerminalOutput(msg)
@@ -88,6 +89,7 @@ def begin_communication_session():
     options = {}
     options['skip_blank_pages'] = True
     options['overlapped_usb_access'] = False
+    options['overlapped_reads'] = False
     # Initialise stack with given transport and options
     # 'tool' object is injected by MPLAB, and is a handle to the MPLABCOMM HID interface
     debugger.setup_session(tool, options)
@@ -185,23 +187,24 @@ def prog_write(type_of_mem, address, length, data):
         terminal.display("Unknown memtype: {}!\n".format(str(type_of_mem)))
 
 
-def copy_data(source, destination):
+def copy_data(source, destination, stride=1):
     """
     Deep copy from source to destination
     :param source: from
     :param destination: to
+    :param stride: distance between the source bytes copied, for dropping padding bytes
     """
-    if len(source) > len(destination):
+    source_length = (len(source) + stride - 1) // stride
+    if source_length > len(destination):
         message = "Data size mismatch: {} byte(s) read from {}, but MPLAB X only accepted {} byte(s).".format(
-            len(source),
+            source_length,
             device_name,
             len(destination)
             )
         terminal.display("WARNING - {}\n".format(message))
         terminal.show_info_dialog_non_blocking("{}".format(message))
 
-    for i in xrange(min(len(source), len(destination))):
-        destination[i] = source[i]
+    bulk_copy(source, destination, stride=stride)
 
 
 def prog_read(type_of_mem, address, length, data):
@@ -226,16 +229,14 @@ def prog_read(type_of_mem, address, length, data):
     elif str(type_of_mem) == "EEData":
         # EEPROM memory
 
-        # For devices with word access to EEPROM there will be a padding byte for each data byte. We have to discard
-        # the pad bytes before sending the data back to MPLAB
-        temp_data = [0] * length * eeprom_data_size_bytes
         if "pic16" in device_name:
             # MPLAB X does not comply with the query_prog_data_mode() setting and sends a word address for pic16 EEPROM
-            copy_data(debugger.read_eeprom_memory(byte_address*2, length * eeprom_data_size_bytes), temp_data)
+            read_back = debugger.read_eeprom_memory(byte_address*2, length * eeprom_data_size_bytes)
         else:
-            copy_data(debugger.read_eeprom_memory(byte_address, length * eeprom_data_size_bytes), temp_data)
-        for dataindex in range(0, len(temp_data), eeprom_data_size_bytes):
-            data[dataindex // eeprom_data_size_bytes] = temp_data[dataindex]
+            read_back = debugger.read_eeprom_memory(byte_address, length * eeprom_data_size_bytes)
+        # For devices with word access to EEPROM there will be a padding byte for each data byte. The pad bytes are
+        # discarded while copying the data back to MPLAB
+        copy_data(read_back, data, eeprom_data_size_bytes)
     elif str(type_of_mem) == "UserID" or str(type_of_mem) == "Test":
         # User ID/Test memory
         copy_data(debugger.read_flash_memory(byte_address, length), data)
@@ -461,14 +462,49 @@ def clear_hw_bp(number):
 def verify_transfer(type_of_mem, address, data, length):
     """
     Verify memory
+    :param type_of_mem: memory area/type
+    :param address: start address
+    :param data: data expected in memory
+    :param length: number of bytes to verify
+    :return: True if memory holds the data
     """
     terminal.display(
         "API command: Verifying {:d} bytes to address 0x{:06X} of {} memory\n".format(length, address, type_of_mem))
-    raise NotImplementedError("Function not implemented!")
+    # Device support scripts always use byte addressing mode
+    byte_address = address
+
+    if str(type_of_mem) == "Pgm":
+        # Program memory
+        result = debugger.verify_flash_memory(byte_address, data[:length])
+    elif str(type_of_mem) == "Cfg":
+        # Config words
+        result = debugger.verify_config_memory(byte_address, data[:length])
+    elif str(type_of_mem) == "EEData":
+        # EEPROM memory
+        if "pic16" in device_name:
+            # MPLAB X does not comply with the query_prog_data_mode() setting and sends a word address for pic16 EEPROM
+            result = debugger.verify_eeprom_memory(byte_address*2, data[:length])
+        else:
+            result = debugger.verify_eeprom_memory(byte_address, data[:length])
+    elif str(type_of_mem) == "UserID" or str(type_of_mem) == "Test":
+        # User ID/Test memory
+        result = debugger.verify_flash_memory(byte_address, data[:length])
+    else:
+        terminal.display("Unknown memtype: {}!\n".format(str(type_of_mem)))
+        return False
+
+    if not result:
+        terminal.display("Verify failed!\n")
+    return result
 
 
 def blank_check():
     """
     Blank-check memory
+    :return: True if the device is blank
     """
-    terminal.display("API command: Blank check (TODO: not implemented!)\n")
+    terminal.display("API command: Blank check\n")
+    result = debugger.blank_check()
+    if not result:
+        terminal.display("Device is not blank!\n")
+    return result
@@ -3,6 +3,8 @@ Wrapper for invoking GEN4-scripts on 5G FW platform
 """
 import logging
 from pyedbglib.util import binary
+from pyedbglib.primitive.gen4controller import Gen4Exception
+from pyedbglib.primitive.gen4controller import GEN4_RSP_SCRIPT_STATUS_FIELD
 
 def pic24_compact(data):
     """
@@ -66,6 +68,8 @@ class Gen4ScriptWrapper(object):
         self.logger.debug("Using GEN4 proxy")
         self.model_object = model_object
         self.controller = controller
+        # Packed data count of triggered reads, by data buffer
+        self._triggered_reads = {}
 
     def _make_command(self, content, params):
         cmd = self.controller.new_command(content)
@@ -149,3 +153,36 @@ class Gen4ScriptWrapper(object):
         Blocks for a write response. Useful for overlapping access.
         """
         return self.controller.receive_script_execution_response()
+
+    def trigger_read(self, data_buffer_id, method, **kwargs):
+        """
+        Triggers a remote read into a data buffer. Does not wait for response. Useful for overlapping access.
+        """
+        parameters, script_content, options = method(self.model_object, **kwargs)
+        cmd = self._make_command(script_content, parameters)
+
+        # Assign the data buffer
+        cmd.set_data_dest(data_buffer_id)
+        self._triggered_reads[data_buffer_id] = options.get('packed_data_count')
+        # Generate a bytestream and trigger remote execution
+        self.controller.start_script_execution(cmd.generate_bytestream())
+
+    def wait_read_done(self):
+        """
+        Blocks for the response of a triggered read, and checks it. Useful for overlapping access.
+        """
+        raw_results = self.controller.receive_script_execution_response()
+        script_status = raw_results[GEN4_RSP_SCRIPT_STATUS_FIELD]
+        if script_status != 0x00:
+            raise Gen4Exception("Script failed, script status: 0x{:02X}".format(script_status))
+
+    def read_triggered(self, data_buffer_id, bytes_to_read):
+        """
+        Reads back the data buffer of a triggered read which is done. Useful for overlapping access.
+        """
+        packed_data_count = self._triggered_reads.pop(data_buffer_id, None)
+        if packed_data_count is None:
+            return self.controller.read_data_buffer(data_buffer_id, bytes_to_read)
+        data = self.controller.read_data_buffer(data_buffer_id, packed_data_count)
+        self.logger.debug("Unpacking %d bytes into %d bytes", packed_data_count, bytes_to_read)
+        return pic24_decompact(data)
@@ -14,6 +14,8 @@ from primitivebase import DebugInterface
 from primitivebase import BoardInterface
 from primitivebase import HardwareInterface
 from primitiveproxy import PrimitiveEmbeddedProxy
+from primitiveaccumulator import PrimitiveFunctionAccumulator
+from primitiveutils import frame_primitive_buffer
 
 from pyedbglib.primitive import primitives
 
@@ -79,6 +81,51 @@ class PrimitiveFunctionEmbedded(PrimitiveFunction):
         return self.invoke(method, **kwargs)
 
 
+class PrimitiveFunctionEmbeddedAccumulator(PrimitiveFunctionAccumulator):
+    """
+    Function provider for host output which accumulates the primitives of each call, rolls their loops and executes
+    them a full ICSP command at a time, rather than one primitive at a time
+    """
+
+    def __init__(self, model_object, optimizer=None):
+        PrimitiveFunctionAccumulator.__init__(self, model_object)
+        self.logger.info("Using accumulated host primitives")
+        self.optimizer = optimizer
+        self.proxy = PrimitiveEmbeddedProxy()
+
+    def invoke(self, method, **kwargs):
+        """
+        Invokes a method, and executes the primitives it generates
+        """
+        self._accumulate(method, kwargs)
+        buffer, offsets, tokens = self.accumulator.get_buffer()
+        frames = frame_primitive_buffer(buffer, offsets, tokens, self.proxy.command_size, optimizer=self.optimizer)
+        self.logger.debug("Executing %s in %d commands", method.__name__, len(frames))
+        for frame in frames:
+            self.proxy.execute(frame)
+
+    def invoke_read(self, bytes_to_read, method, **kwargs):
+        """
+        Invokes a method and returns data from the data pipe
+        """
+        self.invoke(method, **kwargs)
+        return self.proxy.get_data_buffer(0, bytes_to_read)
+
+    def invoke_write(self, data_to_write, method, **kwargs):
+        """
+        Invokes a method after putting data in the data pipe
+        """
+        self.proxy.set_data_buffer(0, data_to_write)
+        return self.invoke(method, **kwargs)
+
+    def invoke_write_read(self, data_to_write, bytes_to_read, method, **kwargs):
+        """
+        Invokes a method after putting data in the data pipe, and returns data from the data pipe
+        """
+        self.invoke_write(data_to_write, method, **kwargs)
+        return self.proxy.get_data_buffer(0, bytes_to_read)
+
+
 class ProgInterfaceIcspC8D24Embedded(ProgInterfaceIcspC8D24):
     """
     Embedded programming interface
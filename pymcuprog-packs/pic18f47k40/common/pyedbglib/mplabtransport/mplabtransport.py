@@ -24,12 +24,12 @@ class MpLabTransport(object):
     def hid_write(self, packet):
         """Sends a packet to HID and does not wait for a response"""
         # pylint: disable=unused-argument, no-self-use
-        raise Exception("Blind write not supported")
+        raise NotImplementedError("Blind write not supported")
 
     def hid_read(self):
         """Waits for and receives a packet over HID"""
         # pylint: disable=no-self-use
-        raise Exception("Blind read not supported")
+        raise NotImplementedError("Blind read not supported")
 
     def hid_transfer(self, packet):
         """Sends a packet and receives a response."""
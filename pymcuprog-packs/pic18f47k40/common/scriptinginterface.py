@@ -12,7 +12,19 @@ from pyedbglib.util import binary
 from debuggerbase import CmsisAtiPicDebugger
 
 from primitiveembedded import PrimitiveFunctionEmbedded
+from primitiveembedded import PrimitiveFunctionEmbeddedAccumulator
 from primitiveaccumulator import PrimitiveFunctionAccumulatorExecuter
+from primitivecache import PrimitiveSequenceCache
+from primitivebundle import load_bundle
+from primitiveoptimizer import PrimitivePeepholeOptimizer
+from primitiveoptimizer import address_counter_model
+from flashshadow import FlashShadow
+from flashshadow import DEFAULT_SHADOW_DIRECTORY
+from blankcheck import BlankPageMap
+from blankcheck import as_bytearray
+from addresscursor import AddressCursor
+from addresscursor import AddressOrderedTransaction
+from bulkcopy import bulk_copy
 
 from debugprovider import ConfigGeneratorTool
 from debugprovider import EmbeddedTool
@@ -21,17 +33,28 @@ from debugprovider import PrinterTool
 from pyedbglib.hidtransport.hidtransportbase import HidTransportBase
 from pyedbglib.mplabtransport.mplabtransport import MpLabTransport
 
-def is_blank(data):
+def first_difference(expected, actual):
     """
-    Checks if a block of flash memory in an array is 'blank'
+    Finds the first byte which differs between two blocks of equal length.
+    Halves of the blocks are compared as a whole, so that only the last few bytes are compared one by one.
+    :param expected: bytearray
+    :param actual: bytearray
+    :return: index of the first difference, or None if the blocks are the same
     """
-    for d in range(0, len(data), 2):
-        if not data[d] == 0xFF:
-            return False
-        if not data[d + 1] == 0x3F:
-            # TODO: flash width should depend on the target
-            return False
-    return True
+    if expected == actual:
+        return None
+    start = 0
+    end = len(expected)
+    while end - start > 16:
+        middle = (start + end) // 2
+        if expected[start:middle] == actual[start:middle]:
+            start = middle
+        else:
+            end = middle
+    for index in range(start, end):
+        if expected[index] != actual[index]:
+            return index
+    return None
 
 
 class PythonScriptedPicDebugger(CmsisAtiPicDebugger):
@@ -39,11 +62,22 @@ class PythonScriptedPicDebugger(CmsisAtiPicDebugger):
     Wrapper for a python-based debugger
     """
 
+    # Memory types for iter_read and read_into
+    MEMTYPE_FLASH = "flash"
+    MEMTYPE_CONFIG = "config"
+    MEMTYPE_EEPROM = "eeprom"
+
     def __init__(self, device_name):
         self.logger = logging.getLogger(__name__)
         CmsisAtiPicDebugger.__init__(self, device_name)
         self.logger.info("Creating nEDBG scripting wrapper")
 
+        # Differential programming state, see write_flash_memory
+        self.flash_shadow = None
+
+        # Config space writes put off to be done in one pass, see write_config_memory
+        self._config_space_writes = []
+
     def setup_session(self, tool, options):
         """
         Takes transport and options and propagates them down the stack
@@ -63,7 +97,13 @@ class PythonScriptedPicDebugger(CmsisAtiPicDebugger):
         if isinstance(tool, EmbeddedTool):
             # Use this mode to execute primitives locally on an embedded python engine
             self.logger.debug("Embedded Tool")
-            self.device_proxy = PrimitiveFunctionEmbedded(self.device_object)
+            if self.options.get('embedded_accumulator', False):
+                # Each call is accumulated and rolled, then executed a full ICSP command at a time
+                self.optimizer = self._create_optimizer()
+                self.device_proxy = PrimitiveFunctionEmbeddedAccumulator(self.device_object, optimizer=self.optimizer)
+            else:
+                # One ICSP command per primitive
+                self.device_proxy = PrimitiveFunctionEmbedded(self.device_object)
 
         elif isinstance(tool, PrinterTool):
             # Use this mode to display primitive strings
@@ -88,9 +128,27 @@ class PythonScriptedPicDebugger(CmsisAtiPicDebugger):
             # Controller object for interfacing with the debugger tool
             self.logger.info("Creating primitive controller")
             self.controller = PrimitiveController(self.transport)
+            self.controller.data_buffer_size = self.options['ati_data_buffer_size']
+
+            self.optimizer = self._create_optimizer()
+
+            # Compiled sequences are kept for the whole session, only addresses are patched from call to call
+            if self.options.get('sequence_cache', True):
+                self.sequence_cache = PrimitiveSequenceCache()
+                # Sequences compiled ahead of time are shipped with the pack; anything else is compiled on first use.
+                # The bundle is compiled the way sessions compile by default, without the peephole optimizer.
+                if self.options.get('sequence_bundle', True) and self.optimizer is None:
+                    try:
+                        load_bundle(self.sequence_cache, self.device_model)
+                    except Exception as error:
+                        self.logger.warning("Unable to load sequence bundle: %s", error)
+            else:
+                self.sequence_cache = None
 
             # Use this mode to accumulate primitives, compress them, then execute them on a remote USB host
-            self.device_proxy = PrimitiveFunctionAccumulatorExecuter(self.device_object, self.controller)
+            self.device_proxy = PrimitiveFunctionAccumulatorExecuter(self.device_object, self.controller,
+                                                                     sequence_cache=self.sequence_cache,
+                                                                     optimizer=self.optimizer)
 
             # Instantiate the debug executive driver
             # Debug is currently only available when using remote USB primitive execution (ie: transport exists)
@@ -98,7 +156,21 @@ class PythonScriptedPicDebugger(CmsisAtiPicDebugger):
             self.debug_executive_object = self.device_model.DEBUGGING_INTERFACE()
 
             self.debug_executive_proxy = PrimitiveFunctionAccumulatorExecuter(self.debug_executive_object,
-                                                                          self.controller)
+                                                                          self.controller,
+                                                                          sequence_cache=self.sequence_cache,
+                                                                          optimizer=self.optimizer)
+
+        self._instrument_session()
+
+    def _create_optimizer(self):
+        """
+        Creates the peephole optimizer which removes redundant primitives from sequences before loops are rolled
+        :return: PrimitivePeepholeOptimizer, or None unless the session options turn it on
+        """
+        if not self.options.get('peephole_optimizer', False):
+            return None
+        return PrimitivePeepholeOptimizer(address_counter_model(self.device_object),
+                                          verify=self.options.get('peephole_verify', False))
 
     def set_debug_exec(self, byte_address, data):
         """
@@ -116,19 +188,22 @@ class PythonScriptedPicDebugger(CmsisAtiPicDebugger):
         if self._in_tmod:
             return
 
+        transaction = self.device_proxy.transaction()
         # Set ICSP clock frequency
-        self.device_proxy.invoke(self.device_model.set_speed)
+        transaction.invoke(self.device_model.set_speed)
 
         # Enter TMOD
-        self.device_proxy.invoke(self.device_model.enter_tmod)
+        transaction.invoke(self.device_model.enter_tmod)
 
         # Read ID for good measure
-        result = self.device_proxy.invoke_read(bytes_to_read=2, method=self.device_model.read_id)
+        read_id = transaction.invoke_read(bytes_to_read=2, method=self.device_model.read_id)
+        result = transaction.execute()[read_id]
         device_id = binary.unpack_le16(result)
 
         self.logger.info("Device ID read: {0:04X}".format(device_id & 0xFFFF))
         if device_id == 0x0000 or device_id == 0xFFFF:
             self.logger.error("Suspect device ID read")
+        self.device_id = device_id
         self._in_tmod = True
 
     def read_id(self):
@@ -152,6 +227,8 @@ class PythonScriptedPicDebugger(CmsisAtiPicDebugger):
         if not self._in_tmod:
             return
 
+        self._flush_config_space_writes()
+
         # Exit TMOD
         self.device_proxy.invoke(self.device_model.exit_tmod)
 
@@ -163,25 +240,9 @@ class PythonScriptedPicDebugger(CmsisAtiPicDebugger):
         :param byte_address: start address
         :param numbytes: number of bytes
         """
-        # Gather chunks
         result = bytearray()
-
-        # TODO - read granularity from tool
-        chunk_size = 0x100
-
-        # Loop until done
-        while numbytes > 0:
-            # Handle leftovers
-            if chunk_size > numbytes:
-                chunk_size = numbytes
-            # Read
-            chunk = self._read_flash_block(byte_address, chunk_size)
-            # Word address increment
-            byte_address += chunk_size
-            numbytes -= chunk_size
-            # Append to results
+        for _, chunk in self.iter_read(self.MEMTYPE_FLASH, byte_address, numbytes):
             result.extend(chunk)
-
         return result
 
     def read_config_memory(self, byte_address, numbytes):
@@ -190,21 +251,14 @@ class PythonScriptedPicDebugger(CmsisAtiPicDebugger):
         :param byte_address: start address
         :param numbytes: number of bytes
         """
-        # Gather chunks
-        result = bytearray()
-
         # Word count, make sure we read the complete word(s) in case somebody asks for an odd number of bytes
         words = (numbytes + 1) // 2
-        # Loop until done
-        while words > 0:
-            self.logger.info("Read config word ({0:d} bytes) at 0x{1:02X}".format(numbytes, byte_address))
-            # Invoke read by proxy, reading one word at a time
-            chunk = self.device_proxy.invoke_read(bytes_to_read=2, method=self.device_model.read_config_word,
-                                                  byte_address=int(byte_address))
-            words -= 1
-            byte_address += 2
-            # Append to results
-            result.extend(chunk)
+        self.logger.info("Read config words ({0:d} bytes) at 0x{1:02X}".format(numbytes, byte_address))
+        self._flush_config_space_writes()
+        # Invoke read by proxy, reading all words in one go
+        result = bytearray(self.device_proxy.invoke_read(bytes_to_read=words * 2,
+                                                         method=self.device_model.read_config_memory,
+                                                         byte_address=int(byte_address), words=words))
 
         # Did anyone ask for an odd number of bytes? Remove the excess byte
         if numbytes%2 == 1:
@@ -218,26 +272,94 @@ class PythonScriptedPicDebugger(CmsisAtiPicDebugger):
         :param byte_address: start address
         :param numbytes: number of bytes
         """
-        # Gather chunks
         result = bytearray()
+        for _, chunk in self.iter_read(self.MEMTYPE_EEPROM, byte_address, numbytes):
+            result.extend(chunk)
+        return result
 
-        # TODO - read granularity from tool
-        chunk_size = 0x100
+    def iter_read(self, memtype, byte_address, numbytes):
+        """
+        Reads memory one chunk at a time, so that only the chunk being handled is held on the host.
+        Config memory is read in one go.
+        Closing the generator before the end is fine, a read still executing on the tool is waited for.
+        :param memtype: MEMTYPE_FLASH, MEMTYPE_CONFIG or MEMTYPE_EEPROM
+        :param byte_address: start address
+        :param numbytes: number of bytes
+        :return: generator of (byte address, memoryview of the data) per chunk
+        """
+        if memtype == self.MEMTYPE_CONFIG:
+            if numbytes > 0:
+                yield byte_address, memoryview(self.read_config_memory(byte_address, numbytes))
+            return
+        if memtype == self.MEMTYPE_FLASH:
+            description = "flash"
+            read_block = self._read_flash_block
+            method = self.device_model.read_flash
+            # Word count, make sure we read the complete word in case somebody asks for an odd number of bytes
+            arguments = lambda address, size: {'byte_address': int(address), 'words': (size + 1) // 2}
+        elif memtype == self.MEMTYPE_EEPROM:
+            description = "eeprom"
+            read_block = self._read_eeprom_block
+            method = self.device_model.read_eeprom
+            arguments = lambda address, size: {'byte_address': int(address), 'numbytes': size}
+        else:
+            raise Exception("Unknown memory type '{0}'".format(memtype))
+
+        # Chunk size picked for the tool when the session was set up
+        chunk_size = self.options['read_chunk_size']
+        ranges = self.read_ranges(byte_address, numbytes, chunk_size)
+
+        if self._overlapped_reads(numbytes, chunk_size):
+            self.logger.info("Read {0:s} ({1:d} bytes) at 0x{2:02X} (overlapped)".format(description, numbytes,
+                                                                                        byte_address))
+            chunks = [(size, arguments(address, size)) for address, size in ranges]
+            reads = self._iter_read_overlapped(self.device_proxy, method, chunks)
+            try:
+                index = 0
+                for data in reads:
+                    yield ranges[index][0], memoryview(bytearray(data))
+                    index += 1
+            finally:
+                # Jython does not close generators as soon as they are dropped
+                reads.close()
+            return
 
-        # Loop until done
-        while numbytes > 0:
-            # Handle leftovers
-            if chunk_size > numbytes:
-                chunk_size = numbytes
-            # Read
-            chunk = self._read_eeprom_block(byte_address, chunk_size)
-            # Word address increment
-            byte_address += chunk_size
-            numbytes -= chunk_size
-            # Append to results
-            result.extend(chunk)
+        for address, size in ranges:
+            yield address, memoryview(bytearray(read_block(address, size)))
 
-        return result
+    def read_into(self, memtype, byte_address, numbytes, buffer, offset=0):
+        """
+        Reads memory straight into a buffer the caller has allocated
+        :param memtype: MEMTYPE_FLASH, MEMTYPE_CONFIG or MEMTYPE_EEPROM
+        :param byte_address: start address
+        :param numbytes: number of bytes
+        :param buffer: bytearray (or Java byte[] from MPLAB X) to fill, at least offset + numbytes long
+        :param offset: index in the buffer of the byte read from byte_address
+        :return: number of bytes read into the buffer
+        """
+        if offset < 0 or offset + numbytes > len(buffer):
+            raise Exception("Buffer of {0:d} bytes can not take {1:d} bytes at offset {2:d}".format(len(buffer),
+                                                                                                 numbytes, offset))
+        written = 0
+        reads = self.iter_read(memtype, byte_address, numbytes)
+        try:
+            for address, chunk in reads:
+                start = offset + address - byte_address
+                # Odd reads may come back with the rest of the last word
+                size = min(len(chunk), numbytes - (address - byte_address))
+                written += bulk_copy(chunk[:size], buffer, start)
+        finally:
+            reads.close()
+        return written
+
+    def _overlapped_reads(self, numbytes, chunk_size):
+        """
+        Checks if a read is to be done with one chunk executing while the previous one is fetched
+        :param numbytes: number of bytes to read
+        :param chunk_size: size of each chunk
+        :return: True if the session options ask for it, and the read takes more than one chunk
+        """
+        return self.options.get('overlapped_reads', False) and self.controller is not None and numbytes > chunk_size
 
     def _read_flash_block(self, byte_address, numbytes):
         """
@@ -269,10 +391,8 @@ class PythonScriptedPicDebugger(CmsisAtiPicDebugger):
         :param byte_address: start address (byte address)
         :param data: data to write
         """
-
-        # ATI chunk is 512
-        # TODO: read out from ATI
-        chunk_size = 512
+        # Chunk size picked for the tool when the session was set up
+        chunk_size = self.options['eeprom_write_chunk_size']
 
         bytes_left = len(data)
 
@@ -310,62 +430,88 @@ class PythonScriptedPicDebugger(CmsisAtiPicDebugger):
         :param byte_address: start address (byte address)
         :param data: data to write
         """
-        if self.options['overlapped_usb_access']:
+        if self._differential_programming():
+            self._write_flash_block_differential(byte_address, data)
+        elif self.options.get('pipelined_verify', False) and self.controller is not None:
+            self._write_flash_block_overlapped(byte_address, data, verify=True)
+        elif self.options['overlapped_usb_access']:
             self._write_flash_block_overlapped(byte_address, data)
         else:
             self._write_flash_block(byte_address, data)
 
-    def _write_flash_block_overlapped(self, byte_address, data):
-        self.logger.info("Flash block write (overlapped)")
-        chunk_size = self.device_object.get_flash_write_row_size_bytes()
+    def _write_flash_block_overlapped(self, byte_address, data, verify=False):
+        """
+        Writes flash, sending the data of each page while the previous page is being written
+        :param byte_address:    byte address to start writing from
+        :param data:            data to write
+        :param verify:          read each page back in the same execution as it is written, and compare it while the
+                                next page is being written.  Stops at the first page which does not verify.
+        """
+        self.logger.info("Flash block write (overlapped%s)", ", verifying" if verify else "")
 
-        numbytes = len(data)
         data_buf_id = 0
-        if numbytes < chunk_size:
-            chunk_size = numbytes
-
-        # Send first data first
-        self.controller.write_data_buffer(data_buf_id, data[0:chunk_size])
-        # Start first page write
-        self.device_proxy.trigger_write(data_buffer_id=data_buf_id, method=self.device_model.write_flash_page,
-                                        byte_address=int(byte_address), words=chunk_size // 2)
-
-        # Shrink data
-        data = data[chunk_size:]
-        byte_address += chunk_size
-
-        # Loop
-        while data:
-            # Handle leftovers
-            if len(data) < chunk_size:
-                chunk_size = len(data)
-
-            # Buffer ID flip
-            data_buf_id = (data_buf_id + 1) % 2
-
+        # Buffer, address and data of the page being written
+        pending = None
+        for byte_address, chunk in self._flash_pages(byte_address, data):
             # Write next page's data
-            self.controller.write_data_buffer(data_buf_id, data[0:chunk_size])
+            self.controller.write_data_buffer(data_buf_id, chunk)
 
-            # Block while first one completes
-            self.device_proxy.wait_write_done()
+            if pending is not None:
+                # Block while the previous one completes
+                status = self.device_proxy.wait_write_done()
 
             # Trigger next
-            self.device_proxy.trigger_write(data_buffer_id=data_buf_id, method=self.device_model.write_flash_page,
-                                            byte_address=int(byte_address), words=chunk_size // 2)
+            if verify:
+                self.device_proxy.trigger_write_read_back(data_buffer_id=data_buf_id,
+                                                          write_method=self.device_model.write_flash_page,
+                                                          read_method=self.device_model.read_flash,
+                                                          byte_address=int(byte_address), words=len(chunk) // 2)
+            else:
+                self.device_proxy.trigger_write(data_buffer_id=data_buf_id, method=self.device_model.write_flash_page,
+                                                byte_address=int(byte_address), words=len(chunk) // 2)
 
-            # TODO - check results
-            # if function_retval[0] != 0x01:
-            #    logging.error("Flash write FAILED! Return value was not True")
-            #    sys.exit(1)
+            # TODO - check results of unverified writes
+            if pending is not None and verify:
+                # The previous page is read out and compared while this one is written
+                self._check_page_read_back(pending, status)
 
-            # Increment byte address
-            byte_address += chunk_size
+            pending = (data_buf_id, byte_address, chunk)
 
-            # Shrink data
-            data = data[chunk_size:]
+            # Buffer ID flip
+            data_buf_id = (data_buf_id + 1) % 2
 
         # Wait for last chunk
-        self.device_proxy.wait_write_done()
+        if pending is not None:
+            status = self.device_proxy.wait_write_done()
+            if verify:
+                self._check_page_read_back(pending, status, in_flight=False)
+
+    def _check_page_read_back(self, page, status, in_flight=True):
+        """
+        Compares a page read back after writing it with the data written
+        :param page: tuple of data buffer ID holding the read back, page byte address and data written
+        :param status: response of the execution which wrote and read back the page
+        :param in_flight: another execution has been triggered, and has to be waited for before giving up
+        """
+        data_buf_id, byte_address, expected = page
+        numbytes = (len(expected) // 2) * 2
+        # The read back is the second block of the execution
+        statuscode = binary.unpack_le32(status[4:8])
+        read_back = None
+        if statuscode == 0:
+            read_back = self.controller.read_data_buffer(data_buf_id, numbytes)
+            if bytearray(read_back) == bytearray(expected[:numbytes]):
+                return
+        if in_flight:
+            self.device_proxy.wait_write_done()
+        if read_back is None:
+            raise Exception("Flash verify failed, unable to read back page at 0x{0:04X} (status 0x{1:08X})".format(
+                byte_address, statuscode))
+        for i in range(numbytes):
+            if expected[i] != read_back[i]:
+                self.logger.error("Flash verify error at 0x%04X (wrote 0x%02X; read 0x%02X)", byte_address + i,
+                                  expected[i], read_back[i])
+                raise Exception("Flash verify failed at 0x{0:04X}".format(byte_address + i))
 
     @staticmethod
     def chunks(data, chunk_size):
@@ -382,51 +528,177 @@ class PythonScriptedPicDebugger(CmsisAtiPicDebugger):
         :param data:            data to write
         """
         self.logger.info("Flash block write")
-        pagebytes = self.device_object.get_flash_write_row_size_bytes()
+        for byte_address, chunk in self._flash_pages(byte_address, data):
+            self.logger.info("Writing a page at byte address 0x%04X", int(byte_address))
+            self._write_flash_page(byte_address, chunk)
 
+    def _flash_pages(self, byte_address, data):
+        """
+        Splits data into flash pages to write, leaving out runs of blank pages if the session options say so
+        :param byte_address:    byte address of the data
+        :param data:            data to write
+        :return: generator of (byte address, page data)
+        """
+        pagebytes = self.device_object.get_flash_write_row_size_bytes()
+        # TODO: not all PICs can just skip pages by leaving them out.
         skip_blank_pages = self.options['skip_blank_pages']
+        for offset, numbytes, blank in BlankPageMap(self.blank_detector, data, pagebytes).runs():
+            if blank and skip_blank_pages:
+                self.logger.info("Skipping %d blank page(s) at byte address 0x%04X",
+                                 (numbytes + pagebytes - 1) // pagebytes, byte_address + offset)
+                continue
+            for page_offset in range(offset, offset + numbytes, pagebytes):
+                yield byte_address + page_offset, data[page_offset:page_offset + pagebytes]
+
+    def _differential_programming(self):
+        """
+        Differential programming leaves flash rows which already hold the data to be programmed alone.
+        It is enabled by the 'differential_programming' session option, and is off unless asked for.  Erases are
+        always carried out as asked for: the shadow only tells which rows would be written with what they already hold.
+        """
+        return self.options.get('differential_programming', False)
+
+    def _get_flash_shadow(self):
+        """
+        Gets the shadow of the flash content of the device, loading it if there is one on file
+        :return: FlashShadow object
+        """
+        if self.flash_shadow is None:
+            filename = None
+            directory = self.options.get('shadow_directory', DEFAULT_SHADOW_DIRECTORY)
+            if directory and self.device_id is not None:
+                filename = FlashShadow.filename_for(directory, self.tool_serial, self.device_id)
+            self.flash_shadow = FlashShadow(self.device_object.get_flash_write_row_size_bytes(), filename)
+            if self.flash_shadow.load():
+                self._spot_check_flash_shadow()
+        return self.flash_shadow
+
+    def _spot_check_flash_shadow(self):
+        """
+        Reads one row which the shadow knows back from the device.
+        Another tool (or the application itself) may have changed flash since the shadow was saved; if the row does
+        not match, the shadow is not trusted at all.
+        """
+        shadow = self.flash_shadow
+        rows = shadow.known_rows()
+        if rows:
+            byte_address = rows[len(rows) // 2]
+            expected = shadow.get_row(byte_address)
+            matches = bytearray(self.read_flash_memory(byte_address, len(expected))) == expected
+        elif shadow.complete:
+            byte_address = 0
+            matches = self.blank_detector.is_blank(self.read_flash_memory(byte_address, shadow.row_size))
+        else:
+            return
+        if not matches:
+            self.logger.warning("Flash row at 0x%04X does not match the flash shadow, discarding it", byte_address)
+            shadow.discard()
+
+    def _write_flash_block_differential(self, byte_address, data):
+        """
+        Writes flash, skipping rows which already hold the data.
+        Each row is compared to the flash shadow, or to the device itself if the shadow does not know the row.  Rows
+        which differ are erased (unless already blank) and written (unless the new content is blank).
+        :param byte_address:    byte address to start writing from
+        :param data:            data to write
+        """
+        self.logger.info("Flash block write (differential)")
+        shadow = self._get_flash_shadow()
+        pagebytes = shadow.row_size
+
+        # Rows the shadow does not know are read back, all in one go
+        read_back = None
+        for address in range(byte_address, byte_address + len(data), pagebytes):
+            if shadow.get_row(address) is None:
+                read_back = self.read_flash_memory(byte_address, len(data))
+                break
+
+        rows = 0
+        changed = 0
         for chunk in self.chunks(data, pagebytes):
-            # TODO: not all PICs can just skip pages by leaving them out.
-            if not skip_blank_pages or not is_blank(chunk):
-                self.logger.info("Writing a page at byte address 0x%04X", int(byte_address))
-                self._write_flash_page(byte_address, chunk)
+            chunk = bytearray(chunk)
+            previous = shadow.get_row(byte_address)
+            if previous is None:
+                offset = rows * pagebytes
+                previous = bytearray(read_back[offset:offset + len(chunk)])
+            rows += 1
+            if previous == chunk:
+                self.logger.debug("Row at byte address 0x%04X is unchanged", byte_address)
             else:
-                self.logger.info("Skipping a page at byte address 0x%04X", byte_address)
+                changed += 1
+                if previous and not self.blank_detector.is_blank(previous):
+                    self.logger.info("Erasing a row at byte address 0x%04X", byte_address)
+                    self._erase_flash_row(byte_address)
+                if self.blank_detector.is_blank(chunk):
+                    shadow.erase_row(byte_address)
+                else:
+                    self.logger.info("Writing a page at byte address 0x%04X", byte_address)
+                    self._write_flash_page(byte_address, chunk)
+                    shadow.set_row(byte_address, chunk)
             # Increment address
             byte_address += pagebytes
+        self.logger.info("Differential write: %d of %d rows changed", changed, rows)
 
-    def _write_flash_page(self, byte_address, data):
+    def _erase_flash_row(self, byte_address):
         """
-        Write a single flash page
-        :param byte_address:    page start byte address
-        :param data:            data bytearray to program
+        Erase a single flash row
+        :param byte_address:    row start byte address
         """
-        self.logger.debug("Flash page write")
+        self._forget_debug_exec_in(byte_address, self.device_object.get_flash_write_row_size_bytes())
+        self.device_proxy.invoke(self.device_model.erase_row, byte_address=int(byte_address))
 
-        # Word count
-        words = len(data) // 2
+    def _finish_differential_programming(self):
+        """
+        Saves the flash shadow at the end of the operation
+        """
+        if self.flash_shadow is not None:
+            self.flash_shadow.save()
+        self.flash_shadow = None
 
-        # Invoke write by proxy
-        self.device_proxy.invoke_write(data_to_write=data, method=self.device_model.write_flash_page,
-                                       byte_address=byte_address, words=int(words))
-        # TODO - check result
+    def _invalidate_flash_shadow(self, byte_address, numbytes):
+        """
+        Flash has been changed outside of programming, so the shadow can no longer be trusted for the rows affected
+        :param byte_address: start address
+        :param numbytes: number of bytes changed
+        """
+        if not self.options.get('differential_programming', False) or self.device_id is None:
+            return
+        shadow = self._get_flash_shadow() if self._in_tmod else self.flash_shadow
+        if shadow is None:
+            # Not able to read flash just now, so the shadow on file goes altogether
+            directory = self.options.get('shadow_directory', DEFAULT_SHADOW_DIRECTORY)
+            if directory:
+                FlashShadow(self.device_object.get_flash_write_row_size_bytes(),
+                            FlashShadow.filename_for(directory, self.tool_serial, self.device_id)).discard()
+            return
+        shadow.forget(byte_address, numbytes)
+        shadow.save()
 
-    def _write_de_page(self, byte_address, data):
+    def _memory_unchanged(self, byte_address, data):
+        """
+        Checks if config or user id memory already holds the given data
+        :param byte_address: start address (byte address)
+        :param data: data to compare
+        """
+        words = len(data) // 2
+        current = self.read_config_memory(byte_address, words * 2)
+        return bytearray(current) == bytearray(data[:words * 2])
+
+    def _write_flash_page(self, byte_address, data):
         """
         Write a single flash page
         :param byte_address:    page start byte address
         :param data:            data bytearray to program
         """
-        self.logger.debug("DE page write")
+        self.logger.debug("Flash page write")
 
         # Word count
         words = len(data) // 2
 
         # Invoke write by proxy
-        self.device_proxy.invoke_write(data_to_write=data, method=self.device_model.write_de_page,
-                                       byte_address=int(byte_address), words=int(words))
-
-        # TODO - result check
+        self.device_proxy.invoke_write(data_to_write=data, method=self.device_model.write_flash_page,
+                                       byte_address=byte_address, words=int(words))
+        # TODO - check result
 
     def _write_de_block(self, byte_address, data):
         """
@@ -437,11 +709,16 @@ class PythonScriptedPicDebugger(CmsisAtiPicDebugger):
         self.logger.info("DE block write")
         pagebytes = self.device_object.get_flash_write_row_size_bytes()
 
+        # All pages in one pass, in as few executions as they fit in
+        transaction = AddressOrderedTransaction(self.device_proxy)
         for chunk in self.chunks(data, pagebytes):
             self.logger.info("Writing a page at byte address 0x%04X", byte_address)
-            self._write_de_page(byte_address, chunk)
+            transaction.invoke_write(data_to_write=chunk, method=self.device_model.write_de_page,
+                                     byte_address=int(byte_address), words=len(chunk) // 2)
             # Increment address
             byte_address += pagebytes
+        transaction.execute()
+        # TODO - result check
 
     def _verify_flash_block(self, byte_address, data, silent_early_exit=False):
         """
@@ -451,6 +728,8 @@ class PythonScriptedPicDebugger(CmsisAtiPicDebugger):
         read_back = self.read_flash_memory(byte_address, len(data))
 
         self.logger.info("Verifying flash")
+        if bytearray(read_back[:len(data)]) == bytearray(data):
+            return True
         numerrors = 0
         for i in range(len(data)):
             if data[i] != read_back[i]:
@@ -467,21 +746,76 @@ class PythonScriptedPicDebugger(CmsisAtiPicDebugger):
             return False
         return True
 
-    def _write_config_word(self, byte_address, data):
+    def _compare_memory(self, memtype, byte_address, expected, description):
         """
-        Write config words
+        Compares memory with the data expected in it, stopping at the first difference.
+        The memory is streamed, so only one chunk of it is held at a time.
+        :param memtype: MEMTYPE_FLASH, MEMTYPE_CONFIG or MEMTYPE_EEPROM
+        :param byte_address: start address
+        :param expected: bytearray of data expected
+        :param description: name of the memory, for logging
+        :return: True if all data matches
+        """
+        reads = self.iter_read(memtype, byte_address, len(expected))
+        try:
+            for address, data in reads:
+                offset = address - byte_address
+                chunk = expected[offset:offset + len(data)]
+                read_back = bytearray(data)[:len(chunk)]
+                if chunk == read_back:
+                    continue
+                index = first_difference(chunk, read_back)
+                if index is not None:
+                    self.logger.error("%s error at 0x%04X (expected 0x%02X; read 0x%02X)", description,
+                                      address + index, chunk[index], read_back[index])
+                    return False
+        finally:
+            reads.close()
+        return True
+
+    def verify_flash_memory(self, byte_address, data):
         """
-        self.logger.debug("Writing config word")
-        self.device_proxy.invoke_write(data_to_write=data, method=self.device_model.write_config_word,
-                                       byte_address=byte_address)
+        Verify flash memory
+        :param byte_address: start address
+        :param data: data expected
+        :return: True if flash holds the data
+        """
+        return self._compare_memory(self.MEMTYPE_FLASH, byte_address, as_bytearray(data), "Flash verify")
 
-    def _write_user_id_word(self, byte_address, data):
+    def verify_config_memory(self, byte_address, data):
         """
-        Write user_id word
+        Verify config memory
+        :param byte_address: start address
+        :param data: data expected
+        :return: True if config memory holds the data
         """
-        self.logger.debug("Writing user_id word")
-        self.device_proxy.invoke_write(data_to_write=data, method=self.device_model.write_user_id_word,
-                                       byte_address=byte_address)
+        return self._compare_memory(self.MEMTYPE_CONFIG, byte_address, as_bytearray(data), "Config verify")
+
+    def verify_eeprom_memory(self, byte_address, data):
+        """
+        Verify eeprom memory
+        :param byte_address: start address
+        :param data: data expected
+        :return: True if eeprom holds the data
+        """
+        return self._compare_memory(self.MEMTYPE_EEPROM, byte_address, as_bytearray(data), "EEPROM verify")
+
+    def blank_check(self):
+        """
+        Checks that flash and EEPROM are erased.
+        Config words are not checked, their erased value depends on which bits are implemented.
+        :return: True if the device is blank
+        """
+        device = self.device_object
+        erased_flash = self.blank_detector.blank(device.FLASH_SIZE_BYTES)
+        if not self._compare_memory(self.MEMTYPE_FLASH, 0, erased_flash, "Flash blank check"):
+            return False
+        if device.EEPROM_SIZE_BYTES:
+            erased_eeprom = bytearray([0xFF]) * device.EEPROM_SIZE_BYTES
+            if not self._compare_memory(self.MEMTYPE_EEPROM, device.EEPROM_ADDRESS_B, erased_eeprom,
+                                        "EEPROM blank check"):
+                return False
+        return True
 
     def erase(self, byte_address=None):
         """
@@ -489,8 +823,27 @@ class PythonScriptedPicDebugger(CmsisAtiPicDebugger):
         :param byte_address: address for the (bulk) erase, see programming spec for the target device for info on which
         memory sections will be erased
         """
+        self._bulk_erase(byte_address)
+
+    def _bulk_erase(self, byte_address=None):
+        """
+        Bulk erase
+        :param byte_address: address for the bulk erase, None for the default
+        """
+        # Writes put off so far were asked for before the erase
+        self._flush_config_space_writes()
+        if self._differential_programming():
+            # The shadow on file has to follow the erase, or the next operation would find it out of date
+            self._get_flash_shadow()
+        # Program memory is erased whatever the address, the DE included
+        self._forget_debug_exec()
         # Use address if provided
         self.device_proxy.invoke(self.device_model.bulk_erase, byte_address=byte_address)
+        if self.flash_shadow is not None:
+            if byte_address is None:
+                self.flash_shadow.erase_all()
+            else:
+                self.flash_shadow.forget()
 
     def erase_de_memory(self, address, words):
         """
@@ -500,6 +853,7 @@ class PythonScriptedPicDebugger(CmsisAtiPicDebugger):
         """
         # Generate a command to execute
         self.logger.debug("Erase DE at address 0x%X", address)
+        self._forget_debug_exec()
         self.device_proxy.invoke(self.device_model.erase_de, byte_address=int(address), words=int(words))
 
     def write_config_memory(self, byte_address, data):
@@ -508,11 +862,20 @@ class PythonScriptedPicDebugger(CmsisAtiPicDebugger):
         :param byte_address: start address (byte address)
         :param data: data to write
         """
-        for i in range(len(data) // 2):
-            values = data[i * 2:i * 2 + 2]
-            self.logger.info("Writing one config word at 0x{:02X}".format(byte_address + i * 2))
-            self.logger.info("0x{:02X} 0x{:02X}".format(values[0], values[1]))
-            self._write_config_word(byte_address + i * 2, values)
+        if self._differential_programming():
+            if self._memory_unchanged(byte_address, data):
+                self.logger.info("Config words at 0x{0:02X} are unchanged".format(byte_address))
+                return
+        words = len(data) // 2
+        self.logger.info("Writing {0:d} config words at 0x{1:02X}".format(words, byte_address))
+        self.logger.debug("Config words: %s", " ".join("0x{:02X}".format(value) for value in data[:words * 2]))
+        if self._walks_to_address():
+            self._config_space_writes.append((self.device_model.write_config_memory, byte_address, data[:words * 2]))
+            return
+        # All words in one buffer, written by one sequence
+        self.device_proxy.invoke_write(data_to_write=data[:words * 2],
+                                       method=self.device_model.write_config_memory,
+                                       byte_address=int(byte_address), words=words)
 
     def write_user_id_memory(self, byte_address, data):
         """
@@ -520,22 +883,59 @@ class PythonScriptedPicDebugger(CmsisAtiPicDebugger):
         :param byte_address: start address (byte address)
         :param data: data to write
         """
-        for i in range(len(data) // 2):
-            values = data[i * 2:i * 2 + 2]
-            self.logger.info("Writing one user id word at 0x{:02X}".format(byte_address + i * 2))
-            self.logger.info("0x{:02X} 0x{:02X}".format(values[0], values[1]))
-            self._write_user_id_word(byte_address + i * 2, values)
+        if self._differential_programming():
+            if self._memory_unchanged(byte_address, data):
+                self.logger.info("User id words at 0x{0:02X} are unchanged".format(byte_address))
+                return
+        words = len(data) // 2
+        self.logger.info("Writing {0:d} user id words at 0x{1:02X}".format(words, byte_address))
+        self.logger.debug("User id words: %s", " ".join("0x{:02X}".format(value) for value in data[:words * 2]))
+        if self._walks_to_address():
+            self._config_space_writes.append((self.device_model.write_user_id_memory, byte_address,
+                                              data[:words * 2]))
+            return
+        # All words in one buffer, written by one sequence
+        self.device_proxy.invoke_write(data_to_write=data[:words * 2],
+                                       method=self.device_model.write_user_id_memory,
+                                       byte_address=int(byte_address), words=words)
+
+    def _walks_to_address(self):
+        """
+        Checks if the device model moves its address pointer by walking to each address.
+        Config and user id writes for such devices are put off until the end of the operation (or until something
+        else needs config space first), and then done in one pass by ascending address.
+        :return: True if the device model tracks its address pointer with a cursor
+        """
+        return isinstance(getattr(self.device_object, 'cursor', None), AddressCursor)
+
+    def _flush_config_space_writes(self):
+        """
+        Does the config and user id writes put off so far, in one pass by ascending address
+        """
+        if not self._config_space_writes:
+            return
+        writes = self._config_space_writes
+        self._config_space_writes = []
+        transaction = AddressOrderedTransaction(self.device_proxy)
+        for method, byte_address, data in writes:
+            transaction.invoke_write(data_to_write=data, method=method, byte_address=int(byte_address),
+                                     words=len(data) // 2)
+        transaction.execute()
 
     def start_programming_operation(self):
         """
         Start programming
         """
         self.enter_tmod()
+        # The shadow is loaded afresh for each operation, the device may have been swapped in between
+        self.flash_shadow = None
 
     def end_of_operations(self):
         """
         Done programming
         """
+        if self._differential_programming():
+            self._finish_differential_programming()
         self.exit_tmod()
 
     def init_debug_session(self, program_de=True):
@@ -543,6 +943,7 @@ class PythonScriptedPicDebugger(CmsisAtiPicDebugger):
         Start a debug session
         """
         self.logger.info("Entering debug mode")
+        de_cached = False
 
         # Program the DE
         if program_de:
@@ -552,8 +953,12 @@ class PythonScriptedPicDebugger(CmsisAtiPicDebugger):
                 self.enter_tmod()
                 self.logger.info("Checking DE")
                 status = True
-                if self._verify_flash_block(self.debug_exec_address, self.debug_exec_data, silent_early_exit=True):
+                de_cached = self._debug_exec_cached()
+                if de_cached:
+                    self.logger.info("DE OK (verified in an earlier session)")
+                elif self._verify_flash_block(self.debug_exec_address, self.debug_exec_data, silent_early_exit=True):
                     self.logger.info("DE OK")
+                    self._remember_debug_exec()
                 else:
                     self.logger.info("Erasing DE")
                     self.erase_de_memory(self.debug_exec_address, len(self.debug_exec_data))
@@ -561,6 +966,8 @@ class PythonScriptedPicDebugger(CmsisAtiPicDebugger):
                     self._write_de_block(self.debug_exec_address, self.debug_exec_data)
                     self.logger.info("Verifying DE")
                     status = self._verify_flash_block(self.debug_exec_address, self.debug_exec_data)
+                    if status:
+                        self._remember_debug_exec()
                 self.exit_tmod()
                 if not status:
                     self.logger.error("DE verification failed!")
@@ -570,7 +977,15 @@ class PythonScriptedPicDebugger(CmsisAtiPicDebugger):
         self.device_proxy.invoke(self.device_model.enter_debug)
 
         # Try to read the DE version to check that things are ok
-        de_version = self.debug_read_de_version()
+        try:
+            de_version = self.debug_read_de_version()
+        except Exception:
+            if not de_cached:
+                raise
+            # Only a few rows of the DE were checked, so check all of it before giving up
+            self.logger.warning("DE not responding, verifying all of it")
+            self._forget_debug_exec()
+            return self.init_debug_session(program_de)
 
         # TODO: raise exception if debug exec did not respond as expected
 
@@ -641,6 +1056,7 @@ class PythonScriptedPicDebugger(CmsisAtiPicDebugger):
         :return:
         """
         self.logger.info("Erase mem at byte address %d", byte_address)
+        self._invalidate_flash_shadow(byte_address, self.device_object.get_flash_write_row_size_bytes())
 
         word_address = byte_address // 2
 
@@ -770,6 +1186,7 @@ class PythonScriptedPicDebugger(CmsisAtiPicDebugger):
         :param data: data to write
         """
         self.logger.info("Write flash of %d byte(s) to byte address %d", len(data), byte_address)
+        self._invalidate_flash_shadow(byte_address, len(data))
 
         word_address = byte_address // 2
 
@@ -800,8 +1217,8 @@ class PythonScriptedPicDebugger(CmsisAtiPicDebugger):
         # Gather chunks
         result = bytearray()
 
-        # TODO - read granularity from tool
-        chunk_size_words = 0x100 // 2
+        # Chunk size picked for the tool when the session was set up
+        chunk_size_words = self.options['debug_read_chunk_size'] // 2
 
         # Loop until done
         while words > 0:
@@ -841,8 +1258,8 @@ class PythonScriptedPicDebugger(CmsisAtiPicDebugger):
         # Gather chunks
         result = bytearray()
 
-        # TODO - read granularity from tool
-        chunk_size_words = 0x100 // 2
+        # Chunk size picked for the tool when the session was set up
+        chunk_size_words = self.options['debug_read_chunk_size'] // 2
 
         # Loop until done
         while words > 0:
@@ -877,8 +1294,8 @@ class PythonScriptedPicDebugger(CmsisAtiPicDebugger):
         # Gather chunks
         result = bytearray()
 
-        # TODO - read granularity from tool
-        chunk_size_bytes = 0x100
+        # Chunk size picked for the tool when the session was set up
+        chunk_size_bytes = self.options['debug_read_chunk_size']
 
         # Loop until done
         while numbytes > 0:
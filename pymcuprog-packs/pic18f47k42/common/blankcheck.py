@@ -0,0 +1,88 @@
+"""
+Blank (erased) flash detection
+"""
+
+
+def as_bytearray(data):
+    """
+    Converts data handed over by MPLAB into a bytearray
+    :param data: sequence of byte values, which may be signed
+    """
+    try:
+        return bytearray(data)
+    except (TypeError, ValueError):
+        return bytearray(value & 0xFF for value in data)
+
+
+class BlankDetector(object):
+    """
+    Recognises erased flash by comparing whole blocks with a cached erased page
+    """
+
+    def __init__(self, erased_word, page_size):
+        """
+        :param erased_word: bytearray holding one erased flash word as read back from the device
+        :param page_size: flash page size in bytes, the size most blocks checked will have
+        """
+        self.erased_word = bytearray(erased_word)
+        self._blank = bytearray()
+        self.blank(page_size)
+
+    def blank(self, numbytes):
+        """
+        Gets a block of erased flash
+        :param numbytes: size of the block
+        :return: bytearray of erased flash words
+        """
+        if numbytes > len(self._blank):
+            words = (numbytes + len(self.erased_word) - 1) // len(self.erased_word)
+            self._blank = self.erased_word * words
+        return self._blank[:numbytes]
+
+    def is_blank(self, data):
+        """
+        Checks if a block of flash memory is 'blank'
+        :param data: block starting at a flash word
+        :return: True if every byte has its erased value
+        """
+        if len(data) > len(self._blank):
+            self.blank(len(data))
+        if not isinstance(data, (bytes, bytearray)):
+            # Java byte[] from MPLAB X holds signed values
+            data = as_bytearray(data)
+        return data == self._blank[:len(data)]
+
+
+class BlankPageMap(object):
+    """
+    Which pages of an image are blank, worked out once so that writes and verifies can skip whole runs of them
+    """
+
+    def __init__(self, detector, data, page_size):
+        """
+        :param detector: BlankDetector for the device
+        :param data: image, starting at a page boundary
+        :param page_size: flash page size in bytes
+        """
+        self.page_size = page_size
+        self.size = len(data)
+        self.pages = [detector.is_blank(data[offset:offset + page_size]) for offset in range(0, len(data), page_size)]
+
+    def is_blank(self, page_index):
+        """
+        :param page_index: index of the page in the image
+        :return: True if the page is blank
+        """
+        return self.pages[page_index]
+
+    def runs(self):
+        """
+        Yields runs of pages which are all blank or all not
+        :return: generator of (offset, numbytes, blank)
+        """
+        start = 0
+        for index in range(1, len(self.pages) + 1):
+            if index == len(self.pages) or self.pages[index] != self.pages[start]:
+                offset = start * self.page_size
+                yield offset, min(index * self.page_size, self.size) - offset, self.pages[start]
+                start = index
@@ -19,6 +19,8 @@ from proginterfaceprovider import ProgInterfaceIcspC6D16
 from proginterfaceprovider import ProgInterfaceIcspC8D24
 # c) GEN4 wrapper
 from proginterfaceprovider import ProgInterfaceGen4
+# Devices which can not load their NVM address directly track it with a cursor
+from addresscursor import AddressCursor
 
 
 # These debug executive models are supported:
@@ -41,6 +43,14 @@ class PicDevice(object):
     # Default value for ICSP clock period. This default could be overridden in the pds files by overriding this attribute
     ICSP_CLOCK_PERIOD_NS = 200
 
+    # Flash words as read back, and their value when erased. These defaults could be overridden in the pds files
+    FLASH_WORD_BYTES = 2
+    FLASH_ERASED_WORD = 0xFFFF
+
+    # Devices without EEPROM leave these as they are
+    EEPROM_ADDRESS_B = None
+    EEPROM_SIZE_BYTES = 0
+
     def __init__(self):
         self.logger = logging.getLogger(__name__)
         self.hw = None
@@ -75,6 +85,12 @@ class PicDevice(object):
         """
         return self.FLASH_WRITE_BYTES_PER_PAGE
 
+    def get_flash_erased_word_bytes(self):
+        """
+        Returns an erased flash word as read back from the device, least significant byte first
+        """
+        return bytearray((self.FLASH_ERASED_WORD >> (8 * index)) & 0xFF for index in range(self.FLASH_WORD_BYTES))
+
     def get_config_start_address_byte(self):
         """
         Returns the first address of configuration memory for the device
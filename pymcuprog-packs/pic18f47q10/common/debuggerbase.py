@@ -4,12 +4,23 @@ Base class for PIC debugger over CMSIS (ATI)
 import logging
 import importlib
 
+from blankcheck import BlankDetector
+from executivecache import ExecutiveCache
+from executivecache import executive_key
+from executivecache import DEFAULT_EXECUTIVE_CACHE_FILE
+from instrumentation import Instrumentation
+
 # HID substitute for when operating in MPLAB
 from pyedbglib.mplabtransport.mplabtransport import MpLabTransport
 from pyedbglib.protocols.cmsisdap import CmsisDapUnit
+from pyedbglib.protocols.ati import ATI_DATA_BUFFER_SIZE
 
 from pyedbglib.protocols.housekeepingprotocol import Jtagice3HousekeepingProtocol
 
+# Used when the tool can not tell
+DEFAULT_PACKET_SIZE = 64
+DEFAULT_READ_CHUNK_SIZE = 0x100
+
 
 class CmsisAtiPicDebugger(object):
     """
@@ -46,16 +57,26 @@ class CmsisAtiPicDebugger(object):
         self.program_exec_data = None
         self.program_exec_version = None
 
+        # Identity of the tool and target, known once a session is set up and TMOD is entered
+        self.tool_serial = None
+        self.device_id = None
+
         # Objects start as None
         self.transport = None
         self.options = None
         self.device_model = None
         self.device_object = None
+        self.blank_detector = None
         self.device_proxy = None
         self.debug_executive_model = None
         self.debug_executive_object = None
         self.debug_executive_proxy = None
         self.controller = None
+        self.sequence_cache = None
+        self.optimizer = None
+        self.executive_cache = None
+        # Kept from session to session, so that statistics can be read after a session has ended
+        self.instrumentation = None
 
     def load_device_object(self, device_model):
         """
@@ -64,6 +85,165 @@ class CmsisAtiPicDebugger(object):
         """
         self.device_model = device_model
         self.device_object = device_model()
+        self.blank_detector = BlankDetector(self.device_object.get_flash_erased_word_bytes(),
+                                            self.device_object.get_flash_write_row_size_bytes())
+
+    def _get_executive_cache(self):
+        """
+        Gets the record of executives verified on devices, if the session options turn it on.
+        The record is kept in a file in the home directory unless 'de_cache_file' says otherwise, so it is off unless
+        the 'de_cache' option is set.
+        :return: ExecutiveCache object, or None
+        """
+        if not self.options.get('de_cache', False) or self.device_id is None:
+            return None
+        if self.executive_cache is None:
+            self.executive_cache = ExecutiveCache(self.options.get('de_cache_file', DEFAULT_EXECUTIVE_CACHE_FILE))
+        return self.executive_cache
+
+    def _debug_exec_cached(self):
+        """
+        Checks if the DE was verified on this device before, and spot-checks its first, middle and last rows.
+        Needs TMOD.
+        :return: True if the DE can be taken to be on the device without reading all of it back
+        """
+        cache = self._get_executive_cache()
+        if cache is None:
+            return False
+        key = executive_key(self.tool_serial, self.device_id, self.debug_exec_address, self.debug_exec_data)
+        if key not in cache:
+            return False
+        rowsize = self.device_object.get_flash_write_row_size_bytes()
+        last = ((len(self.debug_exec_data) - 1) // rowsize) * rowsize
+        middle = (last // 2) - (last // 2) % rowsize
+        for offset in sorted(set([0, middle, last])):
+            expected = bytearray(self.debug_exec_data[offset:offset + rowsize])
+            read_back = bytearray(self.read_flash_memory(self.debug_exec_address + offset, len(expected)))
+            if read_back != expected:
+                self.logger.info("DE spot check failed at 0x%X", self.debug_exec_address + offset)
+                cache.remove(key)
+                return False
+        return True
+
+    def _remember_debug_exec(self):
+        """
+        Records that the DE has been verified on this device
+        """
+        cache = self._get_executive_cache()
+        if cache is not None:
+            cache.add(executive_key(self.tool_serial, self.device_id, self.debug_exec_address, self.debug_exec_data))
+
+    def _forget_debug_exec(self):
+        """
+        Forgets any DE recorded for this device, when it may have been erased
+        """
+        cache = self._get_executive_cache()
+        if cache is not None:
+            cache.remove(executive_key(self.tool_serial, self.device_id, 0, bytearray()))
+
+    def _forget_debug_exec_in(self, byte_address, numbytes):
+        """
+        Forgets any DE recorded for this device if an erase covers some of it
+        :param byte_address: start of the area erased
+        :param numbytes: size of the area erased
+        """
+        if self.debug_exec_address is None or self.debug_exec_data is None:
+            # Where the DE is is not known, so it may be anywhere
+            self._forget_debug_exec()
+        elif byte_address < self.debug_exec_address + len(self.debug_exec_data) and \
+                self.debug_exec_address < byte_address + numbytes:
+            self._forget_debug_exec()
+
+    @staticmethod
+    def read_ranges(byte_address, numbytes, chunk_size):
+        """
+        Splits a read into chunks
+        :param byte_address: start address
+        :param numbytes: number of bytes
+        :param chunk_size: largest chunk
+        :return: list of (byte_address, numbytes), one per chunk
+        """
+        ranges = []
+        while numbytes > 0:
+            size = min(chunk_size, numbytes)
+            ranges.append((byte_address, size))
+            byte_address += size
+            numbytes -= size
+        return ranges
+
+    def _read_overlapped(self, proxy, method, chunks, unpack=None):
+        """
+        Reads chunks through two data buffers, see _iter_read_overlapped
+        :return: data of all chunks
+        """
+        result = bytearray()
+        for data in self._iter_read_overlapped(proxy, method, chunks, unpack):
+            result.extend(data)
+        return result
+
+    def _iter_read_overlapped(self, proxy, method, chunks, unpack=None):
+        """
+        Reads chunks through two data buffers: each chunk is fetched over USB while the next one executes on the tool.
+        A read still executing when the generator is closed is waited for.
+        :param proxy: proxy which can trigger reads (trigger_read, wait_read_done and read_triggered)
+        :param method: model method which reads one chunk
+        :param chunks: list of (bytes_to_read, kwargs for the method), one per chunk
+        :param unpack: function(data, kwargs) which extracts the data of a chunk from what was read, None to take it
+                       as it is
+        :return: generator of the data of each chunk, in order
+        """
+        data_buf_id = 0
+        # Buffer, size and arguments of the chunk executing
+        pending = None
+        in_flight = False
+        try:
+            for bytes_to_read, kwargs in chunks:
+                if pending is not None:
+                    # Block while the previous one completes
+                    in_flight = False
+                    proxy.wait_read_done()
+
+                # Trigger next
+                proxy.trigger_read(data_buf_id, method, **kwargs)
+                in_flight = True
+
+                previous = pending
+                pending = (data_buf_id, bytes_to_read, kwargs)
+
+                # Buffer ID flip
+                data_buf_id = (data_buf_id + 1) % 2
+
+                if previous is not None:
+                    # The previous chunk is fetched while this one executes
+                    yield self._fetch_read(proxy, previous, unpack)
+
+            # Wait for last chunk
+            if pending is not None:
+                in_flight = False
+                proxy.wait_read_done()
+                yield self._fetch_read(proxy, pending, unpack)
+        finally:
+            if in_flight:
+                # Nobody wants this read any more, but the tool has to be done with it before it can take another
+                try:
+                    proxy.wait_read_done()
+                except Exception as error:
+                    self.logger.debug("Read in flight failed as well: %s", error)
+
+    @staticmethod
+    def _fetch_read(proxy, chunk, unpack):
+        """
+        Fetches a chunk read by _iter_read_overlapped
+        :param proxy: proxy the read was triggered on
+        :param chunk: tuple of data buffer ID, bytes to read and method arguments
+        :param unpack: function extracting the data, or None
+        :return: data of the chunk
+        """
+        data_buf_id, bytes_to_read, kwargs = chunk
+        data = proxy.read_triggered(data_buf_id, bytes_to_read)
+        if unpack is not None:
+            data = unpack(data, kwargs)
+        return data
 
     def teardown_session(self):
         """
@@ -72,6 +252,10 @@ class CmsisAtiPicDebugger(object):
         # Flag as uninitialised to force a re-init
         self.logger.info("Tearing down nEDBG session...")
         self.initialised = False
+        if self.optimizer is not None:
+            self.optimizer.log_statistics()
+        if self.instrumentation is not None and self.options.get('instrumentation_report', False):
+            self.instrumentation.log_statistics()
 
     def setup_session(self, tool, options):
         """
@@ -88,6 +272,7 @@ class CmsisAtiPicDebugger(object):
         from debugprovider import PrinterTool
         if isinstance(tool, ConfigGeneratorTool) or isinstance(tool, EmbeddedTool) or isinstance(tool, PrinterTool):
             # TODO: make embedded execution a valid transport
+            self._negotiate_buffer_sizes()
             return
 
         # Initialise transport object
@@ -100,6 +285,7 @@ class CmsisAtiPicDebugger(object):
         cmsis_dap_debugger = CmsisDapUnit(self.transport)
         dap_info = cmsis_dap_debugger.dap_info()
         dap_device_name = dap_info['device_name']
+        self.tool_serial = dap_info['serial']
 
         # Log product info
         self.logger.info("Using CMSIS-DAP product %s (%s) with %s mounted", dap_info['product'], dap_info['serial'],
@@ -122,7 +308,8 @@ class CmsisAtiPicDebugger(object):
         """
         # Always do a transport init
         # Are we running standalone or inside MPLAB?
-        if type(tool_or_transport).__name__ == "CyHidApiTransport":
+        # (a SimulatedTransport from nedbgsim stands in for a real one)
+        if type(tool_or_transport).__name__ in ("CyHidApiTransport", "SimulatedTransport"):
             self.logger.info("Transport already initialised")
             self.transport = tool_or_transport
         else:
@@ -148,3 +335,87 @@ class CmsisAtiPicDebugger(object):
         voltage = hk.get_le16(hk.HOUSEKEEPING_CONTEXT_ANALOG, hk.HOUSEKEEPING_ANALOG_VTREF)
         self.logger.info("> Operating voltage: {0:0.2f}V".format(voltage / 1000.0))
 
+        # Size every transfer to what this tool can take
+        self._negotiate_buffer_sizes(hk)
+
+    def _instrument_session(self):
+        """
+        Instruments the layers of the session just set up, if the session options ask for it
+        """
+        if self.instrumentation is not None:
+            # The objects of the last session are done with
+            self.instrumentation.release()
+        if not self.options.get('instrumentation', False):
+            return
+        if self.instrumentation is None:
+            self.instrumentation = Instrumentation(self.options.get('instrumentation_history', 0))
+
+        controllers = []
+        for controller in [self.controller, getattr(self, 'prog_controller', None),
+                           getattr(self, 'debug_controller', None)]:
+            if controller is not None and controller not in controllers:
+                self.instrumentation.instrument_controller(controller)
+                controllers.append(controller)
+        for proxy in [self.device_proxy, self.debug_executive_proxy, getattr(self, 'prog_executive_proxy', None)]:
+            # Only proxies which compile sequences for a controller
+            if getattr(proxy, 'controller', None) is not None and hasattr(proxy, '_compile_sequence'):
+                self.instrumentation.instrument_accumulator(proxy)
+        self.instrumentation.instrument_debugger(self)
+
+    def _query_le16(self, housekeeping, context, offset):
+        """
+        Reads a 16-bit housekeeping parameter which not all tools provide
+        :return: parameter value, or None if the tool does not provide it
+        """
+        try:
+            return housekeeping.get_le16(context, offset)
+        except Exception as error:
+            self.logger.debug("Housekeeping parameter 0x%02X:0x%02X not available (%s)", context, offset, error)
+            return None
+
+    def _negotiate_buffer_sizes(self, housekeeping=None):
+        """
+        Picks the USB packet size and ATI data buffer size for the session, and from them the chunk size of each
+        operation.  All are put in the session options; values already there are kept, so they can be forced.
+        :param housekeeping: housekeeping protocol of the connected tool, None if there is no tool
+        """
+        packet_size = DEFAULT_PACKET_SIZE
+        buffer_size = ATI_DATA_BUFFER_SIZE
+        read_chunk_size = DEFAULT_READ_CHUNK_SIZE
+        if self.transport:
+            packet_size = self.transport.get_report_size()
+        if housekeeping is not None:
+            endpoint_size = self._query_le16(housekeeping, housekeeping.HOUSEKEEPING_CONTEXT_USB,
+                                             housekeeping.HOUSEKEEPING_USB_EP_SIZE_HID)
+            if endpoint_size and endpoint_size != packet_size:
+                # Standalone HID transports only guess the report size from the product ID
+                if getattr(self.transport, 'device', None) is not None:
+                    self.logger.info("Using HID report size of %d bytes reported by the tool", endpoint_size)
+                    self.transport.device.set_packet_size(endpoint_size)
+                    packet_size = endpoint_size
+            # ATI has no buffer size query, so the largest USB block the tool moves in one buffer transfer is taken
+            # to be the size of its buffers, larger or smaller than the default
+            max_read = self._query_le16(housekeeping, housekeeping.HOUSEKEEPING_CONTEXT_USB,
+                                        housekeeping.HOUSEKEEPING_USB_MAX_READ)
+            max_write = self._query_le16(housekeeping, housekeeping.HOUSEKEEPING_CONTEXT_USB,
+                                         housekeeping.HOUSEKEEPING_USB_MAX_WRITE)
+            if max_read and max_write and min(max_read, max_write) >= packet_size:
+                buffer_size = min(max_read, max_write)
+                # Reads are done in whole words
+                read_chunk_size = buffer_size & ~1
+
+        if self.options is None:
+            self.options = {}
+        self.options.setdefault('ati_packet_size', packet_size)
+        self.options.setdefault('ati_data_buffer_size', buffer_size)
+        if self.options['ati_data_buffer_size'] != buffer_size:
+            # Forced buffer size
+            buffer_size = self.options['ati_data_buffer_size']
+            read_chunk_size = buffer_size & ~1
+        self.options.setdefault('read_chunk_size', read_chunk_size)
+        self.options.setdefault('eeprom_write_chunk_size', buffer_size)
+        # The debug executive is only known to serve 0x100 bytes per request
+        self.options.setdefault('debug_read_chunk_size', min(buffer_size, 0x100) & ~1)
+        self.logger.info("> Packet size: %d bytes, ATI data buffer: %d bytes", self.options['ati_packet_size'],
+                         self.options['ati_data_buffer_size'])
+
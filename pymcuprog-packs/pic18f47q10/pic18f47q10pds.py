@@ -25,6 +25,12 @@ class DeviceDefinition(PicDevice):
 
     # Flash properties for this device
     FLASH_WRITE_BYTES_PER_PAGE = 128
+    FLASH_SIZE_BYTES = 0x20000
+    FLASH_ERASED_WORD = 0xFFFF
+
+    # EEPROM properties for this device
+    EEPROM_ADDRESS_B = 0x310000
+    EEPROM_SIZE_BYTES = 1024
 
     # ICSP programming command-set for this device. Commands from programming spec.
     LOAD_PC_COMMAND = 0x80
@@ -36,6 +42,14 @@ class DeviceDefinition(PicDevice):
     PROGRAM_DATA_INC_COMMAND = 0xE0
     INCREMENT_ADDRESS_COMMAND = 0xF8
 
+    # How the commands above move the PC, used by the peephole optimizer to drop redundant LOAD_PC commands within a
+    # sequence.  The optimizer is off unless the session option 'peephole_optimizer' turns it on.
+    PC_INCREMENT_COMMANDS = (READ_DATA_NVM_INC_COMMAND, PROGRAM_DATA_INC_COMMAND)
+    PC_STATIC_COMMANDS = (READ_DATA_NVM_COMMAND, PROGRAM_DATA_COMMAND)
+    # Program memory and user IDs are accessed by word, EEPROM and config by byte
+    PC_WORD_STEP = 2
+    PC_BYTE_STEP = 1
+
     # Extra commands for DE access
     MAE_COMMAND = 0xC4
     MAE_IEDE = 0x006355
@@ -126,6 +140,18 @@ class DeviceDefinition(PicDevice):
         self.prog.command(self.BULK_ERASE_COMMAND)
         self.board.delay_ms(self.BULK_ERASE_DELAY_MS)
 
+    def erase_row(self, byte_address):
+        """
+        Erases one flash row
+        :param byte_address: start address of the row to erase
+        """
+        # Set the address of the row
+        self.prog.command(self.LOAD_PC_COMMAND)
+        self.prog.payload(byte_address)
+        # Internally timed erase command
+        self.prog.command(self.SECTOR_ERASE_COMMAND)
+        self.board.delay_us(self.ROW_ERASE_DELAY_US)
+
     def write_flash_page(self, byte_address, words):
         """
         Write one flash page to the PIC. This device has no page buffer/data latches so flash is written one word at a time.
@@ -196,6 +222,49 @@ class DeviceDefinition(PicDevice):
         # Wait for the word to be programmed
         self.board.delay_us(self.USER_ID_PROGRAMMING_DELAY_US)
 
+    def read_config_memory(self, byte_address, words):
+        """
+        Reads a block of config words from config space.
+        :param byte_address: address of the first word
+        :param words: number of words to read
+        Data is sent indirectly to the data buffer
+        """
+        self.read_flash(byte_address, words)
+
+    def write_config_memory(self, byte_address, words):
+        """
+        Writes a block of words to the config space
+        :param byte_address: byte address of the first word
+        :param words: number of words to write
+        Data is taken indirectly from the data buffer
+        """
+        # Set the address to write to
+        self.prog.command(self.LOAD_PC_COMMAND)
+        self.prog.payload(byte_address)
+        # Loop through range, writing words with post increment
+        for word in range(words):
+            self.prog.command(self.PROGRAM_DATA_INC_COMMAND)
+            self.prog.write_data_word()
+            # Wait for the word to be programmed
+            self.board.delay_us(self.CONFIG_PROGRAMMING_DELAY_US)
+
+    def write_user_id_memory(self, byte_address, words):
+        """
+        Writes a block of words to the user ID space
+        :param byte_address: byte address of the first word
+        :param words: number of words to write
+        Data is taken indirectly from the data buffer
+        """
+        # Set the address to write to
+        self.prog.command(self.LOAD_PC_COMMAND)
+        self.prog.payload(byte_address)
+        # Loop through range, writing words with post increment
+        for word in range(words):
+            self.prog.command(self.PROGRAM_DATA_INC_COMMAND)
+            self.prog.write_data_word()
+            # Wait for the word to be programmed
+            self.board.delay_us(self.USER_ID_PROGRAMMING_DELAY_US)
+
     def write_eeprom(self, byte_address, numbytes):
         """
         Writes bytes of data to EEPROM
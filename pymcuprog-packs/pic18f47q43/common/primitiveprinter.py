@@ -17,7 +17,9 @@ from primitiveproxy import PrimitivePrinterProxy
 
 from primitiveaccumulator import PrimitiveFunctionAccumulator
 
-from primitiveutils import process_primitive_sequence
+from primitivecache import CompiledSequence
+from primitivecache import PrimitiveSequenceCache
+from primitivecache import AddressSequenceCache
 
 import xml.etree.ElementTree as ETree
 
@@ -42,13 +44,14 @@ SCRIPT_IDS = {
 }
 
 
-def sequence_to_xml(script_id, tokens, sequence):
+def sequence_to_xml(script_id, tokens, sequence, extended_tokens=False):
     """
     Generates simple XML text output.
     Can be used for making config
     :param script_id: script ID to embed
     :param tokens: tokens to encode
     :param sequence: primitive sequence content
+    :param extended_tokens: set to True to encode the tokens in token system one
     <type>PRIMITIVE_SEQUENCE</type>
     <id>x</id>
     <data>a, b, c...</data>
@@ -60,7 +63,7 @@ def sequence_to_xml(script_id, tokens, sequence):
 
     # Convert tokens to array
     from primitiveutils import tokens_to_array
-    token_array = tokens_to_array(tokens)
+    token_array = tokens_to_array(tokens, extended_tokens)
     # Then to string
     token_string = array_to_hexstring(token_array)
 
@@ -163,19 +166,28 @@ class PrimitiveFunctionXmlGenerator(PrimitiveFunctionAccumulator):
         PrimitiveFunctionAccumulator.__init__(self, model_object)
         self.logger.info("XML output")
         self.xml_tool = tool
+        # Used for compiling parametric sequences, so that each script serves any address (and any word count, if the
+        # tool takes extended tokens)
+        self.extended_tokens = getattr(tool, 'extended_tokens', False)
+        if self.extended_tokens:
+            self.sequence_cache = PrimitiveSequenceCache()
+        else:
+            self.sequence_cache = AddressSequenceCache()
 
     def invoke(self, method, bytes_to_read=0, **kwargs):
         """
         Invokes a given method with arguments - no data
         """
         self.logger.info("Using XML generator")
-        content = PrimitiveFunctionAccumulator.invoke(self, method, **kwargs)
-        self.logger.debug("Raw content: %s", content)
-        sequence, tokens = process_primitive_sequence(content)
-        self.logger.debug("Sequence: %s", sequence)
+        compiled = self.sequence_cache.compile(self._compile_sequence, self.model_object, method, kwargs)
+        if not self.extended_tokens and len(compiled.tokens) > 1:
+            # Token system zero has room for one token, so the script only serves the arguments given
+            sequence, _ = self._compile_sequence(method, kwargs)
+            compiled = CompiledSequence(sequence)
+        self.logger.debug("Sequence: %s", compiled.sequence)
         script_id = SCRIPT_IDS[method.__name__]
 
-        xml_entry = sequence_to_xml(script_id, tokens, sequence)
+        xml_entry = sequence_to_xml(script_id, compiled.tokens, compiled.sequence, self.extended_tokens)
         self.xml_tool.add_new_entry(script_id, xml_entry)
         result = bytearray(bytes_to_read)
         return result
@@ -261,6 +261,23 @@ class ProgExecInterfacePic24(object):
 
         return self._check_pe_response(self.PE_COMMAND_READP, numbytes, response)
 
+    def read_flash_response_size(self, numbytes):
+        """
+        Size of the response to a flash read command, for reads triggered on the proxy rather than invoked
+        :param numbytes: Number of bytes to read (decompacted data, i.e. including "phantom bytes")
+        :return Number of bytes the Programming Executive response will contain
+        """
+        return self._memory_read_bytes_expected_from_pe(numbytes)
+
+    def check_read_flash_response(self, response, numbytes):
+        """
+        Checks the response to a flash read command triggered on the proxy, and extracts its data
+        :param response: Complete response packet from Programming Executive
+        :param numbytes: Number of bytes read (decompacted data, i.e. including "phantom bytes")
+        :return Data uncompacted (including "phantom bytes", i.e. 4 bytes per 24-bit instruction word)
+        """
+        return self._check_pe_response(self.PE_COMMAND_READP, numbytes, response)
+
     def write_flash_page_by_proxy(self, proxy, byte_address, data):
         """
         Invoke flash page write command by proxy
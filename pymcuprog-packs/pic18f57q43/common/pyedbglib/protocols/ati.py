@@ -1,7 +1,9 @@
 """Wrapper for the Asynchronous Transport Interface (ATI)"""
 
 import logging
+import time
 from .dapwrapper import DapWrapper
+from ..pyedbglib_errors import PyedbglibError, PyedbglibNotSupportedError
 
 # ATI frame header fields
 ATI_FRAME_VENDOR_COMMAND_ID = 0
@@ -41,6 +43,16 @@ ATI_ENVELOPE_VERSION_VARIANT_DEFAULT = 0
 ATI_EXEC_GEN4_SCRIPT = 0x10
 ATI_EXEC_PIC_PRIMITIVE = 0x30
 
+# Fragment writes kept in flight before waiting for their acknowledgements.
+# Only transports which can write without waiting for a response (hidapi) stream fragments; the MPLAB transport only
+# has command/response transfers, so inside MPLAB X buffers are written one fragment at a time.
+ATI_WRITE_WINDOW = 4
+
+# Retry policy for fragments the tool is not ready to accept
+ATI_RETRY_TIMEOUT_S = 2.0
+ATI_RETRY_BACKOFF_MIN_S = 0.0001
+ATI_RETRY_BACKOFF_MAX_S = 0.01
+
 
 def get_ati_header(handler, handler_variant=0):
     """
@@ -53,6 +65,16 @@ def get_ati_header(handler, handler_variant=0):
     return bytearray([ATI_ENVELOPE_VERSION, ATI_ENVELOPE_VERSION_VARIANT_DEFAULT, handler, handler_variant])
 
 
+def _is_ok_frame(resp):
+    """
+    Checks whether a response acknowledges a fragment write
+
+    :param resp: response received
+    :return: True if the fragment was accepted
+    """
+    return resp[0] == ATI_OK_FRAME[0] and resp[1] == ATI_OK_FRAME[1]
+
+
 class AsynchronousTransportInterface(DapWrapper):
     """Generic wrapper class for the Asynchronous Transport Interface (ATI)"""
 
@@ -63,6 +85,7 @@ class AsynchronousTransportInterface(DapWrapper):
         # TODO: The buffer size should be queried from the tool implementation.
         self.data_buffer_size = ATI_DATA_BUFFER_SIZE
         self.fragment_size = self.transport.get_report_size()
+        self.write_window = ATI_WRITE_WINDOW
         self.log = logging.getLogger(__name__)
 
     def write_metadata_buffer(self, buffer_id, data):
@@ -120,27 +143,106 @@ class AsynchronousTransportInterface(DapWrapper):
         """
         return self.read_buffer(0, num_bytes, buffer_type=ATI_CTRL_TYPE_CMDRSP)
 
-    def send_fragment(self, buffer_id, flags, data):
+    def _write_frame(self, buffer_id, flags, data):
         """
-        Send a fragment of data to a buffer. Limited by USB endpoint size
+        Builds the frame which writes a fragment of data to a buffer
 
         :param buffer_id: ID of buffer to send data to
-        :param flags: BIT:  | 7    |  6    |  5    |  4       3    |  2       1       0 |
-                      USE:  | read |  EOF  |  SOF  |  buffer_type  |      Buffer ID     |
-        :param data: bytearray of data bytes to write to the buffer
+        :param flags: see send_fragment
+        :param data: data bytes of the fragment
+        :return: frame (bytearray)
         """
-        self.log.info("Writing fragment to buffer %d (%d bytes)", buffer_id, len(data))
-        frame = bytearray(ATI_FRAME_PAYLOAD)
+        # Allocated once at full size, the data is copied straight from the caller's buffer (or a view of it)
+        frame = bytearray(ATI_FRAME_PAYLOAD + len(data))
         frame[ATI_FRAME_VENDOR_COMMAND_ID] = VENDOR_COMMAND_ATI
         frame[ATI_FRAME_FLAGS] = (0 << ATI_CTRL_BIT_READNWRITE) | flags | buffer_id & 0x07
         frame[ATI_FRAME_LENGTH] = (len(data) >> 8)
         frame[ATI_FRAME_LENGTH + 1] = (len(data) & 0xFF)
-        frame.extend(data)
-        resp = ATI_FAILURE_FRAME
+        frame[ATI_FRAME_PAYLOAD:] = data
+        return frame
+
+    def _backoff(self, attempt, deadline):
+        """
+        Waits before retrying a write the tool did not accept
+
+        :param attempt: number of retries so far
+        :param deadline: time after which to give up
+        """
+        if time.time() > deadline:
+            raise PyedbglibError("ATI buffer write not accepted within {:.1f}s".format(ATI_RETRY_TIMEOUT_S))
+        time.sleep(min(ATI_RETRY_BACKOFF_MIN_S * (1 << min(attempt, 16)), ATI_RETRY_BACKOFF_MAX_S))
+
+    def _send_frame(self, frame):
+        """
+        Sends a frame which writes a fragment of data, until the tool accepts it
+
+        :param frame: frame, see _write_frame
+        """
+        deadline = time.time() + ATI_RETRY_TIMEOUT_S
+        attempt = 0
         # Flags = 1 means not ready yet, Flags = 2 means ok, data was received
-        while resp[0] != ATI_OK_FRAME[0] or resp[1] != ATI_OK_FRAME[1]:
-            resp = self.dap_command_response(frame)
+        resp = self.dap_command_response(frame)
+        while not _is_ok_frame(resp):
             self.log.debug("Resp[0]: 0x%02X; Resp[1]: 0x%02X", resp[0], resp[1])
+            self._backoff(attempt, deadline)
+            attempt += 1
+            resp = self.dap_command_response(frame)
+
+    def send_fragment(self, buffer_id, flags, data):
+        """
+        Send a fragment of data to a buffer. Limited by USB endpoint size
+
+        :param buffer_id: ID of buffer to send data to
+        :param flags: BIT:  | 7    |  6    |  5    |  4       3    |  2       1       0 |
+                      USE:  | read |  EOF  |  SOF  |  buffer_type  |      Buffer ID     |
+        :param data: bytearray of data bytes to write to the buffer
+        """
+        self.log.info("Writing fragment to buffer %d (%d bytes)", buffer_id, len(data))
+        self._send_frame(self._write_frame(buffer_id, flags, data))
+
+    def _stream_frames(self, frames):
+        """
+        Sends the frames of a buffer write back to back, keeping up to write_window of them in flight, and collects
+        their acknowledgements as they come in. If the tool does not accept a fragment, the rest are drained and the
+        buffer is sent again from its first (SOF) fragment after a backoff. The tool acts on a buffer when it gets its
+        last (EOF) fragment, so that one is only sent once all the others have been accepted.
+        This needs a transport which can write without waiting for a response, as hidapi can under CPython. The MPLAB
+        transport can not, so inside MPLAB X the write window drops to one on the first buffer write and the gain is
+        only that fragments are sliced without copying.
+
+        :param frames: frames of one buffer write, from SOF to EOF
+        :return: False if the transport cannot send without waiting for a response (nothing was sent)
+        """
+        streamed = frames[:-1]
+        deadline = time.time() + ATI_RETRY_TIMEOUT_S
+        attempt = 0
+        while streamed:
+            try:
+                self.dap_command_write(streamed[0])
+            except (PyedbglibNotSupportedError, NotImplementedError) as error:
+                # Transports inside MPLAB only support command/response transfers
+                self.log.info("Streaming buffer writes not supported by transport: %s", error)
+                self.write_window = 1
+                return False
+            sent = 1
+            in_flight = 1
+            accepted = True
+            while in_flight:
+                while accepted and sent < len(streamed) and in_flight < self.write_window:
+                    self.dap_command_write(streamed[sent])
+                    sent += 1
+                    in_flight += 1
+                resp = self.dap_command_read()
+                in_flight -= 1
+                if not _is_ok_frame(resp):
+                    self.log.debug("Resp[0]: 0x%02X; Resp[1]: 0x%02X", resp[0], resp[1])
+                    accepted = False
+            if accepted:
+                break
+            self._backoff(attempt, deadline)
+            attempt += 1
+        self._send_frame(frames[-1])
+        return True
 
     def write_buffer(self, buffer_id, data, buffer_type=ATI_CTRL_TYPE_DATA):
         """
@@ -152,17 +254,30 @@ class AsynchronousTransportInterface(DapWrapper):
                      ATI_CTRL_TYPE_CMDRSP or ATI_CTRL_TYPE_SYS
         """
         self.log.info("Writing buffer %d (%d bytes)", buffer_id, len(data))
+        try:
+            # Fragments are views into the data, not copies of what is left of it
+            view = memoryview(data)
+        except TypeError:
+            view = data
         flags = buffer_type | (1 << ATI_CTRL_BIT_FRAME_SOF)
         bytes_to_send = self.fragment_size - ATI_FRAME_PAYLOAD
-        while data:
-            if bytes_to_send >= len(data):
-                bytes_to_send = len(data)
+        frames = []
+        offset = 0
+        while offset < len(data):
+            end = offset + bytes_to_send
+            if end >= len(data):
+                end = len(data)
                 flags |= (1 << ATI_CTRL_BIT_FRAME_EOF)
-            # Extract a chunk
-            data_frame = data[:bytes_to_send]
-            self.send_fragment(buffer_id, flags, data_frame)
+            frames.append(self._write_frame(buffer_id, flags, view[offset:end]))
             flags = buffer_type
-            data = data[bytes_to_send:]
+            offset = end
+        if not frames:
+            return
+        if self.write_window > 1 and self._stream_frames(frames):
+            return
+        # One fragment at a time, waiting for each to be accepted
+        for frame in frames:
+            self._send_frame(frame)
 
     def receive_fragment(self, buffer_id, flags, bytes_to_receive):
         """
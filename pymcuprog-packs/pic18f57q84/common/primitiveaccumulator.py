@@ -7,18 +7,25 @@ and thereafter sent for remote execution.
 """
 # pyedbglib dependencies
 from pyedbglib.primitive.primitivecontroller import PrimitiveController
+from pyedbglib.protocols.ati import ATI_RESPONSE_BUFFER_SIZE
 from pyedbglib.util import binary
 
 # primitiveutils
-from primitiveutils import process_primitive_sequence
+from primitiveutils import process_primitive_buffer
 from primitiveutils import PrimitiveException
 
+# Compiled sequence cache
+from primitivecache import PrimitiveSequenceCache
+
+# Address pointer tracking
+from addresscursor import AddressCursor
+
 # Base classes
 from primitivebase import PrimitiveFunction
 from primitivebase import PrimitiveResourceProvider
 
 # Proxies
-from primitiveproxy import PrimitiveAccumulatorProxy
+from primitiveproxy import PrimitiveBufferAccumulatorProxy
 from primitiveproxy import PrimitiveExecuterProxy
 
 # Generators
@@ -89,7 +96,9 @@ class PrimitiveFunctionAccumulator(PrimitiveFunction):
         PrimitiveFunction.__init__(self, model_object)
         self.logger.debug("Using accumulator")
         # Create the accumulator proxy itself
-        self.accumulator = PrimitiveAccumulatorProxy()
+        self.accumulator = PrimitiveBufferAccumulatorProxy()
+        # Peephole optimizer applied when compiling sequences, if any
+        self.optimizer = None
         # Request the provider for resources to initialise the model
         provider = PrimitiveResourceProviderPrimitiveGenerator(self.accumulator)
         # Initialise the model object with the provider
@@ -100,13 +109,34 @@ class PrimitiveFunctionAccumulator(PrimitiveFunction):
         Invokes a function on the model object
         Accumulates the output generated in the form of an array of primitives.
         """
+        self._accumulate(method, kwargs)
+        # Extract the contents of the accumulator
+        return self.accumulator.get_content()
+
+    def _accumulate(self, method, kwargs):
+        """
+        Invokes a function on the model object, leaving its primitives in the accumulator
+        """
         self.logger.debug("Accumulating %s", method.__name__)
         # Reset the accumulator for each execution
         self.accumulator.reset()
         # Invoke the requested method on the object
         method(self.model_object, **kwargs)
-        # Extract the contents of the accumulator
-        return self.accumulator.get_content()
+
+    def _compile_sequence(self, method, kwargs, lambda_tokens=False):
+        """
+        Compile a primitive sequence for the given method and arguments
+        :param method: model method
+        :param kwargs: method arguments
+        :param lambda_tokens: set to True to tokenise rolled loops
+        :return: processed sequence and its tokens
+        """
+        # Generate primitive sequence by invoking said method
+        self._accumulate(method, kwargs)
+        # Process sequence straight from the accumulator buffer
+        buffer, offsets, tokens = self.accumulator.get_buffer()
+        return process_primitive_buffer(buffer, offsets, tokens, lambda_tokens=lambda_tokens,
+                                        optimizer=self.optimizer)
 
 
 class PrimitiveFunctionDirectExecuter(PrimitiveFunction):
@@ -165,22 +195,67 @@ class PrimitiveFunctionAccumulatorExecuter(PrimitiveFunctionAccumulator):
     Inherits from class which just accumulates
     """
 
-    def __init__(self, model_object, controller):
+    # Each block of an execution is prefixed by an 8-bit length
+    MAX_BLOCK_SIZE = 0xFF
+    # ATI header, envelope version and block count
+    EXECUTE_COMMAND_OVERHEAD = 4 + 2 + 1
+    # Data buffers used by batched executions: all blocks write from one and read into the other, in order
+    BATCH_WRITE_BUFFER_ID = 0
+    BATCH_READ_BUFFER_ID = 1
+
+    def __init__(self, model_object, controller, sequence_cache=None, optimizer=None):
         PrimitiveFunctionAccumulator.__init__(self, model_object)
         self.logger.debug("Using accumulated executer")
         self.controller = controller
+        self.optimizer = optimizer
+        # Compiled sequences are only cached for models which do not track device state
+        self.sequence_cache = None
+        if sequence_cache is not None and PrimitiveSequenceCache.is_cacheable(model_object):
+            self.sequence_cache = sequence_cache
 
     def _generate_sequence(self, method, **kwargs):
         """
         Generate a primitive sequence for the given method and arguments
         """
         self.logger.debug("Accumulated execute: %s", method.__name__)
-        # Generate primitive sequence by invoking said method
-        content = PrimitiveFunctionAccumulator.invoke(self, method, **kwargs)
+        if self.sequence_cache is not None:
+            return self.sequence_cache.get_sequence(self._compile_sequence, self.model_object, method, kwargs)
         # Process sequence, discarding tokens
-        sequence, _ = process_primitive_sequence(content)
+        sequence, _ = self._run_tracked(self._compile_sequence, method, kwargs)
         return sequence
 
+    def _forget_device_state(self):
+        """
+        Forgets where the model thinks the address pointer of the target is.
+        The model moves its cursor as it generates a sequence, not as the sequence runs, so a sequence which does
+        not run to its end leaves the cursor out of step with the target.
+        """
+        cursor = getattr(self.model_object, 'cursor', None)
+        if isinstance(cursor, AddressCursor):
+            cursor.invalidate()
+
+    def _run_tracked(self, function, *args):
+        """
+        Calls a function which generates or runs sequences, forgetting the state of the target if it raises
+        """
+        try:
+            return function(*args)
+        except Exception:
+            self._forget_device_state()
+            raise
+
+    def _check_statuses(self, statuses):
+        """
+        Forgets the state of the target if any block of an execution failed
+        :param statuses: 32-bit block statuses, back to back
+        :return: statuses
+        """
+        for offset in range(0, len(statuses) - 3, 4):
+            if binary.unpack_le32(statuses[offset:offset + 4]) != 0:
+                self._forget_device_state()
+                break
+        return statuses
+
     def invoke(self, method, **kwargs):
         """
         Invokes a given method with arguments - no data
@@ -190,7 +265,8 @@ class PrimitiveFunctionAccumulatorExecuter(PrimitiveFunctionAccumulator):
         # Create a command structure
         cmd = self.controller.new_command(sequence)
         # Generate a bytestream and pass is to the controller for remote execution
-        return self.controller.execute_single_block(cmd.generate_bytestream())
+        return self._check_statuses(self._run_tracked(self.controller.execute_single_block,
+                                                      cmd.generate_bytestream()))
 
     def invoke_read(self, bytes_to_read, method, **kwargs):
         """
@@ -205,7 +281,8 @@ class PrimitiveFunctionAccumulatorExecuter(PrimitiveFunctionAccumulator):
         # Assign the data buffer
         cmd.set_data_dest(data_buffer_id)
         # Generate a bytestream and pass is to the controller for remote execution
-        status = self.controller.execute_single_block(cmd.generate_bytestream())
+        status = self._check_statuses(self._run_tracked(self.controller.execute_single_block,
+                                                        cmd.generate_bytestream()))
         statuscode = binary.unpack_le32(status)
         if statuscode != 0:
             self.logger.debug("invoke_read status: 0x%08X", statuscode)
@@ -227,9 +304,10 @@ class PrimitiveFunctionAccumulatorExecuter(PrimitiveFunctionAccumulator):
         # Assign the data buffer
         cmd.set_data_source(data_buffer_id)
         # Send the data to the selected buffer
-        self.controller.write_data_buffer(data_buffer_id, data_to_write)
+        self._run_tracked(self.controller.write_data_buffer, data_buffer_id, data_to_write)
         # Generate a bytestream and pass is to the controller for remote execution
-        return self.controller.execute_single_block(cmd.generate_bytestream())
+        return self._check_statuses(self._run_tracked(self.controller.execute_single_block,
+                                                      cmd.generate_bytestream()))
 
     def invoke_write_read(self, data_to_write, bytes_to_read, method, **kwargs):
         """
@@ -246,12 +324,121 @@ class PrimitiveFunctionAccumulatorExecuter(PrimitiveFunctionAccumulator):
         cmd.set_data_source(write_buffer_id)
         cmd.set_data_dest(read_buffer_id)
         # Send the data to the selected buffer
-        self.controller.write_data_buffer(write_buffer_id, data_to_write)
+        self._run_tracked(self.controller.write_data_buffer, write_buffer_id, data_to_write)
         # Generate a bytestream and pass is to the controller for remote execution
-        self.controller.execute_single_block(cmd.generate_bytestream())
+        self._check_statuses(self._run_tracked(self.controller.execute_single_block, cmd.generate_bytestream()))
         # Read back and return the data buffer after remote execution
         return self.controller.read_data_buffer(read_buffer_id, bytes_to_read)
 
+    def invoke_many(self, calls):
+        """
+        Invokes several calls in as few remote executions as possible.
+        Each call becomes one primitive block of an ATI execution.  Data written by the calls of an execution is sent
+        in one go before it, and data read is fetched in one go after it: the tool carries each data pipe on from one
+        block to the next, so the blocks share one write buffer and one read buffer.
+        Calls with more data than a buffer holds run on their own, just as they would outside a transaction.
+        :param calls: list of PrimitiveCall
+        :return: list of results, one per call: data read for calls which read data, block status for the others
+        """
+        results = []
+        batch = []
+        command_size = self.EXECUTE_COMMAND_OVERHEAD
+        write_size = 0
+        read_size = 0
+        # Each block returns a 32-bit status
+        max_blocks = (ATI_RESPONSE_BUFFER_SIZE - 1) // 4
+        for call in calls:
+            call_write_size = 0
+            if call.data_to_write is not None:
+                call_write_size = len(call.data_to_write)
+            if call_write_size > self.controller.data_buffer_size or \
+                    call.bytes_to_read > self.controller.data_buffer_size:
+                # Its data does not fit in a batch, run it on its own (before generating its block, which would move
+                # the cursor of models which track device state)
+                results.extend(self._execute_batch(batch))
+                batch = []
+                command_size = self.EXECUTE_COMMAND_OVERHEAD
+                write_size = 0
+                read_size = 0
+                results.append(call.run(self))
+                continue
+            block = self._generate_block(call)
+            if len(block) > self.MAX_BLOCK_SIZE:
+                # Does not fit in a batch, run it on its own
+                results.extend(self._execute_batch(batch))
+                batch = []
+                command_size = self.EXECUTE_COMMAND_OVERHEAD
+                write_size = 0
+                read_size = 0
+                # The block is already generated, and generating it again would not give the same block for models
+                # which track device state
+                results.extend(self._execute_batch([(call, block)]))
+                continue
+            # The command buffer is taken to be as large as a data buffer
+            if len(batch) == max_blocks or command_size + 1 + len(block) > self.controller.data_buffer_size or \
+                    write_size + call_write_size > self.controller.data_buffer_size or \
+                    read_size + call.bytes_to_read > self.controller.data_buffer_size:
+                results.extend(self._execute_batch(batch))
+                batch = []
+                command_size = self.EXECUTE_COMMAND_OVERHEAD
+                write_size = 0
+                read_size = 0
+            batch.append((call, block))
+            command_size += 1 + len(block)
+            write_size += call_write_size
+            read_size += call.bytes_to_read
+        results.extend(self._execute_batch(batch))
+        return results
+
+    def _generate_block(self, call):
+        """
+        Generates the primitive block (command bytestream) of a call in a batch
+        """
+        sequence = self._generate_sequence(call.method, **call.kwargs)
+        cmd = self.controller.new_command(sequence)
+        if call.data_to_write is not None:
+            cmd.set_data_source(self.BATCH_WRITE_BUFFER_ID)
+        if call.bytes_to_read:
+            cmd.set_data_dest(self.BATCH_READ_BUFFER_ID)
+        return cmd.generate_bytestream()
+
+    def _execute_batch(self, batch):
+        """
+        Executes a batch of (call, block) in one remote execution
+        :return: list of results, one per call
+        """
+        if not batch:
+            return []
+        data_to_write = bytearray()
+        bytes_to_read = 0
+        for call, _ in batch:
+            if call.data_to_write is not None:
+                data_to_write.extend(call.data_to_write)
+            bytes_to_read += call.bytes_to_read
+        if data_to_write:
+            self._run_tracked(self.controller.write_data_buffer, self.BATCH_WRITE_BUFFER_ID, data_to_write)
+        self.logger.debug("Executing %d blocks in one go", len(batch))
+        statuses = self._run_tracked(self.controller.execute, [block for _, block in batch])
+        data_read = bytearray()
+        if bytes_to_read:
+            data_read = self.controller.read_data_buffer(self.BATCH_READ_BUFFER_ID, bytes_to_read)
+
+        results = []
+        offset = 0
+        for (call, _), status in zip(batch, statuses):
+            # A failing write leaves the target in an unknown state, just as a failing read does
+            statuscode = binary.unpack_le32(status)
+            if statuscode != 0:
+                self.logger.debug("invoke_many status: 0x%08X", statuscode)
+                self._forget_device_state()
+                raise PrimitiveException("Error executing primitives", code=statuscode)
+            if not call.bytes_to_read:
+                results.append(status)
+                continue
+            results.append(data_read[offset:offset + call.bytes_to_read])
+            offset += call.bytes_to_read
+        return results
+
     def trigger_write(self, data_buffer_id, method, **kwargs):
         """
         Triggers a remote write. Does not wait for response. Useful for overlapping access.
@@ -263,11 +450,54 @@ class PrimitiveFunctionAccumulatorExecuter(PrimitiveFunctionAccumulator):
         # Assign the data buffer
         cmd.set_data_source(data_buffer_id)
         # Generate a bytestream and trigger remote execution
-        self.controller.start_primitive_execution([cmd.generate_bytestream()])
+        self._run_tracked(self.controller.start_primitive_execution, [cmd.generate_bytestream()])
         # TODO - check result
 
+    def trigger_write_read_back(self, data_buffer_id, write_method, read_method, **kwargs):
+        """
+        Triggers a remote write, followed by a read back of what was written into the same data buffer.
+        Does not wait for response.  Useful for verifying one write while the next one is being sent.
+        """
+        # Generate the sequences, in order, so that the read knows where the write left the target
+        write_cmd = self.controller.new_command(self._generate_sequence(write_method, **kwargs))
+        write_cmd.set_data_source(data_buffer_id)
+        read_cmd = self.controller.new_command(self._generate_sequence(read_method, **kwargs))
+        read_cmd.set_data_dest(data_buffer_id)
+        # Both blocks run in one execution
+        self._run_tracked(self.controller.start_primitive_execution,
+                          [write_cmd.generate_bytestream(), read_cmd.generate_bytestream()])
+
     def wait_write_done(self):
         """
         Blocks for a write response. Useful for overlapping access.
         """
-        return self.controller.receive_primitive_execution_response()
+        return self._check_statuses(self._run_tracked(self.controller.receive_primitive_execution_response))
+
+    def trigger_read(self, data_buffer_id, method, **kwargs):
+        """
+        Triggers a remote read into a data buffer. Does not wait for response. Useful for overlapping access.
+        """
+        # Generate the sequence
+        sequence = self._generate_sequence(method, **kwargs)
+        # Create a command structure
+        cmd = self.controller.new_command(sequence)
+        # Assign the data buffer
+        cmd.set_data_dest(data_buffer_id)
+        # Generate a bytestream and trigger remote execution
+        self._run_tracked(self.controller.start_primitive_execution, [cmd.generate_bytestream()])
+
+    def wait_read_done(self):
+        """
+        Blocks for the response of a triggered read, and checks it. Useful for overlapping access.
+        """
+        status = self._check_statuses(self._run_tracked(self.controller.receive_primitive_execution_response))
+        statuscode = binary.unpack_le32(status[0:4])
+        if statuscode != 0:
+            self.logger.error("trigger_read status: 0x%08X", statuscode)
+            raise PrimitiveException("Error executing primitives", code=statuscode)
+
+    def read_triggered(self, data_buffer_id, bytes_to_read):
+        """
+        Reads back the data buffer of a triggered read which is done. Useful for overlapping access.
+        """
+        return self.controller.read_data_buffer(data_buffer_id, bytes_to_read)
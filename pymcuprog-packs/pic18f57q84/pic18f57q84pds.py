@@ -25,6 +25,12 @@ class DeviceDefinition(PicDevice):
 
     # Flash properties for this device
     FLASH_WRITE_BYTES_PER_PAGE = 256
+    FLASH_SIZE_BYTES = 0x20000
+    FLASH_ERASED_WORD = 0xFFFF
+
+    # EEPROM properties for this device
+    EEPROM_ADDRESS_B = 0x380000
+    EEPROM_SIZE_BYTES = 1024
 
     # ICSP programming command-set for this device. Commands from programming spec.
     LOAD_PC_COMMAND = 0x80
@@ -36,6 +42,14 @@ class DeviceDefinition(PicDevice):
     WRITE_DATA_NVM_INC_COMMAND = 0xE0
     INCREMENT_ADDRESS_COMMAND = 0xF8
 
+    # How the commands above move the PC, used by the peephole optimizer to drop redundant LOAD_PC commands within a
+    # sequence.  The optimizer is off unless the session option 'peephole_optimizer' turns it on.
+    PC_INCREMENT_COMMANDS = (READ_DATA_NVM_INC_COMMAND, WRITE_DATA_NVM_INC_COMMAND)
+    PC_STATIC_COMMANDS = (READ_DATA_NVM_COMMAND, WRITE_DATA_NVM_COMMAND)
+    # Program memory and user IDs are accessed by word, EEPROM and config by byte
+    PC_WORD_STEP = 2
+    PC_BYTE_STEP = 1
+
     # Extra commands for DE access
     MAE_COMMAND = 0xC4
     MAE_IEDE = 0x006355
@@ -128,6 +142,18 @@ class DeviceDefinition(PicDevice):
         # Internally timed erase command
         self.board.delay_us(self.BULK_ERASE_DELAY_US)
 
+    def erase_row(self, byte_address):
+        """
+        Erases one flash row
+        :param byte_address: start address of the row to erase
+        """
+        # Set the address of the row
+        self.prog.command(self.LOAD_PC_COMMAND)
+        self.prog.payload(byte_address)
+        # Internally timed erase command
+        self.prog.command(self.ROW_ERASE_COMMAND)
+        self.board.delay_us(self.ROW_ERASE_DELAY_US)
+
     def write_flash_page(self, byte_address, words):
         """
         Write one flash page to the PIC
@@ -209,6 +235,57 @@ class DeviceDefinition(PicDevice):
         # Internally timed write procedure
         self.board.delay_us(self.WRITE_USER_ID_DELAY_US)
 
+    def write_config_memory(self, byte_address, words):
+        """
+        Writes a block of words to the config space. This device has byte access
+        to the config memory so two byte writes will be done per word.
+        :param byte_address: byte address of the first word
+        :param words: number of words to write
+        Data is taken indirectly from the data buffer
+        """
+        # Set the address to write to
+        self.prog.command(self.LOAD_PC_COMMAND)
+        self.prog.payload(byte_address)
+        # Loop through range, writing bytes with post increment
+        for byte in range(words * 2):
+            self.prog.command(self.WRITE_DATA_NVM_INC_COMMAND)
+            self.prog.write_data_byte()
+            # Internally timed write procedure
+            self.board.delay_us(self.WRITE_CONFIG_DELAY_US)
+
+    def read_config_memory(self, byte_address, words):
+        """
+        Reads a block of config words from config space. This device has byte access
+        to the config memory so two byte reads will be done per word.
+        :param byte_address: address of the first word
+        :param words: number of words to read
+        Data is sent indirectly to the data buffer
+        """
+        # Set the address
+        self.prog.command(self.LOAD_PC_COMMAND)
+        self.prog.payload(byte_address)
+        # Loop through range, reading bytes with post increment
+        for byte in range(words * 2):
+            self.prog.command(self.READ_DATA_NVM_INC_COMMAND)
+            self.prog.read_data_byte()
+
+    def write_user_id_memory(self, byte_address, words):
+        """
+        Writes a block of words to the user ID space
+        :param byte_address: byte address of the first word
+        :param words: number of words to write
+        Data is taken indirectly from the data buffer
+        """
+        # Set the address to write to
+        self.prog.command(self.LOAD_PC_COMMAND)
+        self.prog.payload(byte_address)
+        # Loop through range, writing words with post increment
+        for word in range(words):
+            self.prog.command(self.WRITE_DATA_NVM_INC_COMMAND)
+            self.prog.write_data_word()
+            # Internally timed write procedure
+            self.board.delay_us(self.WRITE_USER_ID_DELAY_US)
+
     def write_eeprom(self, byte_address, numbytes):
         """
         Writes bytes of data to EEPROM
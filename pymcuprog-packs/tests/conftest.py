@@ -0,0 +1,51 @@
+"""
+Fixtures for the tests of the packs
+
+The packs carry their own copies of the stack under the same module names, so each test gets one pack on the path,
+and the modules loaded from it are dropped afterwards.
+"""
+import os
+import sys
+
+import pytest
+
+PACKS_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TOOLS_DIR = os.path.join(PACKS_DIR, 'tools')
+TESTS_DIR = os.path.join(PACKS_DIR, 'tests')
+
+PACKS = sorted(name for name in os.listdir(PACKS_DIR) if os.path.isdir(os.path.join(PACKS_DIR, name, 'common')))
+
+sys.path.insert(0, TOOLS_DIR)
+
+from packpath import use_pack # pylint: disable=wrong-import-position
+
+
+def _loaded_from_packs(module):
+    path = getattr(module, '__file__', None)
+    if not path:
+        return False
+    path = os.path.abspath(path)
+    return path.startswith(PACKS_DIR + os.sep) and not path.startswith(TESTS_DIR + os.sep)
+
+
+@pytest.fixture(params=PACKS)
+def pack(request):
+    """
+    Puts a pack on the path for the length of a test
+    :return: device name of the pack
+    """
+    saved_path = list(sys.path)
+    use_pack(os.path.join(PACKS_DIR, request.param))
+    yield request.param
+    sys.path[:] = saved_path
+    for name, module in list(sys.modules.items()):
+        if _loaded_from_packs(module) and name != 'packpath':
+            del sys.modules[name]
+
+
+@pytest.fixture
+def pack_dir(pack):
+    """
+    :return: directory of the pack on the path
+    """
+    return os.path.join(PACKS_DIR, pack)
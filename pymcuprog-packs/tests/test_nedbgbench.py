@@ -0,0 +1,16 @@
+"""
+Tests of the end-to-end benchmark of the nedbg_<device>.py entry points
+"""
+
+
+def test_benchmark_runs_without_errors(pack_dir):
+    from nedbgbench import NedbgBenchmark
+    from nedbgbench import summarise
+    benchmark = NedbgBenchmark(pack_dir)
+    records = summarise(benchmark.run([1024]))
+    operations = set(record['operation'] for record in records)
+    assert {'erase', 'prog_write', 'prog_read', 'begin_debug_session', 'step_target'} <= operations
+    for record in records:
+        assert not record['errors'], record
+        assert not record['dialogs'], record
+        assert record['protocol_errors'] == 0, record
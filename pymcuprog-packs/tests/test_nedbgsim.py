@@ -0,0 +1,234 @@
+"""
+Tests of the debuggers of the packs against the simulated nEDBG and the NVM model of their device
+"""
+import random
+import importlib
+
+import pytest
+
+# Device ID the target answers with, any value will do
+DEVICE_ID = 0x30A0
+
+# Size of the image programmed, capped at the size of flash
+IMAGE_SIZE_BYTES = 4096
+
+# Session options, as set by nedbg_<device>.py
+OPTIONS = {'skip_blank_pages': True, 'overlapped_usb_access': False, 'overlapped_reads': False}
+
+
+def _image(device_object, size, seed):
+    """
+    Makes up an image with random content which the device can hold
+    """
+    generator = random.Random(seed)
+    image = bytearray(generator.getrandbits(8) for _ in range(size))
+    if device_object.FLASH_ERASED_WORD == 0x3FFF:
+        # 14-bit words
+        for index in range(1, size, 2):
+            image[index] &= 0x3F
+    return image
+
+
+def _image_erased(device_object, size):
+    """
+    :return: what flash reads as when erased
+    """
+    word = bytearray([device_object.FLASH_ERASED_WORD & 0xFF, device_object.FLASH_ERASED_WORD >> 8])
+    return word * (size // 2)
+
+
+def _start(pack, tool=None, **options):
+    """
+    Sets up a programming session of the pack's debugger on a simulated tool
+    :param tool: arguments of the simulated tool, None for the defaults
+    :param options: session options on top of OPTIONS
+    :return: debugger, device definition, NVM model
+    """
+    from debugprovider import provide_debugger_model
+    from nedbgsim import SimulatedTransport
+    from nvmmodel import create_nvm_model
+    device_object = importlib.import_module("{}pds".format(pack)).DeviceDefinition
+    model = create_nvm_model(device_object, device_id=DEVICE_ID)
+    debugger = provide_debugger_model(pack)
+    debugger.setup_session(SimulatedTransport(target=model, device_name=pack, **(tool or {})),
+                           dict(OPTIONS, **options))
+    debugger.start_programming_operation()
+    return debugger, device_object, model
+
+
+def test_erase_write_verify_flash(pack):
+    debugger, device_object, model = _start(pack)
+    size = min(IMAGE_SIZE_BYTES, device_object.FLASH_SIZE_BYTES)
+    image = _image(device_object, size, pack)
+    debugger.erase()
+    assert debugger.read_flash_memory(0, size) == _image_erased(device_object, size)
+    debugger.write_flash_memory(0, image)
+    assert debugger.read_flash_memory(0, size) == image
+    debugger.end_of_operations()
+    statistics = model.statistics()
+    assert debugger.device_id == DEVICE_ID
+    assert statistics['bulk_erases'] == 1
+    assert statistics['timing_violations'] == 0
+    assert statistics['protocol_errors'] == 0
+    assert statistics['rejected_writes'] == 0
+
+
+def test_write_verify_eeprom(pack):
+    debugger, device_object, model = _start(pack)
+    if not device_object.EEPROM_SIZE_BYTES:
+        pytest.skip("{} has no EEPROM".format(pack))
+    data = bytearray(random.Random(pack).getrandbits(8) for _ in range(16))
+    debugger.erase()
+    debugger.write_eeprom_memory(device_object.EEPROM_ADDRESS_B, data)
+    read_back = debugger.read_eeprom_memory(device_object.EEPROM_ADDRESS_B, len(data))
+    debugger.end_of_operations()
+    # Devices with 14-bit words hold one EEPROM byte per word
+    assert read_back == data or read_back[::2] == data
+    assert model.statistics()['protocol_errors'] == 0
+
+
+@pytest.mark.parametrize('data_buffer_size', [256, 1024])
+def test_buffer_sizes_follow_the_tool(pack, data_buffer_size):
+    # Buffers smaller and larger than the default are both taken up
+    debugger, device_object, model = _start(pack, tool={'data_buffer_size': data_buffer_size})
+    assert debugger.options['ati_data_buffer_size'] == data_buffer_size
+    assert debugger.options['read_chunk_size'] == data_buffer_size
+    size = min(IMAGE_SIZE_BYTES, device_object.FLASH_SIZE_BYTES)
+    image = _image(device_object, size, pack)
+    debugger.erase()
+    debugger.write_flash_memory(0, image)
+    executions = debugger.transport.executions
+    assert debugger.read_flash_memory(0, size) == image
+    assert debugger.transport.executions - executions == size // data_buffer_size
+    debugger.end_of_operations()
+
+
+def test_buffer_sizes_without_tool_report(pack):
+    debugger, _, _ = _start(pack, tool={'usb_parameters': False})
+    assert debugger.options['ati_data_buffer_size'] == 512
+    assert debugger.options['read_chunk_size'] == 0x100
+
+
+def _batched_rows(pack, oversized=False):
+    """
+    Writes two flash rows and reads them back, all queued in one transaction
+    :param oversized: True to have the host take data buffers to be smaller than a row
+    :return: results of the transaction, data written, number of executions the transaction took
+    """
+    from primitivebase import PrimitiveTransaction
+    debugger, device_object, model = _start(pack)
+    row_size = debugger.device_object.get_flash_write_row_size_bytes()
+    proxy = debugger.device_proxy
+    if oversized:
+        proxy.controller.data_buffer_size = row_size - 2
+    rows = [_image(device_object, row_size, seed) for seed in range(2)]
+    debugger.erase()
+    executions = debugger.transport.executions
+    transaction = PrimitiveTransaction(proxy)
+    for index, row in enumerate(rows):
+        transaction.invoke_write(data_to_write=row, method=debugger.device_model.write_flash_page,
+                                 byte_address=index * row_size, words=row_size // 2)
+    for index, row in enumerate(rows):
+        transaction.invoke_read(row_size, method=debugger.device_model.read_flash, byte_address=index * row_size,
+                                words=row_size // 2)
+    results = transaction.execute()
+    executions = debugger.transport.executions - executions
+    debugger.end_of_operations()
+    assert model.statistics()['protocol_errors'] == 0
+    return results, rows, executions
+
+
+def test_batched_calls_share_data_buffers(pack):
+    # All blocks of an execution take their data from one buffer, and put what they read in another, in order
+    results, rows, executions = _batched_rows(pack)
+    assert list(results[2:]) == rows
+    assert executions == 1
+
+
+def test_batched_call_larger_than_data_buffer(pack):
+    # Every call has more data than the host takes a buffer to hold, so each runs on its own
+    results, rows, executions = _batched_rows(pack, oversized=True)
+    assert list(results[2:]) == rows
+    assert executions == 4
+
+
+def _program_twice(pack, **options):
+    """
+    Programs an image and EEPROM data, then erases and programs an update to the image
+    :param options: session options
+    :return: flash and EEPROM (None if there is none) read back after the update
+    """
+    debugger, device_object, model = _start(pack, **options)
+    size = min(IMAGE_SIZE_BYTES, device_object.FLASH_SIZE_BYTES)
+    row_size = debugger.device_object.get_flash_write_row_size_bytes()
+    image = _image(device_object, size, pack)
+    debugger.erase()
+    debugger.write_flash_memory(0, image)
+    if device_object.EEPROM_SIZE_BYTES:
+        debugger.write_eeprom_memory(device_object.EEPROM_ADDRESS_B, bytearray(range(16)))
+    debugger.end_of_operations()
+
+    # Same part, new image: one row changed, and the image ends sooner
+    update = image[:size // 2]
+    update[row_size:2 * row_size] = _image(device_object, row_size, 0)
+    debugger.start_programming_operation()
+    debugger.erase()
+    debugger.write_flash_memory(0, update)
+    flash = debugger.read_flash_memory(0, size)
+    eeprom = None
+    if device_object.EEPROM_SIZE_BYTES:
+        eeprom = debugger.read_eeprom_memory(device_object.EEPROM_ADDRESS_B, 16)
+    debugger.end_of_operations()
+    assert flash == update + _image_erased(device_object, size - len(update))
+    assert model.statistics()['bulk_erases'] == 2
+    return flash, eeprom
+
+
+def test_differential_programming_erases_as_asked(pack, tmp_path):
+    # The shadow of the first image must not keep the erase from clearing anything a plain erase clears
+    assert _program_twice(pack, differential_programming=True, shadow_directory=str(tmp_path)) == \
+        _program_twice(pack)
+
+
+@pytest.mark.parametrize('pack', ['pic16f1768', 'pic16f1779'], indirect=True)
+def test_address_cursor_recovers_from_failed_sequence(pack):
+    debugger, device_object, model = _start(pack)
+    user_id_address = device_object.CONFIG_MEMORY_ADDRESS_B
+    debugger.erase()
+    # Fail the write of three words after the first (LOAD_CONFIGURATION then five primitives per word),
+    # while the model has already walked past all of them
+    debugger.transport.interpreter.fail_after = 7
+    status = debugger.device_proxy.invoke_write(data_to_write=bytearray([0x11, 0x00, 0x22, 0x00, 0x33, 0x00]),
+                                                method=debugger.device_model.write_user_id_memory,
+                                                byte_address=user_id_address, words=3)
+    assert status != bytearray(4)
+    debugger.write_user_id_memory(user_id_address + 6, bytearray([0x34, 0x12]))
+    read_back = debugger.read_config_memory(user_id_address, 8)
+    debugger.end_of_operations()
+    assert read_back == bytearray([0x11, 0x00, 0xFF, 0x3F, 0xFF, 0x3F, 0x34, 0x12])
+
+
+@pytest.mark.parametrize('pack', ['pic18f57q84', 'pic16f18446'], indirect=True)
+def test_executive_cache_opt_in(pack, tmp_path):
+    from executivecache import ExecutiveCache
+    from executivecache import executive_key
+    filename = str(tmp_path / 'executives.json')
+    debugger, device_object, model = _start(pack, de_cache_file=filename)
+    debugger.set_debug_exec(0x1000, bytearray(64))
+    debugger._remember_debug_exec()
+    assert debugger._get_executive_cache() is None
+    debugger.end_of_operations()
+
+    debugger, device_object, model = _start(pack, de_cache=True, de_cache_file=filename)
+    debugger.set_debug_exec(0x1000, bytearray(64))
+    debugger._remember_debug_exec()
+    cache = debugger._get_executive_cache()
+    key = executive_key(debugger.tool_serial, debugger.device_id, 0x1000, bytearray(64))
+    assert key in cache
+    # Erasing rows elsewhere leaves the DE be, a bulk erase takes it with the rest of program memory
+    debugger._erase_flash_row(0)
+    assert key in cache
+    debugger.erase()
+    assert key not in cache
+    assert ExecutiveCache(filename).entries == {}
+    debugger.end_of_operations()
@@ -0,0 +1,55 @@
+"""
+Tests of the sequence bundles shipped with the packs
+"""
+import os
+
+import pytest
+
+
+def test_bundle_matches_pack(pack):
+    from debugprovider import provide_debugger_model
+    from primitivebundle import bundle_filename
+    from primitivebundle import load_bundle
+    from primitivecache import PrimitiveSequenceCache
+    model = provide_debugger_model(pack).device_model
+    if not PrimitiveSequenceCache.is_cacheable(model()):
+        # Nothing to bundle for models which track device state
+        assert not os.path.isfile(bundle_filename(model))
+        return
+    assert load_bundle(PrimitiveSequenceCache(), model) > 0
+
+
+@pytest.mark.parametrize('pack', ['pic18f57q84'], indirect=True)
+def test_fingerprint_ignores_line_endings(pack, tmp_path):
+    from primitivebundle import fingerprint_sources
+    sources = {
+        'unix': b'def f():\n    return 1\n',
+        'dos': b'def f():\r\n    return 1  \r\n\r\n',
+        'changed': b'def f():\n    return 2\n',
+    }
+    digests = {}
+    for name, data in sources.items():
+        filename = str(tmp_path / name)
+        with open(filename, 'wb') as source_file:
+            source_file.write(data)
+        digests[name] = fingerprint_sources([filename])
+    assert digests['unix'] == digests['dos']
+    assert digests['unix'] != digests['changed']
+
+
+@pytest.mark.parametrize('pack', ['pic18f57q84'], indirect=True)
+def test_rejected_bundle_warns(pack, tmp_path, caplog):
+    from debugprovider import provide_debugger_model
+    from primitivebundle import bundle_filename
+    from primitivebundle import load_bundle
+    from primitivecache import PrimitiveSequenceCache
+    model = provide_debugger_model(pack).device_model
+    with open(bundle_filename(model), 'rb') as bundle_file:
+        data = bytearray(bundle_file.read())
+    # Spoil the fingerprint, which follows the magic and version
+    data[5] ^= 0xFF
+    filename = str(tmp_path / 'stale.bundle')
+    with open(filename, 'wb') as bundle_file:
+        bundle_file.write(data)
+    assert load_bundle(PrimitiveSequenceCache(), model, filename) == 0
+    assert 'other sources' in caplog.text
@@ -0,0 +1,89 @@
+"""
+Tests of the compiled sequence cache against compiling every sequence
+"""
+import random
+
+import pytest
+
+# Span of flash the accesses are made in, which all devices have
+FLASH_SPAN_BYTES = 0x2000
+
+# Byte addresses of the first config word and of EEPROM: PIC16 and PIC18
+CONFIG_ADDRESS_B = {'pic16': 0x8007 * 2, 'pic18': 0x300000}
+EEPROM_ADDRESS_B = {'pic16': 0xF000 * 2, 'pic18': 0x380000}
+
+
+def _invocations(pack, model, page_bytes, generator):
+    """
+    Lists (method, kwargs) of the memory accesses of a device model class, with addresses and lengths all over the
+    place
+    """
+    family = pack[:5]
+    page_words = page_bytes // 2
+    invocations = [(model.bulk_erase, {'byte_address': None})]
+    for _ in range(40):
+        byte_address = generator.randrange(0, FLASH_SPAN_BYTES, 2)
+        words = generator.choice([1, 2, 3, 4, 8, 16, 100, 127, 128, page_words])
+        invocations.append((model.read_flash, {'byte_address': byte_address, 'words': words}))
+        invocations.append((model.write_flash_page, {'byte_address': byte_address,
+                                                     'words': generator.randint(1, page_words)}))
+    for index in range(4):
+        byte_address = CONFIG_ADDRESS_B[family] + 2 * index
+        invocations.append((model.read_config_word, {'byte_address': byte_address}))
+        invocations.append((model.write_config_word, {'byte_address': byte_address}))
+    if hasattr(model, 'read_eeprom'):
+        for _ in range(10):
+            byte_address = EEPROM_ADDRESS_B[family] + generator.randrange(0, 0x100)
+            numbytes = generator.choice([1, 5, 64, 128, 255, 256])
+            invocations.append((model.read_eeprom, {'byte_address': byte_address, 'numbytes': numbytes}))
+            invocations.append((model.write_eeprom, {'byte_address': byte_address, 'numbytes': numbytes}))
+    return invocations
+
+
+def test_cached_sequences_match_compiled_sequences(pack):
+    from debugprovider import provide_debugger_model
+    from primitiveaccumulator import PrimitiveFunctionAccumulatorExecuter
+    from primitivecache import PrimitiveSequenceCache
+    debugger = provide_debugger_model(pack)
+    model = debugger.device_model
+    if not PrimitiveSequenceCache.is_cacheable(model()):
+        pytest.skip("{} tracks device state, its sequences are not cached".format(model.__name__))
+
+    cache = PrimitiveSequenceCache()
+    # The executers hook into the model object they are given, so each one needs its own
+    cached = PrimitiveFunctionAccumulatorExecuter(model(), None, sequence_cache=cache)
+    compiled = PrimitiveFunctionAccumulatorExecuter(model(), None)
+    # Every invocation is made twice, so that the second one comes from the cache
+    invocations = _invocations(pack, model, debugger.device_object.FLASH_WRITE_BYTES_PER_PAGE, random.Random(pack))
+    for method, kwargs in invocations + invocations:
+        # Sequences compiled directly are lists, cached ones bytearrays
+        assert bytearray(cached._generate_sequence(method, **kwargs)) == \
+            bytearray(compiled._generate_sequence(method, **kwargs)), (method.__name__, kwargs)
+    assert cache.hits >= len(invocations)
+
+
+def test_count_range_checked_in_the_middle(pack):
+    from debugprovider import provide_debugger_model
+    from primitiveaccumulator import PrimitiveFunctionAccumulatorExecuter
+    from primitivecache import PrimitiveSequenceCache
+    model = provide_debugger_model(pack).device_model
+    if not PrimitiveSequenceCache.is_cacheable(model()):
+        pytest.skip("{} tracks device state, its sequences are not cached".format(model.__name__))
+
+    class SplitModel(model):
+        def read_flash_split(self, byte_address, words):
+            # Long reads go in two halves, which neither end of the range of a short read shows
+            if 100 <= words <= 200:
+                self.read_flash(byte_address=byte_address, words=words // 2)
+                self.read_flash(byte_address=byte_address + words, words=words - words // 2)
+            else:
+                self.read_flash(byte_address=byte_address, words=words)
+
+    cache = PrimitiveSequenceCache()
+    cached = PrimitiveFunctionAccumulatorExecuter(SplitModel(), None, sequence_cache=cache)
+    compiled = PrimitiveFunctionAccumulatorExecuter(SplitModel(), None)
+    method = SplitModel.read_flash_split
+    for words in (8, 150):
+        kwargs = {'byte_address': 0x100, 'words': words}
+        assert bytearray(cached._generate_sequence(method, **kwargs)) == \
+            bytearray(compiled._generate_sequence(method, **kwargs)), words
@@ -0,0 +1,65 @@
+"""
+Tests of the loop rollers and token encoding of primitiveutils
+"""
+import random
+
+import pytest
+
+
+def _random_content(generator):
+    """
+    Makes up content with repeats in it, over a small alphabet so that repeats also turn up by chance
+    """
+    length = generator.randint(0, 60)
+    alphabet = generator.randint(1, 4)
+    base = [generator.randint(0, alphabet) for _ in range(generator.randint(1, 6))]
+    content = []
+    while len(content) < length:
+        if generator.random() < 0.5:
+            content += base * generator.randint(1, 8)
+        else:
+            content.append(generator.randint(0, alphabet))
+    return content
+
+
+@pytest.mark.parametrize('seed', range(4))
+def test_roll_tandem_repeats_matches_reference(pack, seed):
+    from primitiveutils import roll_loops_reference
+    from primitiveutils import roll_tandem_repeats
+    generator = random.Random(seed)
+    for _ in range(250):
+        content = _random_content(generator)
+        threshold = generator.choice([0, 1, 4, 7])
+        minimum = generator.choice([1, 1, 2])
+        maximum = generator.choice([None, None, 3, 10])
+        assert roll_tandem_repeats(list(content), minimum, maximum, threshold) == \
+            roll_loops_reference(list(content), minimum, maximum, threshold), content
+
+
+@pytest.mark.parametrize('content', [[1] * 700, [1, 2] * 600 + [3] + [1, 2] * 300, [5, 6, 7] * 300],
+                         ids=['single', 'pairs', 'triples'])
+def test_roll_tandem_repeats_matches_reference_on_long_runs(pack, content):
+    from primitiveutils import roll_loops_reference
+    from primitiveutils import roll_tandem_repeats
+    # Repeat counts are capped, so long runs are split
+    assert roll_tandem_repeats(list(content)) == roll_loops_reference(list(content))
+
+
+def test_tokens_to_array_keeps_to_token_system_zero(pack):
+    from primitiveutils import ParametricToken
+    from primitiveutils import ParametricValueToken
+    from primitiveutils import tokens_to_array
+    address = ParametricValueToken(ParametricToken.TOKEN_ADDRESS_LE32)
+    address.offset = 3
+    address.bytecount = 4
+    count = ParametricValueToken(ParametricToken.TOKEN_COUNT_LE16)
+    count.offset = 0x109
+    count.bytecount = 2
+    assert tokens_to_array([address]) == [ord('T'), 0, 1, ParametricToken.TOKEN_ADDRESS_LE32, 4, 0, 3, 0]
+    # One address token at most, unless the consumer takes token system one
+    with pytest.raises(Exception):
+        tokens_to_array([address, count])
+    with pytest.raises(Exception):
+        tokens_to_array([count])
+    assert tokens_to_array([address, count], extended_tokens=True) == \
+        [ord('T'), 1, 2, ParametricToken.TOKEN_ADDRESS_LE32, 4, 0, 3, 0, ParametricToken.TOKEN_COUNT_LE16, 2, 0, 9, 1]
@@ -0,0 +1,362 @@
+"""
+    nedbgbench
+    End-to-end benchmark of the programming and debug API which MPLAB X calls, without hardware
+
+    The pack's nedbg_<device>.py is loaded the way MPLAB X loads it, with stand-ins for the globals MPLAB X injects
+    (tool, log, msg and device).  Its entry points are then called in the order MPLAB X calls them, against a simulated
+    nEDBG (nedbgsim) with a model of the device NVM (nvmmodel) behind it.
+    For every call the host CPU time, the USB traffic, the data moved and the modeled tool, ICSP and NVM time are
+    recorded.  Programming is benchmarked for images from 1 KB up to all of flash, and read back to check it.
+
+    Records are written as JSON, one object per line, so that runs can be compared by scripts:
+        python tools/nedbgbench.py <pack> [--sizes 1024,4096,...] [--hid] [--output <file>]
+    where <pack> is the pack directory, for example pic18f57q84.  One run benchmarks one pack.
+"""
+from __future__ import print_function
+
+import os
+import sys
+import time
+import json
+import random
+import logging
+import argparse
+import importlib
+
+from packpath import pack_device_name
+from packpath import use_pack
+
+# Image sizes benchmarked, capped at the size of flash (which is always benchmarked)
+DEFAULT_IMAGE_SIZES = [1024, 4096, 16384, 65536]
+
+# Device ID the target answers with.  The stack only checks that something is there, so any value will do.
+DEFAULT_DEVICE_ID = 0x30A0
+
+# Size of the stand-in debug executive
+DEBUG_EXEC_SIZE_BYTES = 512
+
+# Number of steps benchmarked in a debug session
+DEBUG_STEPS = 10
+
+# Level OFF from the MPLAB X log level list (see mplablog)
+MPLAB_LOG_LEVEL_OFF = 6
+
+# Counters of nedbgsim and nvmmodel which are recorded as the difference over each call
+TRANSPORT_COUNTERS = ['elapsed_s', 'usb_reports_out', 'usb_reports_in', 'usb_polls', 'ati_bytes_out', 'ati_bytes_in',
+                      'executions', 'blocks', 'primitives', 'tool_busy_s', 'icsp_clock_s', 'icsp_delay_s']
+NVM_COUNTERS = ['icsp_commands', 'bulk_erases', 'row_erases', 'program_operations', 'locations_programmed',
+                'nvm_erase_s', 'nvm_program_s', 'timing_violations', 'protocol_errors', 'rejected_writes']
+
+try:
+    _cpu_time = time.process_time
+except AttributeError:
+    # Python 2
+    _cpu_time = time.clock
+
+
+def _execute(code, namespace):
+    """
+    Runs module code in a namespace (exec is a statement in Python 2, and can not be passed around)
+    """
+    exec(code, namespace) # pylint: disable=exec-used
+
+
+class MplabLogStandIn(object):
+    """
+    Stands in for the log object MPLAB X injects.  Output is dropped, as it is with logging turned off in MPLAB X.
+    """
+    # pylint: disable=invalid-name
+    def __init__(self, level=MPLAB_LOG_LEVEL_OFF):
+        self.level = level
+        self.show_output = False
+
+    def getLogLevelThreshold(self):
+        """
+        :return: index of the log level selected in MPLAB X
+        """
+        return self.level
+
+    def setShowOutput(self, value):
+        """
+        :param value: True to show output in MPLAB X
+        """
+        self.show_output = value
+
+    def debug(self, message):
+        pass
+
+    def info(self, message):
+        pass
+
+    def warning(self, message):
+        pass
+
+    def error(self, message):
+        pass
+
+
+class MplabMsgStandIn(object):
+    """
+    Stands in for the msg object MPLAB X injects.  Output is dropped, dialogs are kept so they can be reported.
+    """
+
+    def __init__(self):
+        self.dialogs = []
+
+    def print(self, message):
+        """
+        Output window text
+        """
+        pass
+
+    def msg(self, message, title):
+        """
+        Dialog box
+        """
+        self.dialogs.append("{0}: {1}".format(title, message))
+
+
+class MplabToolStandIn(object):
+    """
+    Stands in for the tool object MPLAB X injects (Controller$PacketTransfer), so the stack goes through MpLabTransport.
+    """
+    # pylint: disable=invalid-name
+    def __init__(self, transport):
+        self.transport = transport
+
+    def GetPacketSize(self):
+        """
+        :return: bytes per HID report
+        """
+        return self.transport.GetPacketSize()
+
+    def Send(self, packet, length):
+        """
+        Sends a report
+        """
+        self.transport.Send(packet, length)
+
+    def Receive(self, response, length):
+        """
+        Receives the response to the last report sent
+        """
+        self.transport.Receive(response, length)
+
+
+class NedbgBenchmark(object):
+    """
+    Drives the nedbg_<device>.py entry points of a pack and records what each call costs
+    """
+
+    def __init__(self, pack_dir, device_id=DEFAULT_DEVICE_ID, mplab_tool=True):
+        """
+        :param pack_dir: directory of the pack (the one holding nedbg_<device>.py)
+        :param device_id: device ID the target answers with
+        :param mplab_tool: True to go through the MPLAB X tool API (as in MPLAB X), False to use the HID API
+        """
+        self.logger = logging.getLogger(__name__)
+        self.pack_dir = use_pack(pack_dir)
+        self.device_name = pack_device_name(self.pack_dir)
+        # The simulator and the models are built on the stack of the pack, which is only on the path from here on
+        from nedbgsim import SimulatedTransport # pylint: disable=import-outside-toplevel
+        from nvmmodel import create_nvm_model # pylint: disable=import-outside-toplevel
+        self.mplab_tool = mplab_tool
+        self.records = []
+        self.api = None
+
+        # The target and the tool are kept for the whole run, like a board which stays plugged in
+        self.device_object = importlib.import_module("{}pds".format(self.device_name)).DeviceDefinition
+        self.model = create_nvm_model(self.device_object, device_id)
+        self.transport = SimulatedTransport(target=self.model, device_name=self.device_name)
+        self.msg = MplabMsgStandIn()
+        self.log = MplabLogStandIn()
+
+    def load(self):
+        """
+        Loads nedbg_<device>.py with the globals MPLAB X injects
+        """
+        path = os.path.join(self.pack_dir, "nedbg_{}.py".format(self.device_name))
+        with open(path) as source_file:
+            source = source_file.read()
+        tool = MplabToolStandIn(self.transport) if self.mplab_tool else self.transport
+        self.api = {'__name__': "nedbg_{}".format(self.device_name), '__file__': path, 'tool': tool, 'log': self.log,
+                    'msg': self.msg, 'device': self.device_name.upper()}
+        # The module picks up its configuration relative to the working directory, as it does in MPLAB X
+        cwd = os.getcwd()
+        os.chdir(self.pack_dir)
+        try:
+            self._measure('load', 0, _execute, compile(source, path, 'exec'), self.api)
+        finally:
+            os.chdir(cwd)
+
+    def _measure(self, operation, size, function, *args):
+        """
+        Calls a function, and records what it costs
+        :param operation: name of the operation recorded
+        :param size: number of bytes the operation deals with
+        :param function: what to call
+        :param args: arguments to call it with
+        :return: what the function returned, None if it failed
+        """
+        transport_before = self.transport.statistics()
+        nvm_before = self.model.statistics()
+        dialogs = len(self.msg.dialogs)
+        error = None
+        result = None
+        wall_start = time.time()
+        cpu_start = _cpu_time()
+        try:
+            result = function(*args)
+        except Exception as e: # pylint: disable=broad-except
+            error = "{0}: {1}".format(type(e).__name__, e)
+            self.logger.warning("%s %s failed: %s", self.device_name, operation, error)
+        cpu_s = _cpu_time() - cpu_start
+        wall_s = time.time() - wall_start
+
+        transport_after = self.transport.statistics()
+        nvm_after = self.model.statistics()
+        record = {'device': self.device_name, 'operation': operation, 'size_bytes': size,
+                  'transport': 'mplab' if self.mplab_tool else 'hid', 'host_cpu_s': cpu_s, 'host_wall_s': wall_s}
+        for counter in TRANSPORT_COUNTERS:
+            record[counter] = transport_after[counter] - transport_before[counter]
+        for counter in NVM_COUNTERS:
+            record[counter] = nvm_after[counter] - nvm_before[counter]
+        record['modeled_s'] = record.pop('elapsed_s')
+        record['dialogs'] = self.msg.dialogs[dialogs:]
+        record['error'] = error
+        self.records.append(record)
+        return result
+
+    def _call(self, operation, size, entry_point, *args):
+        """
+        Calls an entry point of nedbg_<device>.py, and records what it costs
+        """
+        return self._measure(operation, size, self.api[entry_point], *args)
+
+    def _image(self, size, seed):
+        """
+        Makes up an image with random content which the device can hold
+        :param size: number of bytes
+        :param seed: random seed, for images which are the same from run to run
+        :return: image (bytearray)
+        """
+        generator = random.Random(seed)
+        image = bytearray(generator.getrandbits(8) for _ in range(size))
+        if self.device_object.FLASH_ERASED_WORD == 0x3FFF:
+            # 14-bit words
+            for index in range(1, size, 2):
+                image[index] &= 0x3F
+        return image
+
+    def image_sizes(self, sizes=None):
+        """
+        :param sizes: list of image sizes wanted, None for the default sizes
+        :return: the image sizes which fit in flash, with the size of flash last
+        """
+        flash_size = self.device_object.FLASH_SIZE_BYTES
+        sizes = [size for size in (sizes or DEFAULT_IMAGE_SIZES) if size < flash_size]
+        return sizes + [flash_size]
+
+    def program(self, size):
+        """
+        Benchmarks one programming session: erase, write an image to flash, and read it back
+        :param size: image size in bytes
+        :return: True if the image read back is the one written
+        """
+        image = self._image(size, size)
+        read_back = bytearray(size)
+        self._call('begin_communication_session', size, 'begin_communication_session')
+        self._call('start_programming_operation', size, 'start_programming_operation')
+        self._call('erase', size, 'erase')
+        self._call('prog_write', size, 'prog_write', "Pgm", 0, size, image)
+        self._call('prog_read', size, 'prog_read', "Pgm", 0, size, read_back)
+        self._call('end_of_operations', size, 'end_of_operations')
+        self._call('end_communication_session', size, 'end_communication_session')
+        return read_back == image
+
+    def debug(self):
+        """
+        Benchmarks one debug session: start it with a debug executive, step, and read memory
+        """
+        definition = self.device_object
+        # The DE has a region of its own, which MPLAB X passes the address of.  Where the pack does not say, any
+        # address past flash will do for the model.
+        address = getattr(definition, 'DEBUG_EXEC_ADDRESS_B', getattr(definition, 'DE_MEM2_B',
+                                                                      definition.FLASH_SIZE_BYTES))
+        debug_exec = self._image(DEBUG_EXEC_SIZE_BYTES, address)
+        file_registers = bytearray(256)
+        flash = bytearray(1024)
+        self._call('begin_communication_session', 0, 'begin_communication_session')
+        self._call('set_debug_exec', len(debug_exec), 'set_debug_exec', address, debug_exec)
+        self._call('begin_debug_session', len(debug_exec), 'begin_debug_session')
+        for _ in range(DEBUG_STEPS):
+            self._call('step_target', 0, 'step_target')
+        self._call('debug_read', len(file_registers), 'debug_read', "FileRegs", 0, len(file_registers), file_registers)
+        if "pic18" not in self.device_name:
+            # PIC18 DEs can not read flash
+            self._call('debug_read', len(flash), 'debug_read', "Pgm", 0, len(flash), flash)
+        self._call('end_debug_session', 0, 'end_debug_session')
+        self._call('end_communication_session', 0, 'end_communication_session')
+
+    def run(self, sizes=None):
+        """
+        Runs the benchmark
+        :param sizes: list of image sizes, None for the default sizes
+        :return: list of records, one per call
+        """
+        self.load()
+        for size in self.image_sizes(sizes):
+            if not self.program(size):
+                self.logger.error("%s: %d byte image did not read back", self.device_name, size)
+                self.records[-1]['error'] = self.records[-1]['error'] or "Read back does not match the image written"
+        self.debug()
+        return self.records
+
+
+def summarise(records):
+    """
+    Adds up the records of each operation
+    :param records: records from NedbgBenchmark.run
+    :return: list of records, one per device, operation and size
+    """
+    totals = {}
+    order = []
+    for record in records:
+        key = (record['device'], record['operation'], record['size_bytes'])
+        if key not in totals:
+            totals[key] = dict(record, calls=0, dialogs=[], errors=[])
+            del totals[key]['error']
+            order.append(key)
+            for counter in TRANSPORT_COUNTERS[1:] + NVM_COUNTERS + ['modeled_s', 'host_cpu_s', 'host_wall_s']:
+                totals[key][counter] = 0
+        total = totals[key]
+        total['calls'] += 1
+        if record['error']:
+            total['errors'].append(record['error'])
+        total['dialogs'].extend(record['dialogs'])
+        for counter in TRANSPORT_COUNTERS[1:] + NVM_COUNTERS + ['modeled_s', 'host_cpu_s', 'host_wall_s']:
+            total[counter] += record[counter]
+    return [totals[key] for key in order]
+
+
+if __name__ == "__main__":
+    PARSER = argparse.ArgumentParser(description="Benchmark the nEDBG programming and debug API on a simulated tool")
+    PARSER.add_argument("pack", help="pack directory (the one holding nedbg_<device>.py)")
+    PARSER.add_argument("--sizes", help="comma-separated image sizes in bytes (flash size is always included)")
+    PARSER.add_argument("--hid", action="store_true", help="use the HID API rather than the MPLAB X tool API")
+    PARSER.add_argument("--per-call", action="store_true", help="one record per call, rather than per operation")
+    PARSER.add_argument("--output", help="file to write the records to, rather than stdout")
+    ARGUMENTS = PARSER.parse_args()
+
+    logging.basicConfig(level=logging.WARNING, format="%(message)s")
+    SIZES = [int(size, 0) for size in ARGUMENTS.sizes.split(',')] if ARGUMENTS.sizes else None
+
+    BENCHMARK = NedbgBenchmark(ARGUMENTS.pack, mplab_tool=not ARGUMENTS.hid)
+    RECORDS = BENCHMARK.run(SIZES)
+    if not ARGUMENTS.per_call:
+        RECORDS = summarise(RECORDS)
+    OUTPUT = open(ARGUMENTS.output, 'w') if ARGUMENTS.output else sys.stdout
+    for RECORD in RECORDS:
+        OUTPUT.write(json.dumps(RECORD, sort_keys=True) + "\n")
+    if ARGUMENTS.output:
+        OUTPUT.close()
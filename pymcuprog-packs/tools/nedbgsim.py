@@ -0,0 +1,809 @@
+"""
+    nedbgsim
+    Simulated nEDBG, for running the stack without hardware
+
+    SimulatedTransport stands in for the HID transport (or for the MPLAB X tool object).  It takes the packets the
+    tool would take, and answers CMSIS-DAP info, housekeeping and ATI requests the way the nEDBG firmware does.
+    Primitive sequences are executed against an ICSP target model.
+    Time is not spent but modeled: USB frames, polls, ICSP clocking and delays all move a clock in nanoseconds, so
+    that runs are fast and give the same figures every time.
+
+    The simulator runs on the stack of a pack, which has to be on the module search path before it is imported (see
+    packpath.use_pack).
+"""
+import logging
+
+from pyedbglib.primitive import primitives
+from pyedbglib.primitive.primitivecontroller import PRIMITIVE_ENVELOPE_VERSION_MAJOR
+from pyedbglib.primitive.primitivecontroller import DATA_SOURCE_UNDEFINED
+from pyedbglib.primitive.primitivecontroller import DATA_DEST_UNDEFINED
+from pyedbglib.protocols.ati import VENDOR_COMMAND_ATI
+from pyedbglib.protocols.ati import ATI_FRAME_FLAGS
+from pyedbglib.protocols.ati import ATI_FRAME_LENGTH
+from pyedbglib.protocols.ati import ATI_FRAME_PAYLOAD
+from pyedbglib.protocols.ati import ATI_CTRL_BIT_READNWRITE
+from pyedbglib.protocols.ati import ATI_CTRL_BIT_FRAME_EOF
+from pyedbglib.protocols.ati import ATI_CTRL_BIT_FRAME_SOF
+from pyedbglib.protocols.ati import ATI_CTRL_TYPE_DATA
+from pyedbglib.protocols.ati import ATI_CTRL_TYPE_METADATA
+from pyedbglib.protocols.ati import ATI_CTRL_TYPE_CMDRSP
+from pyedbglib.protocols.ati import ATI_OK_FRAME
+from pyedbglib.protocols.ati import ATI_FAILURE_FRAME
+from pyedbglib.protocols.ati import ATI_DATA_BUFFER_SIZE
+from pyedbglib.protocols.ati import ATI_EXEC_PIC_PRIMITIVE
+from pyedbglib.protocols.avrcmsisdap import AvrCommand
+from pyedbglib.protocols.cmsisdap import CmsisDapUnit
+from pyedbglib.protocols.jtagice3protocol import Jtagice3Command
+from pyedbglib.protocols.jtagice3protocol import Jtagice3Protocol
+from pyedbglib.protocols.housekeepingprotocol import Jtagice3HousekeepingProtocol
+from pyedbglib.util import binary
+
+# Block status codes (32-bit) of executions which fail
+STATUS_OK = 0
+STATUS_UNKNOWN_PRIMITIVE = 0x01
+STATUS_DATA_UNDERRUN = 0x02
+STATUS_DATA_OVERRUN = 0x03
+STATUS_BAD_ENVELOPE = 0x04
+STATUS_NOT_EXECUTED = 0xFF
+
+# Failure code of housekeeping requests for parameters the tool does not have
+# (not defined by the pyedbglib shipped with some packs)
+SETGET_FAILURE_NOT_SUPPORTED = 0x11
+
+
+class SimulatedExecutionError(Exception):
+    """
+    Execution of a primitive block stopped, with the status the tool reports for it
+    """
+    def __init__(self, msg, status):
+        super(SimulatedExecutionError, self).__init__(msg)
+        self.status = status
+
+
+class IcspTarget(object):
+    """
+    What is on the other end of the ICSP pins, as seen by the tool.
+    This one is nothing at all: inputs read low, and nothing answers.  Device models override these methods.
+    """
+
+    def __init__(self):
+        # Time at the target, in nanoseconds, kept up to date by the tool while it executes primitives
+        self.time_ns = 0
+
+    def set_mclr(self, high):
+        """
+        Drives MCLR (VPP)
+        :param high: True for high (released), False for low
+        """
+        pass
+
+    def set_pins(self, value):
+        """
+        Sets the direction and level of the ICSP clock and data pins
+        :param value: SET_ICSP_PINS argument
+        """
+        pass
+
+    def set_clk(self, high):
+        """
+        Drives the ICSP clock pin
+        :param high: True for high
+        """
+        pass
+
+    def get_pins(self):
+        """
+        :return: levels of the ICSP pins, as GET_ICSP_PINS returns them
+        """
+        return 0
+
+    def clock_out(self, bits, value, msb_first):
+        """
+        Clocks bits into the target
+        :param bits: number of bits
+        :param value: bits to send
+        :param msb_first: True if the most significant bit goes first
+        """
+        pass
+
+    def clock_in(self, bits, msb_first):
+        """
+        Clocks bits out of the target
+        :param bits: number of bits
+        :param msb_first: True if the most significant bit comes first
+        :return: bits received
+        """
+        return 0
+
+    def debug_command(self, command, data_out, bytes_in):
+        """
+        Runs a debug executive command
+        :param command: DE command code
+        :param data_out: data sent to the DE (bytearray)
+        :param bytes_in: number of bytes the DE returns
+        :return: data returned (bytearray)
+        """
+        return bytearray(bytes_in)
+
+    def pe_send_word(self, word):
+        """
+        Sends a word to the programming executive
+        :param word: 16-bit word
+        """
+        pass
+
+    def pe_receive_word(self):
+        """
+        :return: word received from the programming executive
+        """
+        return 0
+
+    def pe_handshake(self):
+        """
+        Waits for the programming executive to be done with its command
+        """
+        pass
+
+
+class PrimitiveInterpreter(object):
+    """
+    Executes primitive blocks the way the nEDBG firmware does, keeping track of how long they take
+    """
+
+    # Argument bytes following each primitive ID
+    ARGUMENT_BYTES = {
+        primitives.SET_VPP_ON: 0,
+        primitives.SET_VPP_OFF: 0,
+        primitives.SET_CLK_HI: 0,
+        primitives.SET_CLK_LO: 0,
+        primitives.SET_ICSP_PINS: 1,
+        primitives.GET_ICSP_PINS: 0,
+        primitives.DELAY_US: 2,
+        primitives.DELAY_MS: 2,
+        primitives.WRITE_LITERAL_32_LSB: 4,
+        primitives.WRITE_BITS_LITERAL: 5,
+        primitives.WRITE_BITS_LITERAL_MSB: 5,
+        primitives.P16ENV3_WRITE_PAYLOAD_LITERAL: 5,
+        primitives.P16ENV3_WRITE_BUFFER: 0,
+        primitives.P16ENV3_WRITE_BUFFER_DFM: 0,
+        primitives.P16ENV3_READ_PAYLOAD_PFM: 0,
+        primitives.P16ENV3_READ_PAYLOAD_DFM: 0,
+        primitives.P16F_READ_LOC_BUFFER: 0,
+        primitives.P16F_WRITE_LOC_BUFFER: 0,
+        primitives.DE_COMMAND: 5,
+        primitives.P24_SEND_PE_WORD: 2,
+        primitives.P24_SEND_PE_WORD_BUF: 0,
+        primitives.P24_RECEIVE_PE_WORD: 0,
+        primitives.P24_PE_HANDSHAKE: 0,
+        primitives.SET_SPEED: 4,
+        primitives.GET_SPEED: 0,
+    }
+
+    # Firmware time to fetch and dispatch one primitive
+    PRIMITIVE_OVERHEAD_NS = 1000
+    # ICSP clock period until the first SET_SPEED
+    DEFAULT_PERIOD_NS = 1000
+    # Bits of the data cycle of each ICSP variant
+    C8D24_PAYLOAD_BITS = 24
+    C6D16_PAYLOAD_BITS = 16
+
+    def __init__(self, target):
+        """
+        :param target: IcspTarget the ICSP pins are connected to
+        """
+        self.logger = logging.getLogger(__name__)
+        self.target = target
+        self.period_ns = self.DEFAULT_PERIOD_NS
+        # Statistics, for the whole session
+        self.primitives_executed = 0
+        self.icsp_ns = 0
+        self.delay_ns = 0
+        # Primitives left before an execution is made to fail, None to never fail
+        self.fail_after = None
+        # State of the execution in progress
+        self.elapsed_ns = 0
+        self._start_ns = 0
+        self._source = None
+        self._source_position = 0
+        self._dest = None
+        self._dest_position = 0
+
+    def parse(self, content, position=0, count=None):
+        """
+        Parses primitives into a tree
+        :param content: primitive bytes
+        :param position: where to start
+        :param count: number of elements to parse, None for all up to the end
+        :return: list of (primitive, arguments) and ('loop', repeats, elements), position after the last element
+        """
+        elements = []
+        while (count is None and position < len(content)) or (count is not None and len(elements) < count):
+            if position >= len(content):
+                raise SimulatedExecutionError("Primitive sequence ends in the middle of a lambda", STATUS_BAD_ENVELOPE)
+            primitive = content[position]
+            if primitive == primitives.LAMBDA:
+                repeats = content[position + 1]
+                body, position = self.parse(content, position + 3, content[position + 2])
+                elements.append(('loop', repeats, body))
+                continue
+            if primitive not in self.ARGUMENT_BYTES:
+                raise SimulatedExecutionError("Unknown primitive 0x{0:02X}".format(primitive), STATUS_UNKNOWN_PRIMITIVE)
+            end = position + 1 + self.ARGUMENT_BYTES[primitive]
+            elements.append((primitive, content[position + 1:end]))
+            position = end
+        return elements, position
+
+    def execute(self, content, start_ns, source, dest):
+        """
+        Executes a block of primitives
+        :param content: primitive bytes
+        :param start_ns: time the block starts executing
+        :param source: data buffer the block takes data from, as [buffer, read position], or None
+        :param dest: data buffer the block puts data in, as [buffer, write position], or None
+        :return: time taken, in nanoseconds
+        """
+        self._start_ns = start_ns
+        self.elapsed_ns = 0
+        self._source = source
+        self._dest = dest
+        elements, _ = self.parse(bytearray(content))
+        self._run(elements)
+        return self.elapsed_ns
+
+    def _run(self, elements):
+        for element in elements:
+            if element[0] == 'loop':
+                # The body runs once more than it repeats
+                for _ in range(element[1] + 1):
+                    self._run(element[2])
+                continue
+            self._step(element[0], element[1])
+
+    def _advance(self, nanoseconds):
+        self.elapsed_ns += nanoseconds
+        self.target.time_ns = self._start_ns + self.elapsed_ns
+
+    def _clock_out(self, bits, value, msb_first):
+        self._advance(bits * self.period_ns)
+        self.icsp_ns += bits * self.period_ns
+        self.target.clock_out(bits, value & ((1 << bits) - 1), msb_first)
+
+    def _clock_in(self, bits, msb_first):
+        self._advance(bits * self.period_ns)
+        self.icsp_ns += bits * self.period_ns
+        return self.target.clock_in(bits, msb_first) & ((1 << bits) - 1)
+
+    def _delay(self, nanoseconds):
+        self._advance(nanoseconds)
+        self.delay_ns += nanoseconds
+
+    def _take(self, numbytes):
+        """
+        Takes data from the data pipe
+        """
+        if not numbytes:
+            # DE commands which send nothing run without a data pipe
+            return bytearray()
+        if self._source is None or self._source[1] + numbytes > len(self._source[0]):
+            raise SimulatedExecutionError("Data pipe underrun", STATUS_DATA_UNDERRUN)
+        buffer, position = self._source
+        self._source[1] = position + numbytes
+        return buffer[position:position + numbytes]
+
+    def _put(self, data):
+        """
+        Puts data in the data pipe
+        """
+        if self._dest is None:
+            # No destination, the data is dropped
+            return
+        buffer, position = self._dest
+        if position + len(data) > len(buffer):
+            raise SimulatedExecutionError("Data pipe overrun", STATUS_DATA_OVERRUN)
+        buffer[position:position + len(data)] = data
+        self._dest[1] = position + len(data)
+
+    def _step(self, primitive, arguments):
+        # pylint: disable=too-many-branches, too-many-statements
+        if self.fail_after is not None:
+            if not self.fail_after:
+                self.fail_after = None
+                raise SimulatedExecutionError("Injected failure", STATUS_UNKNOWN_PRIMITIVE)
+            self.fail_after -= 1
+        self.primitives_executed += 1
+        self._advance(self.PRIMITIVE_OVERHEAD_NS)
+        target = self.target
+        if primitive == primitives.SET_VPP_ON:
+            target.set_mclr(True)
+        elif primitive == primitives.SET_VPP_OFF:
+            target.set_mclr(False)
+        elif primitive == primitives.SET_CLK_HI:
+            target.set_clk(True)
+        elif primitive == primitives.SET_CLK_LO:
+            target.set_clk(False)
+        elif primitive == primitives.SET_ICSP_PINS:
+            target.set_pins(arguments[0])
+        elif primitive == primitives.GET_ICSP_PINS:
+            self._put(bytearray([target.get_pins() & 0xFF]))
+        elif primitive == primitives.DELAY_US:
+            self._delay(binary.unpack_le16(arguments) * 1000)
+        elif primitive == primitives.DELAY_MS:
+            self._delay(binary.unpack_le16(arguments) * 1000000)
+        elif primitive == primitives.WRITE_LITERAL_32_LSB:
+            self._clock_out(32, binary.unpack_le32(arguments), False)
+        elif primitive == primitives.WRITE_BITS_LITERAL:
+            self._clock_out(arguments[0], binary.unpack_le32(arguments[1:]), False)
+        elif primitive == primitives.WRITE_BITS_LITERAL_MSB:
+            self._clock_out(arguments[0], binary.unpack_le32(arguments[1:]), True)
+        elif primitive == primitives.P16ENV3_WRITE_PAYLOAD_LITERAL:
+            # Payloads go between a start and a stop bit
+            self._clock_out(arguments[0], binary.unpack_le32(arguments[1:]) << 1, True)
+        elif primitive == primitives.P16ENV3_WRITE_BUFFER:
+            self._clock_out(self.C8D24_PAYLOAD_BITS, binary.unpack_le16(self._take(2)) << 1, True)
+        elif primitive == primitives.P16ENV3_WRITE_BUFFER_DFM:
+            self._clock_out(self.C8D24_PAYLOAD_BITS, self._take(1)[0] << 1, True)
+        elif primitive == primitives.P16ENV3_READ_PAYLOAD_PFM:
+            value = self._clock_in(self.C8D24_PAYLOAD_BITS, True) >> 1
+            self._put(binary.pack_le16(value & 0xFFFF))
+        elif primitive == primitives.P16ENV3_READ_PAYLOAD_DFM:
+            value = self._clock_in(self.C8D24_PAYLOAD_BITS, True) >> 1
+            self._put(bytearray([value & 0xFF]))
+        elif primitive == primitives.P16F_WRITE_LOC_BUFFER:
+            self._clock_out(self.C6D16_PAYLOAD_BITS, (binary.unpack_le16(self._take(2)) & 0x3FFF) << 1, False)
+        elif primitive == primitives.P16F_READ_LOC_BUFFER:
+            value = self._clock_in(self.C6D16_PAYLOAD_BITS, False) >> 1
+            self._put(binary.pack_le16(value & 0x3FFF))
+        elif primitive == primitives.DE_COMMAND:
+            command = arguments[0]
+            bytes_out = binary.unpack_le16(arguments[1:3])
+            bytes_in = binary.unpack_le16(arguments[3:5])
+            data_out = self._take(bytes_out)
+            # Each byte is clocked through the ICSP pins
+            self._advance((bytes_out + bytes_in) * 8 * self.period_ns)
+            self.icsp_ns += (bytes_out + bytes_in) * 8 * self.period_ns
+            data_in = bytearray(target.debug_command(command, data_out, bytes_in))
+            self._put(data_in[:bytes_in] + bytearray(max(0, bytes_in - len(data_in))))
+        elif primitive == primitives.P24_SEND_PE_WORD:
+            self._advance(16 * self.period_ns)
+            target.pe_send_word(binary.unpack_le16(arguments))
+        elif primitive == primitives.P24_SEND_PE_WORD_BUF:
+            self._advance(16 * self.period_ns)
+            target.pe_send_word(binary.unpack_le16(self._take(2)))
+        elif primitive == primitives.P24_RECEIVE_PE_WORD:
+            self._advance(16 * self.period_ns)
+            self._put(binary.pack_le16(target.pe_receive_word() & 0xFFFF))
+        elif primitive == primitives.P24_PE_HANDSHAKE:
+            target.pe_handshake()
+        elif primitive == primitives.SET_SPEED:
+            self.period_ns = binary.unpack_le32(arguments) or self.DEFAULT_PERIOD_NS
+        elif primitive == primitives.GET_SPEED:
+            self._put(binary.pack_le32(self.period_ns))
+
+
+class SimulatedTransport(object):
+    """
+    HID transport which is an nEDBG running on the host.
+
+    Supports the HID transport API (hid_transfer, hid_write, hid_read and get_report_size), and the MPLAB X tool API
+    (GetPacketSize, Send and Receive) so that it can also be handed over as the tool of an MPLAB session.
+    """
+
+    # Full speed USB: one HID report each way per 1 ms frame
+    USB_FRAME_NS = 1000000
+    REPORT_SIZE = 64
+    # What the tool says about itself
+    PRODUCT = "nEDBG CMSIS-DAP"
+    SERIAL = "MCHP3290SIM00001"
+    FIRMWARE_VERSION = (1, 26, 630)
+    VTREF_MV = 3300
+    # Number of ATI data buffers
+    DATA_BUFFERS = 8
+
+    def __init__(self, target=None, device_name="", report_size=REPORT_SIZE, data_buffer_size=ATI_DATA_BUFFER_SIZE,
+                 usb_parameters=True):
+        """
+        :param target: IcspTarget connected to the tool, None for no target
+        :param device_name: name of the device the tool says is mounted on its kit, "" for none
+        :param report_size: HID report size
+        :param data_buffer_size: size of each ATI data buffer
+        :param usb_parameters: False for a tool which does not report its USB buffer and report sizes
+        """
+        self.logger = logging.getLogger(__name__)
+        self.target = target if target is not None else IcspTarget()
+        self.device_name = device_name
+        self.report_size = report_size
+        self.data_buffer_size = data_buffer_size
+        self.interpreter = PrimitiveInterpreter(self.target)
+
+        # Time as seen by the host, and when each USB direction and the tool are next free
+        self.host_ns = 0
+        self._out_free_ns = 0
+        self._in_free_ns = 0
+        self._busy_until_ns = 0
+        # Responses to reports written with hid_write, with the time they are ready, in order
+        self._responses = []
+        # Response to the last report sent with Send, for Receive
+        self._mplab_response = None
+
+        # ATI buffers
+        self._data_buffers = [bytearray(data_buffer_size) for _ in range(self.DATA_BUFFERS)]
+        self._metadata_buffers = [bytearray() for _ in range(self.DATA_BUFFERS)]
+        self._command = bytearray()
+        self._response = bytearray()
+        self._write_position = {}
+        self._read_position = {}
+
+        # AVR command fragments, and the response to the last command
+        self._avr_command = bytearray()
+        self._avr_response = None
+        self._housekeeping = self._housekeeping_parameters(usb_parameters)
+
+        # Statistics
+        self.reports_out = 0
+        self.reports_in = 0
+        self.polls = 0
+        self.bytes_out = 0
+        self.bytes_in = 0
+        self.executions = 0
+        self.blocks = 0
+        self.busy_ns = 0
+
+    def _housekeeping_parameters(self, usb_parameters):
+        """
+        :param usb_parameters: True to include the parameters of the USB context
+        :return: housekeeping parameter values, by (context, parameter)
+        """
+        hk = Jtagice3HousekeepingProtocol
+        major, minor, build = self.FIRMWARE_VERSION
+        parameters = {
+            (hk.HOUSEKEEPING_CONTEXT_CONFIG, hk.HOUSEKEEPING_CONFIG_HWREV): bytearray([0]),
+            (hk.HOUSEKEEPING_CONTEXT_CONFIG, hk.HOUSEKEEPING_CONFIG_FWREV_MAJ): bytearray([major]),
+            (hk.HOUSEKEEPING_CONTEXT_CONFIG, hk.HOUSEKEEPING_CONFIG_FWREV_MIN): bytearray([minor]),
+            (hk.HOUSEKEEPING_CONTEXT_CONFIG, hk.HOUSEKEEPING_CONFIG_BUILD): binary.pack_le16(build),
+            (hk.HOUSEKEEPING_CONTEXT_CONFIG, hk.HOUSEKEEPING_CONFIG_CHIP): bytearray([0]),
+            (hk.HOUSEKEEPING_CONTEXT_CONFIG, hk.HOUSEKEEPING_CONFIG_BLDR_MAJ): bytearray([1, 0]),
+            (hk.HOUSEKEEPING_CONTEXT_CONFIG, hk.HOUSEKEEPING_CONFIG_BLDR_MIN): bytearray([0]),
+            (hk.HOUSEKEEPING_CONTEXT_CONFIG, hk.HOUSEKEEPING_CONFIG_DEBUG_BUILD): bytearray([0]),
+            (hk.HOUSEKEEPING_CONTEXT_ANALOG, hk.HOUSEKEEPING_ANALOG_VTREF): binary.pack_le16(self.VTREF_MV),
+        }
+        if usb_parameters:
+            parameters.update({
+                (hk.HOUSEKEEPING_CONTEXT_USB, hk.HOUSEKEEPING_USB_MAX_READ): binary.pack_le16(self.data_buffer_size),
+                (hk.HOUSEKEEPING_CONTEXT_USB, hk.HOUSEKEEPING_USB_MAX_WRITE): binary.pack_le16(self.data_buffer_size),
+                (hk.HOUSEKEEPING_CONTEXT_USB, hk.HOUSEKEEPING_USB_EP_SIZE_HID): binary.pack_le16(self.report_size),
+            })
+        return parameters
+
+    # HID transport API
+
+    def get_report_size(self):
+        """
+        :return: bytes per HID report
+        """
+        return self.report_size
+
+    def hid_transfer(self, packet):
+        """
+        Sends a report and receives the response
+        :param packet: report to send
+        :return: response report
+        """
+        arrival_ns = self._send()
+        response = self._handle(bytearray(packet), arrival_ns)
+        self._receive(arrival_ns)
+        return response
+
+    def hid_write(self, packet):
+        """
+        Sends a report without waiting for its response, which is then picked up by hid_read
+        :param packet: report to send
+        :return: number of bytes sent
+        """
+        arrival_ns = self._send()
+        self._responses.append((self._handle(bytearray(packet), arrival_ns), arrival_ns))
+        return len(packet)
+
+    def hid_read(self):
+        """
+        Receives the response to the oldest report sent with hid_write
+        :return: response report
+        """
+        if not self._responses:
+            raise Exception("No response to read: nothing was written")
+        response, ready_ns = self._responses.pop(0)
+        self._receive(ready_ns)
+        return response
+
+    # MPLAB X tool API
+
+    # pylint: disable=invalid-name
+    def GetPacketSize(self):
+        """
+        :return: bytes per HID report
+        """
+        return self.report_size
+
+    def Send(self, packet, length):
+        """
+        Sends a report, the response is then picked up by Receive
+        """
+        self._mplab_response = self.hid_transfer(bytearray(packet)[:length])
+
+    def Receive(self, response, length):
+        """
+        Copies the response to the last report sent into the array given
+        """
+        response[0:length] = self._mplab_response[:length]
+    # pylint: enable=invalid-name
+
+    # Statistics
+
+    def elapsed_s(self):
+        """
+        :return: modeled time of the session so far, in seconds
+        """
+        return max(self.host_ns, self._busy_until_ns) / 1e9
+
+    def statistics(self):
+        """
+        :return: dictionary of the counters of the session so far
+        """
+        return {
+            'elapsed_s': self.elapsed_s(),
+            'usb_reports_out': self.reports_out,
+            'usb_reports_in': self.reports_in,
+            'usb_polls': self.polls,
+            'ati_bytes_out': self.bytes_out,
+            'ati_bytes_in': self.bytes_in,
+            'executions': self.executions,
+            'blocks': self.blocks,
+            'primitives': self.interpreter.primitives_executed,
+            'tool_busy_s': self.busy_ns / 1e9,
+            'icsp_clock_s': self.interpreter.icsp_ns / 1e9,
+            'icsp_delay_s': self.interpreter.delay_ns / 1e9,
+        }
+
+    # USB timing
+
+    def _frame_start(self, time_ns):
+        """
+        :return: start of the first USB frame at or after the given time
+        """
+        frames = (time_ns + self.USB_FRAME_NS - 1) // self.USB_FRAME_NS
+        return frames * self.USB_FRAME_NS
+
+    def _send(self):
+        """
+        Schedules an OUT report
+        :return: time the report reaches the tool
+        """
+        start_ns = self._frame_start(max(self.host_ns, self._out_free_ns))
+        self._out_free_ns = start_ns + self.USB_FRAME_NS
+        self.reports_out += 1
+        return start_ns + self.USB_FRAME_NS
+
+    def _receive(self, ready_ns):
+        """
+        Schedules the IN report of a response, and moves the host on to when it has it
+        :param ready_ns: time the response is ready in the tool
+        """
+        start_ns = self._frame_start(max(ready_ns, self._in_free_ns))
+        self._in_free_ns = start_ns + self.USB_FRAME_NS
+        self.reports_in += 1
+        self.host_ns = max(self.host_ns, start_ns + self.USB_FRAME_NS)
+
+    # Firmware
+
+    def _report(self, data):
+        """
+        Pads a response to a full report
+        """
+        response = bytearray(data)
+        return response + bytearray(max(0, self.report_size - len(response)))
+
+    def _handle(self, packet, time_ns):
+        """
+        Handles a report the way the firmware does
+        :param packet: report received
+        :param time_ns: time it is received
+        :return: response report
+        """
+        command = packet[0]
+        if command == CmsisDapUnit.ID_DAP_Info:
+            return self._report(self._dap_info(packet[1]))
+        if command == AvrCommand.AVR_COMMAND:
+            return self._report(self._avr_command_fragment(packet))
+        if command == AvrCommand.AVR_RESPONSE:
+            return self._report(self._avr_response_fragment())
+        if command == AvrCommand.AVR_EVENT:
+            return self._report([AvrCommand.AVR_EVENT, 0x00])
+        if command == VENDOR_COMMAND_ATI:
+            return self._report(self._ati(packet, time_ns))
+        self.logger.warning("Simulated tool does not support command 0x%02X", command)
+        return self._report([command, 0xFF])
+
+    def _dap_info(self, field):
+        """
+        :return: DAP_Info response for a field
+        """
+        values = {
+            CmsisDapUnit.DAP_ID_VENDOR: "Microchip",
+            CmsisDapUnit.DAP_ID_PRODUCT: self.PRODUCT,
+            CmsisDapUnit.DAP_ID_SER_NUM: self.SERIAL,
+            CmsisDapUnit.DAP_ID_FW_VER: "{0:d}.{1:d}.{2:d}".format(*self.FIRMWARE_VERSION),
+            CmsisDapUnit.DAP_ID_DEVICE_VENDOR: "Microchip" if self.device_name else "",
+            CmsisDapUnit.DAP_ID_DEVICE_NAME: self.device_name.upper(),
+            CmsisDapUnit.DAP_ID_CAPABILITIES: "\x01",
+        }
+        value = bytearray(values.get(field, "").encode())
+        return bytearray([CmsisDapUnit.ID_DAP_Info, len(value)]) + value
+
+    def _avr_command_fragment(self, packet):
+        """
+        Takes a fragment of an AVR command, and handles the command once it is complete
+        """
+        index = packet[1] >> 4
+        total = packet[1] & 0x0F
+        length = binary.unpack_be16(packet[2:4])
+        if index == 1:
+            self._avr_command = bytearray()
+        self._avr_command.extend(packet[4:4 + length])
+        if index < total:
+            return [AvrCommand.AVR_COMMAND, AvrCommand.AVR_MORE_FRAGMENTS]
+        self._avr_response = self._jtagice3(self._avr_command)
+        return [AvrCommand.AVR_COMMAND, AvrCommand.AVR_FINAL_FRAGMENT]
+
+    def _avr_response_fragment(self):
+        """
+        :return: the response to the last AVR command, in one fragment
+        """
+        if self._avr_response is None:
+            return [AvrCommand.AVR_RESPONSE, 0x00]
+        response = self._avr_response
+        self._avr_response = None
+        return bytearray([AvrCommand.AVR_RESPONSE, 0x11]) + binary.pack_be16(len(response)) + response
+
+    def _jtagice3(self, command):
+        """
+        Handles a JTAGICE3 command
+        :return: response
+        """
+        sequence = command[2:4]
+        handler = command[4]
+        payload = command[5:]
+        header = bytearray([Jtagice3Command.JTAGICE3_TOKEN]) + sequence + bytearray([handler])
+        failed = bytearray([Jtagice3Protocol.PROTOCOL_FAILED, 0x00, SETGET_FAILURE_NOT_SUPPORTED])
+        if handler != Jtagice3Command.HANDLER_HOUSEKEEPING or not payload:
+            return header + failed
+        hk = Jtagice3HousekeepingProtocol
+        if payload[0] in (hk.CMD_HOUSEKEEPING_START_SESSION, hk.CMD_HOUSEKEEPING_END_SESSION, hk.CMD_SET):
+            return header + bytearray([Jtagice3Protocol.PROTOCOL_OK, 0x00])
+        if payload[0] == hk.CMD_GET:
+            value = self._housekeeping.get((payload[2], payload[3]))
+            if value is None:
+                return header + failed
+            value = (value + bytearray(payload[4]))[:payload[4]]
+            return header + bytearray([Jtagice3Protocol.PROTOCOL_DATA, 0x00]) + value + \
+                bytearray([Jtagice3Protocol.FAILURE_OK])
+        return header + failed
+
+    def _ati(self, packet, time_ns):
+        """
+        Handles an ATI fragment
+        :return: response
+        """
+        flags = packet[ATI_FRAME_FLAGS]
+        length = binary.unpack_be16(packet[ATI_FRAME_LENGTH:ATI_FRAME_PAYLOAD])
+        buffer_type = flags & ATI_CTRL_TYPE_CMDRSP
+        buffer_id = flags & 0x07
+        start = flags & (1 << ATI_CTRL_BIT_FRAME_SOF)
+        end = flags & (1 << ATI_CTRL_BIT_FRAME_EOF)
+        busy = time_ns < self._busy_until_ns
+        key = (buffer_type, buffer_id)
+
+        if flags & (1 << ATI_CTRL_BIT_READNWRITE):
+            if buffer_type == ATI_CTRL_TYPE_CMDRSP and busy:
+                # Still executing, the host has to ask again
+                self.polls += 1
+                return [VENDOR_COMMAND_ATI, 0x01, 0x00, 0x00]
+            if start:
+                self._read_position[key] = 0
+            position = self._read_position.get(key, 0)
+            buffer = self._buffer(buffer_type, buffer_id)
+            data = buffer[position:position + length]
+            self._read_position[key] = position + len(data)
+            self.bytes_in += len(data)
+            return bytearray([VENDOR_COMMAND_ATI, 0x00]) + binary.pack_be16(len(data)) + data
+
+        if buffer_type == ATI_CTRL_TYPE_CMDRSP and busy:
+            # Commands are taken one at a time
+            return ATI_FAILURE_FRAME
+        data = packet[ATI_FRAME_PAYLOAD:ATI_FRAME_PAYLOAD + length]
+        self.bytes_out += len(data)
+        if start:
+            self._write_position[key] = 0
+        position = self._write_position.get(key, 0)
+        if buffer_type == ATI_CTRL_TYPE_CMDRSP:
+            if start:
+                self._command = bytearray()
+            self._command.extend(data)
+        elif buffer_type == ATI_CTRL_TYPE_METADATA:
+            self._metadata_buffers[buffer_id][position:position + len(data)] = data
+        else:
+            if position + len(data) > len(self._data_buffers[buffer_id]):
+                return ATI_FAILURE_FRAME
+            self._data_buffers[buffer_id][position:position + len(data)] = data
+        self._write_position[key] = position + len(data)
+        if end and buffer_type == ATI_CTRL_TYPE_CMDRSP:
+            self._execute_command(self._command, time_ns)
+        return ATI_OK_FRAME
+
+    def _buffer(self, buffer_type, buffer_id):
+        """
+        :return: the ATI buffer of the given type and ID
+        """
+        if buffer_type == ATI_CTRL_TYPE_CMDRSP:
+            return self._response
+        if buffer_type == ATI_CTRL_TYPE_METADATA:
+            return self._metadata_buffers[buffer_id]
+        return self._data_buffers[buffer_id]
+
+    def _execute_command(self, command, time_ns):
+        """
+        Executes the contents of the command buffer, and leaves its response in the response buffer
+        :param command: command buffer
+        :param time_ns: time the command is complete in the tool
+        """
+        # ATI header: envelope version, variant, handler and handler variant
+        handler = command[2] if len(command) > 2 else None
+        if handler != ATI_EXEC_PIC_PRIMITIVE:
+            self.logger.warning("Simulated tool does not support ATI handler %s", handler)
+            self._response = bytearray([0x01]) + binary.pack_le32(STATUS_BAD_ENVELOPE)
+            return
+        self.executions += 1
+        # Primitive envelope: version, block count, then each block with its length in front
+        position = 4
+        if command[position] != PRIMITIVE_ENVELOPE_VERSION_MAJOR:
+            self._response = bytearray([0x01]) + binary.pack_le32(STATUS_BAD_ENVELOPE)
+            return
+        count = command[position + 2]
+        position += 3
+        statuses = bytearray()
+        duration_ns = 0
+        # Each data buffer is read from its start and written from its start, for the whole execution
+        pipes = {}
+        failed = False
+        for _ in range(count):
+            length = command[position]
+            block = command[position + 1:position + 1 + length]
+            position += 1 + length
+            if failed:
+                statuses.extend(binary.pack_le32(STATUS_NOT_EXECUTED))
+                continue
+            self.blocks += 1
+            source = self._pipe(pipes, 'source', block[0])
+            dest = self._pipe(pipes, 'dest', block[1])
+            # Source, destination, parameter count, parameters, content source, then the primitives
+            content = block[3 + block[2] * 6 + 1:]
+            try:
+                duration_ns += self.interpreter.execute(content, time_ns + duration_ns, source, dest)
+                statuses.extend(binary.pack_le32(STATUS_OK))
+            except SimulatedExecutionError as error:
+                self.logger.debug("Simulated execution failed: %s", error)
+                duration_ns += self.interpreter.elapsed_ns
+                statuses.extend(binary.pack_le32(error.status))
+                failed = True
+        self.busy_ns += duration_ns
+        self._busy_until_ns = time_ns + duration_ns
+        self._response = bytearray([0x00]) + statuses
+
+    def _pipe(self, pipes, direction, buffer_id):
+        """
+        :return: the data pipe of a block, as [buffer, position], shared by all blocks of the execution
+        """
+        if buffer_id in (DATA_SOURCE_UNDEFINED, DATA_DEST_UNDEFINED) or buffer_id >= len(self._data_buffers):
+            return None
+        key = (direction, buffer_id)
+        if key not in pipes:
+            pipes[key] = [self._data_buffers[buffer_id], 0]
+        return pipes[key]
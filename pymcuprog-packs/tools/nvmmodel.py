@@ -0,0 +1,702 @@
+"""
+    nvmmodel
+    Behavioural models of the NVM of the PIC devices, as seen through their ICSP pins
+
+    The models take the command and data cycles clocked in by a simulated tool (see nedbgsim) and act on them the way
+    the programming specifications say: the PC is loaded and stepped, locations are read, latched, programmed and
+    erased, and the debug executive (DE) region is only written to after a MAE command.
+    Everything is taken from the DeviceDefinition of the pack: command codes, memory sizes, and the delays of the
+    internally timed operations, which are used to flag commands arriving while the device is still busy.
+
+    Flash only programs bits from 1 to 0, so writing to locations which were not erased shows up when verifying.
+    As with nedbgsim, the pack modelled has to be on the module search path before this is imported.
+"""
+import logging
+
+from nedbgsim import IcspTarget
+from proginterfaceprovider import ProgInterfaceIcspC6D16
+
+# Value clocked in before the programming mode entry key ('MCHP')
+PROGRAMMING_MODE_KEY = 0x4D434850
+
+# Regions of the address space
+FLASH = 'flash'
+USER_ID = 'user_id'
+CONFIG = 'config'
+EEPROM = 'eeprom'
+DEVICE_ID = 'device_id'
+EXECUTIVE = 'executive'
+
+
+class MemoryRegion(object):
+    """
+    A region of the address space of a device model
+    """
+    # pylint: disable=too-few-public-methods, too-many-arguments
+    def __init__(self, name, start, end, bits, erased, overwrite=False, writable=True):
+        """
+        :param name: FLASH, USER_ID, CONFIG, EEPROM, DEVICE_ID or EXECUTIVE
+        :param start: first location
+        :param end: location after the last one
+        :param bits: width of each value held
+        :param erased: value of an erased location
+        :param overwrite: True if programming replaces values (self erasing), False if it only clears bits
+        :param writable: False for read-only regions
+        """
+        self.name = name
+        self.start = start
+        self.end = end
+        self.bits = bits
+        self.erased = erased
+        self.overwrite = overwrite
+        self.writable = writable
+
+    def __contains__(self, address):
+        return self.start <= address < self.end
+
+
+class PicNvmModel(IcspTarget):
+    """
+    Base class of the device models: programming mode entry, decoding of ICSP cycles, memory and timing.
+    Each location holds a value as wide as its region; addresses are the ones the PC of the device takes.
+    """
+
+    # Widths of the ICSP cycles, in bits
+    COMMAND_BITS = 8
+    PAYLOAD_BITS = 24
+    KEY_BITS = 32
+
+    def __init__(self, device_definition, device_id=None):
+        """
+        :param device_definition: DeviceDefinition class of the device modelled
+        :param device_id: value of the device ID, None to leave it erased
+        """
+        IcspTarget.__init__(self)
+        self.logger = logging.getLogger(__name__)
+        self.definition = device_definition
+        self.regions = self._regions()
+        self.executive = self._executive_region()
+        self.memory = {}
+        self.latches = {}
+        self.pc = 0
+        self.programming_mode = False
+        self.de_access = False
+        self._mclr_high = True
+        self._pending = None
+        self._busy_until_ns = 0
+        # Commands, by code: (handler, what follows: 'payload', 'read' or None)
+        self._commands = {}
+        self._bind_commands()
+        if device_id is not None:
+            self._set_device_id(device_id)
+        self.reset_statistics()
+
+    def reset_statistics(self):
+        """
+        Clears the counters returned by statistics()
+        """
+        self.commands = 0
+        self.bulk_erases = 0
+        self.row_erases = 0
+        self.program_operations = 0
+        self.locations_programmed = 0
+        self.erase_ns = 0
+        self.program_ns = 0
+        self.timing_violations = 0
+        self.protocol_errors = 0
+        self.rejected_writes = 0
+
+    def statistics(self):
+        """
+        :return: dictionary of the counters of the model
+        """
+        return {
+            'icsp_commands': self.commands,
+            'bulk_erases': self.bulk_erases,
+            'row_erases': self.row_erases,
+            'program_operations': self.program_operations,
+            'locations_programmed': self.locations_programmed,
+            'nvm_erase_s': self.erase_ns / 1e9,
+            'nvm_program_s': self.program_ns / 1e9,
+            'timing_violations': self.timing_violations,
+            'protocol_errors': self.protocol_errors,
+            'rejected_writes': self.rejected_writes,
+        }
+
+    # Device description, provided by the variants
+
+    def _regions(self):
+        """
+        :return: list of MemoryRegion, the executive region excluded
+        """
+        raise NotImplementedError("Memory regions must be described for this model")
+
+    def _executive_region(self):
+        """
+        :return: MemoryRegion for locations outside all other regions, where the DE goes
+        """
+        raise NotImplementedError("Executive region must be described for this model")
+
+    def _bind_commands(self):
+        """
+        Fills in the command table
+        """
+        raise NotImplementedError("Commands must be described for this model")
+
+    def _set_device_id(self, device_id):
+        """
+        Puts the device ID in place
+        """
+        raise NotImplementedError("Device ID location must be described for this model")
+
+    def _decode_payload(self, value):
+        """
+        :return: data carried by a payload cycle
+        """
+        raise NotImplementedError("Payload format must be described for this model")
+
+    def _encode_payload(self, data):
+        """
+        :return: payload cycle carrying the data
+        """
+        raise NotImplementedError("Payload format must be described for this model")
+
+    def _bind(self, name, handler, follows=None):
+        """
+        Adds a command to the command table, if the device has it
+        :param name: name of the command code in the DeviceDefinition
+        :param handler: method handling it
+        :param follows: 'payload' if a payload is clocked in after the command, 'read' if data is clocked out
+        """
+        code = getattr(self.definition, name, None)
+        if code is not None:
+            self._commands[code] = (handler, follows)
+
+    def _delay_ns(self, *names):
+        """
+        :return: the first of the delays named which is defined for the device, in nanoseconds
+        """
+        for name in names:
+            value = getattr(self.definition, name, None)
+            if value is None:
+                continue
+            if name.endswith('_MS'):
+                return value * 1000000
+            return value * 1000
+        return 0
+
+    # ICSP pins
+
+    def set_mclr(self, high):
+        if high and not self._mclr_high:
+            # Programming mode ends, with whatever was latched and not programmed
+            self.programming_mode = False
+            self.de_access = False
+            self.latches = {}
+            self._pending = None
+        self._mclr_high = high
+
+    def clock_out(self, bits, value, msb_first):
+        if bits == self.KEY_BITS:
+            if not self._mclr_high and value == PROGRAMMING_MODE_KEY:
+                self.programming_mode = True
+                self.pc = 0
+                self._pending = None
+            return
+        if not self.programming_mode:
+            return
+        if bits == self.COMMAND_BITS:
+            self._command(value)
+        elif bits == self.PAYLOAD_BITS:
+            self._payload(self._decode_payload(value))
+        else:
+            self._protocol_error("{0:d}-bit cycle".format(bits))
+
+    def clock_in(self, bits, msb_first):
+        if not self.programming_mode or bits != self.PAYLOAD_BITS or self._pending is None or \
+                self._pending[1] != 'read':
+            self._protocol_error("read cycle")
+            return 0
+        handler = self._pending[0]
+        self._pending = None
+        return self._encode_payload(handler())
+
+    def _command(self, code):
+        self.commands += 1
+        if self.time_ns < self._busy_until_ns:
+            self.timing_violations += 1
+            self.logger.warning("ICSP command 0x%02X %d ns before the device is done", code,
+                                self._busy_until_ns - self.time_ns)
+        if self._pending is not None:
+            self._protocol_error("command 0x{0:02X} instead of a data cycle".format(code))
+        command = self._commands.get(code)
+        if command is None:
+            self._protocol_error("command 0x{0:02X}".format(code))
+            return
+        handler, follows = command
+        if follows is None:
+            self._pending = None
+            handler()
+        else:
+            self._pending = command
+
+    def _payload(self, data):
+        if self._pending is None or self._pending[1] != 'payload':
+            self._protocol_error("payload cycle")
+            return
+        handler = self._pending[0]
+        self._pending = None
+        handler(data)
+
+    def _protocol_error(self, what):
+        self.protocol_errors += 1
+        self.logger.warning("Unexpected %s (PC 0x%06X)", what, self.pc)
+        self._pending = None
+
+    def _busy(self, duration_ns):
+        """
+        Starts an internally timed operation
+        """
+        self._busy_until_ns = self.time_ns + duration_ns
+
+    # Memory
+
+    def region(self, address):
+        """
+        :return: MemoryRegion holding a location
+        """
+        for region in self.regions:
+            if address in region:
+                return region
+        return self.executive
+
+    def read_location(self, address):
+        """
+        :return: value held at a location
+        """
+        return self.memory.get(address, self.region(address).erased)
+
+    def _program_location(self, address, value):
+        """
+        Programs one location, as far as its region allows
+        :return: True if programmed
+        """
+        region = self.region(address)
+        if not region.writable or (region is self.executive and not self.de_access):
+            self.rejected_writes += 1
+            return False
+        value &= (1 << region.bits) - 1
+        if not region.overwrite:
+            # Flash cells only go from 1 to 0 until erased
+            value &= self.memory.get(address, region.erased)
+        self.memory[address] = value
+        self.locations_programmed += 1
+        return True
+
+    def _erase_region(self, region):
+        """
+        Erases all of a region
+        """
+        for address in [address for address in self.memory if self.region(address) is region]:
+            del self.memory[address]
+
+    def _erase_range(self, start, end):
+        """
+        Erases the locations of a range
+        """
+        for address in range(start, end):
+            self.memory.pop(address, None)
+
+    def _program_latches(self):
+        """
+        Programs what was latched, as one internally timed operation
+        """
+        if not self.latches:
+            self._protocol_error("programming with nothing latched")
+            return
+        region = self.region(min(self.latches))
+        for address in sorted(self.latches):
+            self._program_location(address, self.latches[address])
+        self.latches = {}
+        self.program_operations += 1
+        duration_ns = self._program_delay_ns(region)
+        self.program_ns += duration_ns
+        self._busy(duration_ns)
+
+    def _program_delay_ns(self, region):
+        """
+        :return: time taken to program locations of a region
+        """
+        raise NotImplementedError("Programming times must be described for this model")
+
+    def _erase_rows(self, address):
+        """
+        Erases the flash row holding a location
+        """
+        row = self.row_locations()
+        start = address - address % row
+        region = self.region(start)
+        if region is self.executive and not self.de_access:
+            self.rejected_writes += 1
+        else:
+            self._erase_range(start, start + row)
+        self.row_erases += 1
+        duration_ns = self._delay_ns('ROW_ERASE_DELAY_US')
+        self.erase_ns += duration_ns
+        self._busy(duration_ns)
+
+    def row_locations(self):
+        """
+        :return: number of locations in a flash row
+        """
+        raise NotImplementedError("Row size must be described for this model")
+
+    def _bulk_erase_regions(self, regions, duration_ns):
+        """
+        Erases whole regions, as one internally timed operation
+        """
+        for region in regions:
+            self._erase_region(region)
+        self.bulk_erases += 1
+        self.erase_ns += duration_ns
+        self._busy(duration_ns)
+
+    def _enable_de_access(self, key):
+        """
+        MAE command: the DE region is writable after the right key
+        """
+        self.de_access = key == self.definition.MAE_IEDE
+        if not self.de_access:
+            self._protocol_error("MAE key 0x{0:06X}".format(key))
+
+
+class PicNvmModelC8D24(PicNvmModel):
+    """
+    Devices with 8-bit commands and 24-bit data cycles.
+    PIC16 devices address words, one per location; PIC18 devices address bytes, and access program memory two at a time.
+    Depending on the device, data is either programmed as it comes in (WRITE/PROGRAM_DATA commands) or latched
+    (LOAD_DATA commands) until an internally timed programming command.
+    """
+
+    COMMAND_BITS = 8
+    PAYLOAD_BITS = 24
+
+    # PIC16 configuration space, by word address
+    PIC16_CONFIG_SPACE = 0x8000
+    PIC16_CONFIG_SPACE_END = 0x8100
+    # PIC18 regions, by byte address
+    PIC18_USER_ID_ADDRESS = 0x200000
+    PIC18_CONFIG_ADDRESS = 0x300000
+    PIC18_SPACE_SIZE = 0x100
+    PIC18_DEVICE_ID_ADDRESS = 0x3FFFFC
+    PIC18_END_ADDRESS = 0x400000
+
+    def __init__(self, device_definition, device_id=None):
+        # PIC18 devices have byte addresses, and step over two of them for a word
+        self.byte_addressed = device_definition.PC_WORD_STEP == 2
+        # Devices erasing by bit field (rather than by PC) have byte wide configuration memory
+        self.erase_bit_field = hasattr(device_definition, 'ICD_MEMORY')
+        PicNvmModel.__init__(self, device_definition, device_id)
+
+    def _regions(self):
+        definition = self.definition
+        if self.byte_addressed:
+            regions = [
+                MemoryRegion(FLASH, 0, definition.FLASH_SIZE_BYTES, 8, 0xFF),
+                MemoryRegion(USER_ID, self.PIC18_USER_ID_ADDRESS, self.PIC18_USER_ID_ADDRESS + self.PIC18_SPACE_SIZE,
+                             8, 0xFF),
+                MemoryRegion(CONFIG, self.PIC18_CONFIG_ADDRESS, self.PIC18_CONFIG_ADDRESS + self.PIC18_SPACE_SIZE, 8,
+                             0xFF, overwrite=True),
+                MemoryRegion(DEVICE_ID, self.PIC18_DEVICE_ID_ADDRESS, self.PIC18_END_ADDRESS, 8, 0xFF,
+                             writable=False),
+            ]
+            if definition.EEPROM_SIZE_BYTES:
+                regions.append(MemoryRegion(EEPROM, definition.EEPROM_ADDRESS_B,
+                                            definition.EEPROM_ADDRESS_B + definition.EEPROM_SIZE_BYTES, 8, 0xFF,
+                                            overwrite=True))
+            return regions
+        device_id_address = definition.DEVICE_ID_ADDRESS_B // 2
+        regions = [
+            MemoryRegion(FLASH, 0, definition.FLASH_SIZE_BYTES // 2, 14, 0x3FFF),
+            MemoryRegion(USER_ID, self.PIC16_CONFIG_SPACE, self.PIC16_CONFIG_SPACE + 4, 14, 0x3FFF),
+            # Revision and device IDs
+            MemoryRegion(DEVICE_ID, device_id_address - 1, device_id_address + 1, 14, 0x3FFF, writable=False),
+            MemoryRegion(CONFIG, self.PIC16_CONFIG_SPACE + 4, self.PIC16_CONFIG_SPACE_END, 14, 0x3FFF,
+                         overwrite=True),
+        ]
+        if definition.EEPROM_SIZE_BYTES:
+            eeprom_address = definition.EEPROM_ADDRESS_B // 2
+            regions.append(MemoryRegion(EEPROM, eeprom_address, eeprom_address + definition.EEPROM_SIZE_BYTES, 8, 0xFF,
+                                        overwrite=True))
+        return regions
+
+    def _executive_region(self):
+        if self.byte_addressed:
+            return MemoryRegion(EXECUTIVE, 0, 0, 8, 0xFF)
+        return MemoryRegion(EXECUTIVE, 0, 0, 14, 0x3FFF)
+
+    def _bind_commands(self):
+        self._bind('LOAD_PC_COMMAND', self._load_pc, 'payload')
+        self._bind('BULK_ERASE_COMMAND', self._bulk_erase_bit_field if self.erase_bit_field else self._bulk_erase,
+                   'payload' if self.erase_bit_field else None)
+        self._bind('ROW_ERASE_COMMAND', lambda: self._erase_rows(self.pc))
+        self._bind('SECTOR_ERASE_COMMAND', lambda: self._erase_rows(self.pc))
+        self._bind('READ_DATA_NVM_COMMAND', lambda: self._read(False), 'read')
+        self._bind('READ_DATA_NVM_INC_COMMAND', lambda: self._read(True), 'read')
+        # Programmed as they come in
+        self._bind('WRITE_DATA_NVM_COMMAND', lambda data: self._write(data, False), 'payload')
+        self._bind('WRITE_DATA_NVM_INC_COMMAND', lambda data: self._write(data, True), 'payload')
+        self._bind('PROGRAM_DATA_COMMAND', lambda data: self._write(data, False), 'payload')
+        self._bind('PROGRAM_DATA_INC_COMMAND', lambda data: self._write(data, True), 'payload')
+        # Latched, then programmed together
+        self._bind('LOAD_DATA_NVM_COMMAND', lambda data: self._latch(data, False), 'payload')
+        self._bind('LOAD_DATA_NVM_INC_COMMAND', lambda data: self._latch(data, True), 'payload')
+        self._bind('INTERNALLY_TIMED_PROG_COMMAND', self._program_latches)
+        self._bind('INCREMENT_ADDRESS_COMMAND', self._increment)
+        self._bind('ADDRESS_INC', self._increment)
+        self._bind('MAE_COMMAND', self._enable_de_access, 'payload')
+
+    def _set_device_id(self, device_id):
+        if self.byte_addressed:
+            self.memory[self.definition.DEVICE_ID_ADDRESS_B] = device_id & 0xFF
+            self.memory[self.definition.DEVICE_ID_ADDRESS_B + 1] = (device_id >> 8) & 0xFF
+        else:
+            self.memory[self.definition.DEVICE_ID_ADDRESS_B // 2] = device_id & 0x3FFF
+
+    def _decode_payload(self, value):
+        # Start bit, then the data
+        return (value >> 1) & 0x3FFFFF
+
+    def _encode_payload(self, data):
+        return data << 1
+
+    def row_locations(self):
+        if self.byte_addressed:
+            return self.definition.FLASH_WRITE_BYTES_PER_PAGE
+        return self.definition.FLASH_WRITE_BYTES_PER_PAGE // 2
+
+    def _word_wide(self, address):
+        """
+        :return: True if the location is accessed a word (two locations) at a time
+        """
+        if not self.byte_addressed:
+            return False
+        region = self.region(address)
+        if region.name == EEPROM or (region.name == CONFIG and self.erase_bit_field):
+            return False
+        return True
+
+    def _step(self, address):
+        """
+        :return: how far the PC moves on from a location
+        """
+        return 2 if self._word_wide(address) else 1
+
+    def _load_pc(self, address):
+        self.pc = address
+
+    def _increment(self):
+        self.pc += self._step(self.pc)
+
+    def _read(self, increment):
+        address = self.pc
+        if self._word_wide(address):
+            data = self.read_location(address) | (self.read_location(address + 1) << 8)
+        else:
+            data = self.read_location(address)
+        if increment:
+            self.pc += self._step(address)
+        return data
+
+    def _locations(self, address, data):
+        """
+        :return: (location, value) pairs for data going to a location
+        """
+        if self._word_wide(address):
+            return [(address, data & 0xFF), (address + 1, (data >> 8) & 0xFF)]
+        return [(address, data)]
+
+    def _write(self, data, increment):
+        """
+        Programs data as it comes in, as one internally timed operation
+        """
+        address = self.pc
+        for location, value in self._locations(address, data):
+            self._program_location(location, value)
+        self.program_operations += 1
+        duration_ns = self._program_delay_ns(self.region(address))
+        self.program_ns += duration_ns
+        self._busy(duration_ns)
+        if increment:
+            self.pc += self._step(address)
+
+    def _latch(self, data, increment):
+        address = self.pc
+        for location, value in self._locations(address, data):
+            self.latches[location] = value
+        if increment:
+            self.pc += self._step(address)
+
+    def _program_delay_ns(self, region):
+        if region.name == EEPROM:
+            return self._delay_ns('EEPROM_PROGRAMMING_DELAY_US', 'WRITE_EEPROM_DELAY_US')
+        if region.name == CONFIG:
+            return self._delay_ns('WRITE_CONFIG_WORD_DELAY_US', 'WRITE_CONFIG_DELAY_US', 'CONFIG_PROGRAMMING_DELAY_US')
+        if region.name == USER_ID:
+            return self._delay_ns('ID_PROGRAMMING_DELAY_US', 'WRITE_USER_ID_DELAY_US', 'USER_ID_PROGRAMMING_DELAY_US')
+        if region is self.executive:
+            return self._delay_ns('WRITE_DE_PAGE_DELAY_US', 'WRITE_DE_DELAY_US')
+        return self._delay_ns('PAGE_PROGRAMMING_DELAY_US', 'WRITE_PROGRAM_DELAY_US', 'FLASH_PROGRAMMING_DELAY_US')
+
+    def _region_named(self, name):
+        for region in self.regions:
+            if region.name == name:
+                return region
+        return None
+
+    def _bulk_erase(self):
+        """
+        Bulk erase of the regions selected by the PC
+        """
+        region = self.region(self.pc)
+        if region is self.executive:
+            if not self.de_access:
+                self.rejected_writes += 1
+                return
+            self._bulk_erase_regions([self.executive], self._delay_ns('DE_ERASE_DELAY_US', 'BULK_ERASE_DELAY_US'))
+            return
+        if region.name == FLASH:
+            names = [FLASH]
+        elif region.name == EEPROM:
+            names = [EEPROM]
+        elif self.byte_addressed:
+            # From configuration space, PIC18 devices erase their EEPROM too
+            names = [FLASH, USER_ID, CONFIG, EEPROM]
+        else:
+            names = [FLASH, USER_ID, CONFIG]
+        regions = [self._region_named(name) for name in names if self._region_named(name) is not None]
+        self._bulk_erase_regions(regions, self._delay_ns('BULK_ERASE_DELAY_US', 'BULK_ERASE_DELAY_MS'))
+
+    def _bulk_erase_bit_field(self, selection):
+        """
+        Bulk erase of the regions selected by the payload
+        """
+        definition = self.definition
+        regions = []
+        for bit, name in ((definition.EEPROM_MEMORY, EEPROM), (definition.PROGRAM_MEMORY, FLASH),
+                          (definition.USER_ID_MEMORY, USER_ID), (definition.CONFIG_MEMORY, CONFIG)):
+            if selection & bit and self._region_named(name) is not None:
+                regions.append(self._region_named(name))
+        if selection & definition.ICD_MEMORY:
+            if self.de_access:
+                regions.append(self.executive)
+            else:
+                self.rejected_writes += 1
+        self._bulk_erase_regions(regions, self._delay_ns('BULK_ERASE_DELAY_US', 'BULK_ERASE_DELAY_MS'))
+
+
+class PicNvmModelC6D16(PicNvmModel):
+    """
+    Devices with 6-bit commands and 16-bit data cycles (14 bits of data between a start and a stop bit).
+    The PC can not be loaded: it is reset to the start of flash, moved to configuration space, and incremented.
+    Data is latched, then programmed by row.
+    """
+
+    COMMAND_BITS = 6
+    PAYLOAD_BITS = 16
+
+    # Configuration space and DE region, by word address
+    CONFIG_SPACE = 0x8000
+    EXECUTIVE_SPACE = 0x8100
+    PC_MASK = 0x7FFF
+
+    def _regions(self):
+        definition = self.definition
+        device_id_address = definition.DEVICE_ID_ADDRESS_B // 2
+        return [
+            MemoryRegion(FLASH, 0, definition.FLASH_SIZE_BYTES // 2, 14, 0x3FFF),
+            MemoryRegion(USER_ID, self.CONFIG_SPACE, self.CONFIG_SPACE + 4, 14, 0x3FFF),
+            MemoryRegion(DEVICE_ID, device_id_address - 1, device_id_address + 1, 14, 0x3FFF, writable=False),
+            MemoryRegion(CONFIG, self.CONFIG_SPACE + 4, self.EXECUTIVE_SPACE, 14, 0x3FFF, overwrite=True),
+        ]
+
+    def _executive_region(self):
+        return MemoryRegion(EXECUTIVE, 0, 0, 14, 0x3FFF)
+
+    def _bind_commands(self):
+        self._bind('LOAD_CONFIGURATION', self._load_configuration, 'payload')
+        self._bind('LOAD_DATA_FOR_PROGRAM_MEMORY', self._latch, 'payload')
+        self._bind('READ_DATA_FROM_PROGRAM_MEMORY', lambda: self.read_location(self.pc), 'read')
+        self._bind('INCREMENT_ADDRESS', self._increment)
+        self._bind('RESET_ADDRESS', self._reset_address)
+        self._bind('BEGIN_INTERNALLY_TIMED_PROGRAMMING', self._program_latches)
+        self._bind('BEGIN_EXTERNALLY_TIMED_PROGRAMMING', self._program_latches)
+        self._bind('END_EXTERNALLY_TIMED_PROGRAMMING', lambda: None)
+        self._bind('BULK_ERASE_PROGRAM_MEMORY', self._bulk_erase)
+        self._bind('ROW_ERASE_PROGRAM_MEMORY', lambda: self._erase_rows(self.pc))
+        self._bind('MAE_COMMAND', self._enable_de_access, 'payload')
+
+    def _set_device_id(self, device_id):
+        self.memory[self.definition.DEVICE_ID_ADDRESS_B // 2] = device_id & 0x3FFF
+
+    def _decode_payload(self, value):
+        # Start bit, 14 bits of data, stop bit
+        return (value >> 1) & 0x3FFF
+
+    def _encode_payload(self, data):
+        return (data & 0x3FFF) << 1
+
+    def _enable_de_access(self, key):
+        # Only 14 bits of the key make it through a data cycle
+        self.de_access = key == self.definition.MAE_IEDE & 0x3FFF
+        if not self.de_access:
+            self._protocol_error("MAE key 0x{0:04X}".format(key))
+
+    def row_locations(self):
+        return self.definition.FLASH_WRITE_BYTES_PER_PAGE // 2
+
+    def _load_configuration(self, data):
+        # pylint: disable=unused-argument
+        self.pc = self.CONFIG_SPACE
+
+    def _reset_address(self):
+        self.pc = 0
+
+    def _increment(self):
+        # The PC wraps within the space it is in
+        self.pc = (self.pc & self.CONFIG_SPACE) | ((self.pc + 1) & self.PC_MASK)
+
+    def _latch(self, data):
+        self.latches[self.pc] = data
+
+    def _program_delay_ns(self, region):
+        if region.name == FLASH:
+            return self._delay_ns('PROGRAM_MEMORY_DELAY_US')
+        return self._delay_ns('PROGRAM_CONFIG_WORDS_DELAY_US')
+
+    def _bulk_erase(self):
+        """
+        Bulk erase of the regions selected by the PC
+        """
+        duration_ns = self._delay_ns('BULK_ERASE_DELAY_US')
+        if self.pc < self.CONFIG_SPACE:
+            self._bulk_erase_regions([self.regions[0]], duration_ns)
+        elif self.pc >= self.EXECUTIVE_SPACE:
+            if not self.de_access:
+                self.rejected_writes += 1
+                return
+            self._bulk_erase_regions([self.executive], duration_ns)
+        else:
+            self._bulk_erase_regions([region for region in self.regions if region.writable], duration_ns)
+
+
+def create_nvm_model(device_definition, device_id=None):
+    """
+    Creates the model of a device
+    :param device_definition: DeviceDefinition class of the device
+    :param device_id: value of the device ID, None to leave it erased
+    :return: PicNvmModel to connect to a SimulatedTransport
+    """
+    if issubclass(device_definition.PROGRAMMING_INTERFACE, ProgInterfaceIcspC6D16):
+        return PicNvmModelC6D16(device_definition, device_id)
+    return PicNvmModelC8D24(device_definition, device_id)
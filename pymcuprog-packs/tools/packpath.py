@@ -0,0 +1,31 @@
+"""
+    packpath
+    Puts a pack on the module search path, so that the tools run against its stack
+
+    Every pack carries its own copy of the stack (common/, with pyedbglib in it) under the same module names, so one
+    process can only use one pack at a time.
+"""
+import os
+import sys
+
+
+def pack_device_name(pack_dir):
+    """
+    :param pack_dir: directory of a pack (the one holding nedbg_<device>.py)
+    :return: name of the device the pack is for
+    """
+    return [name[len('nedbg_'):-len('.py')] for name in sorted(os.listdir(pack_dir))
+            if name.startswith('nedbg_') and name.endswith('.py')][0]
+
+
+def use_pack(pack_dir):
+    """
+    Puts a pack and its common directory first on the module search path
+    :param pack_dir: directory of a pack
+    :return: absolute path of the pack directory
+    """
+    pack_dir = os.path.abspath(pack_dir)
+    if not os.path.isdir(os.path.join(pack_dir, 'common')):
+        raise ValueError("{} is not a pack directory".format(pack_dir))
+    sys.path[0:0] = [pack_dir, os.path.join(pack_dir, 'common')]
+    return pack_dir